@@ -1,3 +1,7 @@
-from runcmd import RunCmd, RunCmdError, RunCmdInternalError, RunCmdInvalidInputError, RunCmdInterruptError
+from runcmd import RunCmd, RunCmdError, RunCmdInternalError, RunCmdInvalidInputError, RunCmdInterruptError, \
+    RunCmdJob, RunCmdResult, RunCmdPool, RunCmdFuture, RunCmdSpawnServer, BoundedBuffer, \
+    SpooledBuffer, RunCmdSession, RunCmdCache
 
-__all__ = ['RunCmd', 'RunCmdError', 'RunCmdInternalError', 'RunCmdInvalidInputError', 'RunCmdInterruptError']
\ No newline at end of file
+__all__ = ['RunCmd', 'RunCmdError', 'RunCmdInternalError', 'RunCmdInvalidInputError', 'RunCmdInterruptError',
+           'RunCmdJob', 'RunCmdResult', 'RunCmdPool', 'RunCmdFuture', 'RunCmdSpawnServer', 'BoundedBuffer',
+           'SpooledBuffer', 'RunCmdSession', 'RunCmdCache']
\ No newline at end of file
@@ -29,10 +29,43 @@ import threading
 import os
 import sys
 import time
-import StringIO
 import traceback
 import signal
 import contextlib
+import codecs
+import mmap
+import tempfile
+import collections
+import select
+import io
+import errno
+import math
+import socket
+import struct
+import pickle
+import pipes
+import binascii
+import re
+import zlib
+import bz2
+import Queue
+import hashlib
+import json
+
+try:
+    import fcntl
+except ImportError:
+    # not available under Windows.
+    fcntl = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        # the backports.lzma package, under Python 2.
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 __version_info__ = ('0', '2', '6')
 __version__ = '.'.join(__version_info__)
@@ -85,314 +118,4805 @@ class RunCmdInterruptError(RunCmdError):
         return 'Command "{}" raised exception\n. {}'.format(self._cmd, self._err_msg)
 
 
-class _PipeData(threading.Thread):
-    """ A pipe which continuously reads from a source and writes to a destination file object
-    in the background.
+def _get_monotonic():
+    """ Find a clock which is not affected by changes to the system time.
 
-    Use the "with" statement to manage the context of the _PipeData instance,
-    e.g.:
-        is_keep_reading = True
-        with _PipeData(out_file) as pipe:
-            while is_keep_reading and not pipe.is_error:
-                # do something.
+    Python 2 has no time.monotonic(), hence the platform's monotonic clock is read via ctypes
+    where possible. Falls back to time.time() if none can be found.
 
-            if pipe.is_error:
-                print pipe.error_msg
+    Returns:
+        A function returning the current time in seconds as a float.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
 
-    Once the pipe has finished, it cannot be reused. Instead, a new PipeData instance must be
-    created.
+    try:
+        import ctypes
+        import ctypes.util
 
-    Attributes:
-        is_stop     : boolean indicating if the pipe has finished reading from the source.
-        in_fd       : file descriptor representing the input to the pipe. Pass this to the
-                      source of the data to be read
-        dest_file   : the destination file object. This is the file where the data is
-                      written out to
-        is_error    : error status. True if an unrecoverable error has occurred. The caller
-                      should monitor this value regularly.
-        error_msg   : contains the error message. If no error had occurred, this is set to None.
+        if sys.platform == 'win32':
+            tick_count = ctypes.windll.kernel32.GetTickCount64
+            tick_count.restype = ctypes.c_ulonglong
+            return lambda: tick_count() / 1000.0
+
+        class _Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        # clock_gettime lives in librt for older versions of glibc.
+        for lib_name in (None, ctypes.util.find_library('rt')):
+            clock_gettime = getattr(ctypes.CDLL(lib_name, use_errno=True), 'clock_gettime', None)
+            if clock_gettime is not None:
+                break
+        else:
+            return time.time
 
-        _out_file   : an internal file object representing the output of pipe.
-        _finish_read : boolean to indicate when the pipe has finished reading from the source.
-        _buffer     : a buffer used to temporarily store the chunks of data read from the source.
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        clock_monotonic = 1
+
+        def monotonic():
+            # ctypes releases the GIL during the call, hence every call needs a timespec of its
+            # own; a shared one could be overwritten by another thread between the reads.
+            ts = _Timespec()
+            if clock_gettime(clock_monotonic, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (ImportError, AttributeError, OSError):
+        return time.time
+
+_monotonic = _get_monotonic()
+
+
+def _pipe():
+    """ Create a pipe whose file descriptors are not inherited by child processes.
+
+    Popen duplicates the descriptors it hands to the child, and the duplicate does not carry
+    the close-on-exec flag.
+
+    Returns:
+        A tuple of (read_fd, write_fd).
     """
-    # Number of bytes to read in at a time.
-    CHUNK_SIZE = 1024
+    r, w = os.pipe()
+    _set_cloexec(r)
+    _set_cloexec(w)
+    return r, w
 
-    def __init__(self, dest_file):
-        """ Constructor
 
-        Args:
-            dest_file: file object where the data will be written into.
-        """
-        r, w = os.pipe()
-        # set both is_stop and finish_read to True during init to avoid hanging if _PipeData
-        # fails to initialise. Set both booleans to False upon __enter__
-        self.is_stop = True
-        self._finish_read = True
-        self.in_fd = w
-        self.is_error = False
-        self.error_msg = None
-        self._dest_file = dest_file
-        self._out_file = os.fdopen(r, 'rb')
-        self._buffer = bytearray(_PipeData.CHUNK_SIZE)
+def _set_cloexec(fd):
+    """ Stop fd from being inherited by child processes. Not needed under Windows.
+    """
+    if fcntl is not None:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _check_writable(f):
+    """ Raise RunCmdInvalidInputError if the file object cannot be written to.
+
+    The file object is not guaranteed to be a file (e.g. StringIO) hence its mode cannot be
+    checked directly.
+    """
+    try:
+        f.write('')
+    except (IOError, ValueError):
+        raise RunCmdInvalidInputError('Error: file object passed in is not writable / closed.')
+
+
+def _get_fileno(f):
+    """ Returns the OS file descriptor behind a file object, or None if it has none.
+    """
+    try:
+        return f.fileno()
+    except (AttributeError, IOError, ValueError):
+        # io.UnsupportedOperation derives from both IOError and ValueError.
+        return None
+
 
-        # we expect a valid dest file to be passed in. The dest_file is not guaranteed to be a
-        # file (e.g. StringIO) hence we cannot check its mode directly.
+def _get_fd_offset(fd):
+    """ Returns the current offset of file descriptor fd, or None if it is not seekable.
+    """
+    try:
+        return os.lseek(fd, 0, os.SEEK_CUR)
+    except OSError:
+        return None
+
+
+def _sync_file_position(f, fd):
+    """ Move the position of file object f to the current offset of its file descriptor.
+
+    Required after a child process wrote to fd directly, otherwise f may keep writing at the
+    position it had before. Non-seekable files are left alone.
+
+    Returns:
+        The offset of fd, or None if it is not seekable.
+    """
+    offset = _get_fd_offset(fd)
+    if offset is not None:
         try:
-            dest_file.write('')
-        except (IOError, ValueError):
-            raise RunCmdInvalidInputError('Error: file object passed in is not writable '
-                                          '/ closed.')
+            f.seek(offset)
+        except (IOError, OSError, ValueError):
+            pass
+    return offset
 
-        super(_PipeData, self).__init__()
 
-    def __enter__(self):
-        self._finish_read = False
-        self.is_stop = False
-        self.start()
-        return self
+def _get_pipe_capacity(fd):
+    """ Returns the number of bytes the pipe can hold before a writer blocks.
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._stop()
+    Args:
+        fd: either end of the pipe.
+    """
+    # F_GETPIPE_SZ is only available under Linux, and not exported by Python 2's fcntl module.
+    f_getpipe_sz = 1032
+    if fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            return fcntl.fcntl(fd, f_getpipe_sz)
+        except IOError:
+            pass
+    return 65536
 
-    def run(self):
-        """ Continuously read from the source and write to the destination file object until
-        user calls stop().
 
-        This runs in a background thread.
+def _set_nonblocking(fd):
+    """ Put the file descriptor into non-blocking mode.
+
+    Args:
+        fd: file descriptor to modify.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _PosixSpawn(object):
+    """ Starts processes in a new session with posix_spawnp(), loaded from glibc via ctypes.
+
+    Unlike fork(), posix_spawnp() does not copy the page tables of the caller, hence its cost
+    does not grow with the memory used by the caller, and it runs no Python code in the child,
+    which makes it safe to use from a multi-threaded caller.
+    """
+    # from glibc's spawn.h
+    POSIX_SPAWN_SETSID = 0x80
+
+    # Size of the buffers holding posix_spawnattr_t and posix_spawn_file_actions_t, which are
+    # opaque. Both are well under this size in glibc.
+    STRUCT_SIZE = 1024
+
+    def __init__(self):
+        """ Constructor
+
+        Exceptions:
+            ImportError, AttributeError, OSError : posix_spawnp() or POSIX_SPAWN_SETSID is not
+                                                   available.
         """
-        while not self.is_stop and not self.is_error:
-            self._read()
-            time.sleep(0.2)
+        import ctypes
 
-        # read all remaining buffer input from pipe.
-        if not self.is_error:
-            self._read()
-        self._finish_read = True
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'posix_spawnp() is only used under Linux')
 
-    def _read(self):
-        """ Read all content buffered in the pipe one chunk at a time and write to the
-        destination file object.
+        self._ctypes = ctypes
+        self._libc = libc = ctypes.CDLL(None, use_errno=True)
+        self._spawnp = libc.posix_spawnp
+        self._spawnp.argtypes = [ctypes.POINTER(ctypes.c_int), ctypes.c_char_p, ctypes.c_void_p,
+                                 ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        self._attr_init = libc.posix_spawnattr_init
+        self._attr_destroy = libc.posix_spawnattr_destroy
+        self._attr_setflags = libc.posix_spawnattr_setflags
+        self._attr_setflags.argtypes = [ctypes.c_void_p, ctypes.c_short]
+        self._actions_init = libc.posix_spawn_file_actions_init
+        self._actions_destroy = libc.posix_spawn_file_actions_destroy
+        self._adddup2 = libc.posix_spawn_file_actions_adddup2
+        self._addclose = libc.posix_spawn_file_actions_addclose
+        # glibc 2.29 and later.
+        self._addchdir = getattr(libc, 'posix_spawn_file_actions_addchdir_np', None)
+        if self._addchdir is not None:
+            self._addchdir.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+
+        # older versions of glibc reject POSIX_SPAWN_SETSID.
+        attr = self._make_attr()
+        self._attr_destroy(attr)
+
+    def is_supported(self, cwd):
+        """ Returns True if a command can be started in cwd.
         """
+        return cwd is None or self._addchdir is not None
+
+    def spawn(self, executable, args, env, cwd, dups, closes):
+        """ Start a process in a new session.
+
+        Args:
+            executable: Program to run, searched for in PATH if it has no slash.
+            args      : List of arguments, including the program name.
+            env       : Dictionary of the environment, or None to inherit the caller's.
+            cwd       : Directory to run the program in, or None.
+            dups      : List of tuples of (fd, target_fd) to dup2() in the child, in order.
+            closes    : List of file descriptors to close in the child, after the dup2().
+        Returns:
+            The pid of the process.
+        Exceptions:
+            OSError : The process could not be started, e.g. the program was not found.
+        """
+        ctypes = self._ctypes
+        argv = self._make_array(args)
+        if env is None:
+            envp = ctypes.c_void_p.in_dll(self._libc, 'environ').value
+        else:
+            envp = self._make_array(['%s=%s' % item for item in env.items()])
+
+        attr = self._make_attr()
+        actions = ctypes.create_string_buffer(_PosixSpawn.STRUCT_SIZE)
+        self._check(self._actions_init(actions))
         try:
-            # this blocks until out_file writes at least CHUNK_SIZE worth of data.
-            read_size = self._out_file.readinto(self._buffer)
-            while read_size:
-                self._dest_file.write(self._buffer[:read_size])
-                read_size = self._out_file.readinto(self._buffer)
-            self._dest_file.flush()
-        except Exception as e:
-            self.is_error = True
-            self.error_msg = "{} raised exception {}".format(self.__class__.__name__, str(e))
+            for fd, target_fd in dups:
+                self._check(self._adddup2(actions, fd, target_fd))
+            for fd in closes:
+                self._check(self._addclose(actions, fd))
+            if cwd is not None:
+                self._check(self._addchdir(actions, self._encode(cwd)))
 
-    def _stop(self):
-        """ Signal to pipe to stop reading from in_fd and write everything out.
+            pid = ctypes.c_int()
+            self._check(self._spawnp(ctypes.byref(pid), self._encode(executable), actions, attr,
+                                     argv, envp))
+            return pid.value
+        finally:
+            self._actions_destroy(actions)
+            self._attr_destroy(attr)
 
-        Once this is called, this object cannot be run again.
+    def _make_attr(self):
+        """ Returns an initialised posix_spawnattr_t which starts a new session.
         """
-        if self.is_stop:
+        attr = self._ctypes.create_string_buffer(_PosixSpawn.STRUCT_SIZE)
+        self._check(self._attr_init(attr))
+        err = self._attr_setflags(attr, _PosixSpawn.POSIX_SPAWN_SETSID)
+        if err != 0:
+            self._attr_destroy(attr)
+            self._check(err)
+        return attr
+
+    def _make_array(self, strings):
+        """ Returns a NULL terminated array of C strings.
+        """
+        strings = [self._encode(string) for string in strings]
+        return (self._ctypes.c_char_p * (len(strings) + 1))(*(strings + [None]))
+
+    @staticmethod
+    def _encode(string):
+        if isinstance(string, unicode):
+            return string.encode(sys.getfilesystemencoding() or 'utf-8')
+        return str(string)
+
+    @staticmethod
+    def _check(err):
+        if err != 0:
+            raise OSError(err, os.strerror(err))
+
+
+def _get_posix_spawn():
+    """ Returns a _PosixSpawn, or None if posix_spawnp() cannot start a new session here.
+    """
+    try:
+        return _PosixSpawn()
+    except (ImportError, AttributeError, OSError):
+        return None
+
+_posix_spawn = _get_posix_spawn()
+
+
+class _SpawnPopen(subprocess.Popen):
+    """ Popen which starts the command in a new session with posix_spawnp(), instead of
+    fork() and a preexec_fn calling os.setsid(). See _PosixSpawn.
+
+    Falls back to the latter for the cases posix_spawnp() cannot reproduce.
+    """
+    def _execute_child(self, args, executable, preexec_fn, close_fds, cwd, env,
+                       universal_newlines, startupinfo, creationflags, shell, to_close,
+                       p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite):
+        if isinstance(args, basestring):
+            args = [args]
+        else:
+            args = list(args)
+        if shell:
+            args = ['/bin/sh', '-c'] + args
+            if executable:
+                args[0] = executable
+        if executable is None:
+            executable = args[0]
+
+        # cases where the fds overlap the standard ones, so dup2() order matters, and where
+        # posix_spawnp() would search the caller's PATH rather than env's.
+        is_unsupported = (preexec_fn is not None or close_fds or
+                          not _posix_spawn.is_supported(cwd) or c2pwrite == 0 or
+                          (errwrite in (0, 1) and errwrite != c2pwrite) or
+                          (env is not None and '/' not in executable))
+        if is_unsupported:
+            super(_SpawnPopen, self)._execute_child(
+                args, executable, preexec_fn or os.setsid, close_fds, cwd, env,
+                universal_newlines, startupinfo, creationflags, False, to_close,
+                p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite)
             return
 
-        # Close the write end of pipe. Wait until everything has been read
-        # from the pipe before closing the read end of the pipe as well.
-        self.is_stop = True
-        os.close(self.in_fd)
-        while not self._finish_read:
-            time.sleep(0.1)
+        dups = [(fd, target_fd) for fd, target_fd in ((p2cread, 0), (c2pwrite, 1), (errwrite, 2))
+                if fd is not None]
+        closes = set(fd for fd in (p2cwrite, c2pread, errread) if fd is not None)
+        closes.update(fd for fd in (p2cread, c2pwrite, errwrite) if fd is not None and fd > 2)
+        try:
+            self.pid = _posix_spawn.spawn(executable, args, env, cwd, dups, sorted(closes))
+            self._child_created = True
+        finally:
+            # close the child's ends of the pipes created by Popen, as Popen does.
+            for fd, other_fd in ((p2cread, p2cwrite), (c2pwrite, c2pread), (errwrite, errread)):
+                if fd is not None and other_fd is not None:
+                    os.close(fd)
+                    to_close.discard(fd)
 
-        self._out_file.close()
-        self.join()
 
-    def __del__(self):
-        """ Stop the monitoring process if object gets deleted.
-        """
-        self._stop()
+def _spawn(cmd, shell, cwd, stdout, stderr=None, stdin=None, server=None, env=None):
+    """ Start the command in its own process group.
 
+    Args:
+        cmd   : Command to run.
+        shell : Boolean to indicate if the shell should be invoked or not.
+        cwd   : Directory to run command in.
+        stdout: file descriptor the command writes its output to.
+        stderr: file descriptor the command writes its errors to. None merges them into
+                stdout.
+        stdin : file descriptor the command reads its input from. None inherits the stdin of
+                the caller.
+        server: RunCmdSpawnServer to start the command, or None. The command is started
+                directly if the server is not running.
+        env   : dictionary of the environment of the command. None inherits the environment
+                of the caller.
+    Returns:
+        The Popen object of the command, or a _SpawnedProcess if started by the server.
+    """
+    if server is not None:
+        p = server.spawn(cmd, shell, cwd, stdout, stderr, stdin, env)
+        if p is not None:
+            return p
 
-class RunCmd(object):
-    """ Runs a command in a subprocess and wait for it to return or timeout.
+    if stderr is None:
+        stderr = subprocess.STDOUT
 
-    This is a substitute for a common subprocess usage pattern:
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        ret, out = p.communicate()
+    if sys.platform == 'win32':
+        return subprocess.Popen(cmd,
+                                shell=shell,
+                                cwd=cwd,
+                                env=env,
+                                stdin=stdin,
+                                stdout=stdout,
+                                stderr=stderr)
 
-    With additional support for a timeout for the command. This is a blocking call,
-    which will wait for either the command to complete or a timeout to occur.
+    # in unix-like system group all predecessors of a process under the same id,
+    # making it easier to them all at once. Windows already does this.
+    if _posix_spawn is not None:
+        return _SpawnPopen(cmd,
+                           shell=shell,
+                           cwd=cwd,
+                           env=env,
+                           stdin=stdin,
+                           stdout=stdout,
+                           stderr=stderr)
 
-    Attributes:
-        returncode  : The return code as returned from the process. There are also special
-                      returncode values set if RunCmd encounters issues running the command.
-                      See Error ReturnCode section for more details.
-        cmd         : The command used.
+    return subprocess.Popen(cmd,
+                            shell=shell,
+                            cwd=cwd,
+                            env=env,
+                            stdin=stdin,
+                            stdout=stdout,
+                            stderr=stderr,
+                            preexec_fn=os.setsid)
 
-    Error ReturnCode:
-        INVALID_INPUT_ERR: Invalid parameters were used.
-        INTERRUPT_ERR    : Command was interrupted, e.g. Keyboard interrupt signal sent
-        TIMEOUT_ERR      : Runtime of command has exceed set timeout and was forced to
-                           terminate.
+
+def _send_message(fd, message):
+    """ Write a pickled message to a blocking socket, prefixed by its length.
     """
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    view = memoryview(struct.pack('!I', len(data)) + data)
+    while view:
+        view = view[os.write(fd, view):]
 
-    WAIT_INTERVAL = 0.5
-    INVALID_INPUT_ERR = -4
-    INTERRUPT_ERR = -3
-    TIMEOUT_ERR = -2
 
-    def __init__(self):
+def _recv_message(fd):
+    """ Read a message written by _send_message().
+
+    Returns:
+        The message, or None if the socket was closed.
+    """
+    def read(size):
+        chunks = []
+        while size:
+            try:
+                chunk = os.read(fd, size)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    header = read(4)
+    if header is None:
+        return None
+    data = read(struct.unpack('!I', header)[0])
+    return None if data is None else pickle.loads(data)
+
+
+# resource usage reported by the spawn server, compatible with resource.struct_rusage.
+_Rusage = collections.namedtuple('_Rusage', ['ru_utime', 'ru_stime', 'ru_maxrss'])
+
+
+class _SpawnedProcess(object):
+    """ Stands in for the Popen object of a command started by RunCmdSpawnServer.
+
+    The command is a child of the server, hence only the server can reap it. It reports the
+    exit status back, and this object is updated by the server's reader thread.
+
+    Attributes:
+        pid       : process id of the command, also the id of its process group.
+        returncode: return code of the command once it has exited, otherwise None.
+        rusage    : resource usage of the command once it has exited, or None.
+    """
+    def __init__(self, pid):
         """ Constructor
         """
-        self.return_code = -1
-        self.cmd = ''
+        self.pid = pid
+        self.returncode = None
+        self.rusage = None
+        self._exited = threading.Event()
 
-    def run(self, cmd, timeout=0, shell=False, cwd=None):
-        """ Runs the command and return the return code and output.
+    def poll(self):
+        return self.returncode
 
-        This is similar to Popen.communicate().Note that it is assumed the output of the command
-        will not exceed the available memory. For larger outputs, use cmd_fd()
+    def wait(self):
+        self._exited.wait()
+        return self.returncode
 
-        Args:
-            cmd     : Command to run.
-            timeout : Seconds to wait before terminating command. Timeout must be an positive
-                      integer. If timeout <= 0, RunCmd will wait indefinitely. Defaults to 0.
-            shell   : Boolean to indicate if the shell should be invoked or not.
-                      Defaults to False.
-            cwd:    : Directory to run command in. If none is given the command will be run in
-                      the current directory. Default is None.
-        Returns:
-            A tuple of (returncode, out) where returncode is the returncode from the subprocess
-            and out is a buffer containing the output.
+    def reap(self, block=True):
+        """ See _reap().
+        """
+        if block:
+            self._exited.wait()
+        return self.returncode is not None, self.rusage
+
+    def _set_exited(self, returncode, rusage):
+        self.rusage = rusage
+        self.returncode = returncode
+        self._exited.set()
+
+
+class RunCmdSpawnServer(object):
+    """ A small helper process which starts commands on behalf of RunCmd and RunCmdPool.
+
+    Starting a command from a large process costs time in proportion to the memory of the
+    process, even with posix_spawnp(). The server is a fresh Python interpreter which only
+    imports this module, hence stays small. The file descriptors of the command are passed
+    to the server over a Unix socket, so capturing the output and the timeout work as usual,
+    and the server reports back when the command exits.
+
+    For example:
+        with RunCmdSpawnServer() as server:
+            cmd = RunCmd(spawn_server=server)
+            ret, out = cmd.run('make', timeout=600)
+
+    If the server dies, commands are started directly instead. Commands it was running are
+    killed, as their exit status can no longer be collected. Only supported under POSIX.
+
+    Attributes:
+        pid : process id of the server.
+    """
+    # started with "python -c"; the directory of this module is filled in.
+    SERVER_CMD = 'import sys; sys.path.insert(0, %r); import runcmd; runcmd._run_spawn_server()'
+
+    def __init__(self):
+        """ Constructor. Starts the server.
 
         Exceptions:
-            RunCmdInvalidInputError : Command had invalid parameters.
-            RunCmdInterruptError    : Command was interrupted, e.g. a Keyboard interrupt signal.
+            RunCmdInvalidInputError : The platform is not supported.
         """
-        buff = None
-        with contextlib.closing(StringIO.StringIO()) as f:
-            self.run_fd(cmd, f, timeout, shell, cwd)
-            buff = f.getvalue()
+        if sys.platform == 'win32':
+            raise RunCmdInvalidInputError('Error: RunCmdSpawnServer is not supported under '
+                                          'Windows.')
+        try:
+            import _multiprocessing
+            self._sendfd = _multiprocessing.sendfd
+        except (ImportError, AttributeError):
+            raise RunCmdInvalidInputError('Error: passing file descriptors is not supported.')
 
-        return self.return_code, buff
+        # _lock guards the state shared with the reader thread, _send_lock the socket. They are
+        # separate so the reader never waits for a send, which may wait for the reader.
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._next_id = 0
+        self._requests = {}
+        self._processes = {}
+        self._is_alive = True
 
-    def run_fd(self, cmd, out_file, timeout=0, shell=False, cwd=None):
-        """ Runs the command and writes the output into the user specified file object.
+        sock, server_sock = socket.socketpair()
+        try:
+            _set_cloexec(sock.fileno())
+            server_cmd = RunCmdSpawnServer.SERVER_CMD % os.path.dirname(os.path.abspath(__file__))
+            self._p = _spawn([sys.executable, '-c', server_cmd], False, None,
+                             sys.__stdout__.fileno(), sys.__stderr__.fileno(),
+                             server_sock.fileno())
+        except Exception:
+            sock.close()
+            raise
+        finally:
+            server_sock.close()
 
-        Similar to RunCmd.run() but allows user to specify a file object where the output will be
-        written into. The returncode can be retrieved from the member value, returncode.
+        self.pid = self._p.pid
+        self._sock = sock
+        self._reader = threading.Thread(target=self._read_messages)
+        self._reader.daemon = True
+        self._reader.start()
 
-        Args:
-            cmd     : Command to run.
-            out_file: File object which the command will write its output to.
-            timeout : Seconds to wait before terminating command. Timeout must be an positive
-                      integer. If timeout <= 0, RunCmd will wait indefinitely. Defaults to 0.
-            shell   : Boolean to indicate if the shell should be invoked or not.
-                      Defaults to False.
-            cwd:    : Directory to run command in. If none is given the command will be run in
-                      the current directory. Default is None.
-        Exceptions:
-            RunCmdInvalidInputError : Command had invalid parameters.
-            RunCmdInterruptError    : Command was interrupted, e.g. a Keyboard interrupt signal.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def is_alive(self):
+        """ Returns True if the server is running.
         """
-        self.cmd = cmd
+        return self._is_alive
 
-        # if no command was sent in, consider it successful and return.
-        if cmd is None or len(cmd) == 0:
-            self.return_code = 0
-            return
+    def spawn(self, cmd, shell, cwd, stdout, stderr=None, stdin=None, env=None):
+        """ Start a command in the server. See _spawn() for the arguments.
 
-        if not out_file:
-            raise RunCmdInvalidInputError("Error: out_file is None; expected file object.")
+        Returns:
+            The _SpawnedProcess of the command, or None if the server is not running.
+        Exceptions:
+            OSError : The command could not be started, e.g. it was not found.
+        """
+        fds = [stdin if stdin is not None else 0, stdout]
+        if stderr is not None:
+            fds.append(stderr)
 
-        timeout = sys.maxint if int(timeout) <= 0 else int(timeout)
-        with _PipeData(out_file) as pipe:
-            p = None
+        with self._lock:
+            if not self._is_alive:
+                return None
+            request_id = self._next_id
+            self._next_id += 1
+            request = self._requests[request_id] = [threading.Event(), None]
+
+        with self._send_lock:
             try:
-                if sys.platform == 'win32':
-                    p = subprocess.Popen(cmd,
-                                         shell=shell,
-                                         cwd=cwd,
-                                         stdout=pipe.in_fd,
-                                         stderr=subprocess.STDOUT)
-                else:
-                    # in unix-like system group all predecessors of a process under the same id,
-                    # making it easier to them all at once. Windows already does this.
-                    p = subprocess.Popen(cmd,
-                                         shell=shell,
-                                         cwd=cwd,
-                                         stdout=pipe.in_fd,
-                                         stderr=subprocess.STDOUT,
-                                         preexec_fn=os.setsid)
-
-                # Continuously poll the process "p" until either the process has finished or
-                # process timeout. If the process has exceeded the timeout limit, kill it.
-                # Note the "pipe" is continuously reading the output in a the background thread.
-                curr_time = 0
-                while p.poll() is None and curr_time < timeout and not pipe.is_error:
-                    curr_time += RunCmd.WAIT_INTERVAL
-                    time.sleep(RunCmd.WAIT_INTERVAL)
-
-                if pipe.is_error:
-                    # pipe error
-                    self._kill(p)
-                    raise RunCmdInternalError(pipe.error_msg)
-                elif curr_time >= timeout:
-                    # timeout
-                    self.return_code = RunCmd.TIMEOUT_ERR
-                    self._kill(p)
-                else:
-                    #normal case
-                    self.return_code = p.returncode
+                if self._is_alive:
+                    _send_message(self._sock.fileno(),
+                                  (request_id, cmd, shell, cwd, env, len(fds)))
+                    for fd in fds:
+                        self._sendfd(self._sock.fileno(), fd)
+            except (OSError, IOError):
+                # the reader notices the server died, and fails the request.
+                pass
 
-            except (WindowsError, OSError):
-                self.return_code = RunCmd.INVALID_INPUT_ERR
-                raise RunCmdInvalidInputError(traceback.format_exc())
+        request[0].wait()
+        response = request[1]
+        if response is None:
+            return None
+        if isinstance(response, _SpawnedProcess):
+            return response
+        raise OSError(*response)
 
-            except KeyboardInterrupt:
-                self.return_code = RunCmd.INTERRUPT_ERR
-                self._kill(p)
-                raise RunCmdInterruptError(cmd, traceback.format_exc())
+    def close(self):
+        """ Stop the server. Commands it is still running are killed.
+        """
+        with self._send_lock:
+            if not self._is_alive:
+                return
+            self._sock.shutdown(socket.SHUT_WR)
+        self._reader.join()
 
-    @staticmethod
-    def _kill(p):
-        """ Kill the process immediately.
+    def _read_messages(self):
+        """ Dispatch the messages from the server until it exits. Runs in a background thread.
+        """
+        try:
+            while True:
+                message = _recv_message(self._sock.fileno())
+                if message is None:
+                    break
 
-        Args:
-            p: sub-process to be killed.
+                kind, key, value = message
+                with self._lock:
+                    if kind == 'exited':
+                        returncode, rusage = value
+                        p = self._processes.pop(key)
+                        p._set_exited(returncode, _Rusage(*rusage) if rusage else None)
+                        continue
+
+                    request = self._requests.pop(key)
+                    if kind == 'spawned':
+                        request[1] = self._processes[value] = _SpawnedProcess(value)
+                    else:
+                        request[1] = value
+                    request[0].set()
+        except (OSError, IOError):
+            pass
+        finally:
+            self._stop()
+
+    def _stop(self):
+        """ Mark the server as dead, fail the requests in flight and kill the commands whose
+        exit status can no longer be collected.
         """
-        if p.poll() is None:
-            # Popen.kill() does not kill processes in Windows, only attempts to terminate it,
-            # hence we need to kill process here.
-            if sys.platform == 'win32':
-                k = subprocess.Popen('TASKKILL /PID {} /T /F >NUL 2>&1'.format(p.pid),
-                                     shell=True)
-                k.communicate()
-            else:
-                pid = -p.pid
-                os.kill(pid, signal.SIGTERM)
-                os.waitpid(pid, 0)
+        with self._lock:
+            self._is_alive = False
+            for request in self._requests.values():
+                request[0].set()
+            self._requests.clear()
+            for p in self._processes.values():
+                try:
+                    os.killpg(p.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                p._set_exited(-signal.SIGKILL, None)
+            self._processes.clear()
+        with self._send_lock:
+            self._sock.close()
+        self._p.wait()
 
 
-def main():
-    """ Provides a command line interface to RunCmd.run(). The output is printed out to stdout.
+def _run_spawn_server():
+    """ The main loop of RunCmdSpawnServer's process. Requests arrive on stdin, a Unix socket,
+    and the server exits once it is closed.
+    """
+    import _multiprocessing
 
-    Returns 0 if command was run successfully, otherwise an error had occurred.
+    # keep the socket away from the commands, which would otherwise inherit it as stdin.
+    sock_fd = os.dup(0)
+    _set_cloexec(sock_fd)
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.close(null_fd)
+
+    # SIGINT is left alone, as an ignored signal stays ignored in the commands; the server runs
+    # in a session of its own, away from the terminal's Ctrl-C.
+    sigchld_r, sigchld_w = _pipe()
+    _set_nonblocking(sigchld_r)
+    _set_nonblocking(sigchld_w)
+    signal.set_wakeup_fd(sigchld_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGCHLD, False)
+
+    processes = {}
+    while True:
+        try:
+            readable = select.select([sock_fd, sigchld_r], [], [])[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if sigchld_r in readable:
+            try:
+                while os.read(sigchld_r, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+            for pid, p in processes.items():
+                is_exited, rusage = _reap(p, block=False)
+                if is_exited:
+                    del processes[pid]
+                    if rusage is not None:
+                        rusage = (rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+                    _send_message(sock_fd, ('exited', pid, (p.returncode, rusage)))
+
+        if sock_fd in readable:
+            request = _recv_message(sock_fd)
+            if request is None:
+                break
+
+            request_id, cmd, shell, cwd, env, fd_count = request
+            fds = [_multiprocessing.recvfd(sock_fd) for _ in range(fd_count)]
+            for fd in fds:
+                _set_cloexec(fd)
+            try:
+                p = _spawn(cmd, shell, cwd, fds[1], fds[2] if fd_count > 2 else None, fds[0],
+                           env=env)
+                processes[p.pid] = p
+                _send_message(sock_fd, ('spawned', request_id, p.pid))
+            except OSError as e:
+                _send_message(sock_fd, ('error', request_id, (e.errno, e.strerror)))
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+
+def _is_program(name, cwd=None):
+    """ Returns True if name is an executable file, looked up in PATH unless it has a slash, as
+    the shell and exec() do.
     """
-    import optparse
+    if '/' in name:
+        paths = [os.path.join(cwd or '', name)]
+    else:
+        paths = [os.path.join(path or '.', name)
+                 for path in os.environ.get('PATH', os.defpath).split(os.pathsep)]
+    return any(os.path.isfile(path) and os.access(path, os.X_OK) for path in paths)
 
-    parser = optparse.OptionParser()
-    parser.add_option('-c', '--cmd',
-                      action='store',
-                      type='string',
-                      dest='cmd',
-                      help='Command to run. Must be enclosed in double quotes, '
-                           'e.g. -c"echo Hello"')
 
-    parser.add_option('-t', '--timeout',
-                      action='store',
-                      type='int',
-                      default=0,
-                      dest='timeout',
-                      help='Time in seconds to wait for the command to finish before forcibly '
-                           'terminating it. Defaults to 0 which makes it wait indefinitely.')
+class _WakeupEvent(object):
+    """ An event which can be waited on with a timeout.
+
+    threading.Event.wait(timeout) under Python 2 polls with sleeps of up to 50ms. Instead, under
+    POSIX the event is a pipe which becomes readable when set, and is waited on with select().
+    Under Windows it falls back to threading.Event.
+
+    Once set, the event stays set.
+    """
+    def __init__(self):
+        """ Constructor
+        """
+        self._flag = False
+        self._lock = threading.Lock()
+        self._event = None
+        self._r = self._w = None
+        if sys.platform == 'win32':
+            self._event = threading.Event()
+        else:
+            self._r, self._w = _pipe()
+            _set_nonblocking(self._r)
+
+    def set(self):
+        """ Set the event, waking up any waiting thread.
+        """
+        with self._lock:
+            if self._flag:
+                return
+
+            self._flag = True
+            if self._event is not None:
+                self._event.set()
+            elif self._w is not None:
+                os.write(self._w, 'x')
+
+    def is_set(self):
+        return self._flag
+
+    def clear(self):
+        """ Reset the event.
+
+        The pipe is drained before the flag is reset, under the same lock as set(), so that a
+        concurrent set() is never lost.
+        """
+        with self._lock:
+            if self._event is not None:
+                self._event.clear()
+            else:
+                try:
+                    while os.read(self._r, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            self._flag = False
+
+    def fileno(self):
+        """ Returns a file descriptor which is readable while the event is set. Only available
+        under POSIX.
+        """
+        return self._r
+
+    def wait(self, timeout=None):
+        """ Block until the event is set or the timeout expires.
+
+        Args:
+            timeout: Seconds to wait. None waits indefinitely.
+        Returns:
+            True if the event is set.
+        """
+        if self._flag:
+            return True
+
+        if self._event is not None:
+            self._event.wait(timeout)
+        else:
+            try:
+                select.select([self._r], [], [], timeout)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        return self._flag
+
+    def close(self):
+        """ Release the pipe used by the event.
+        """
+        if self._r is not None:
+            os.close(self._r)
+            os.close(self._w)
+            self._r = self._w = None
+
+
+def _reap(p, block=True):
+    """ Reap the process if it has exited, and collect its resource usage.
+
+    Sets p.returncode the same way Popen.wait() does.
+
+    Args:
+        p    : Popen object of the process.
+        block: If True, wait for the process to exit.
+    Returns:
+        A tuple of (is_exited, rusage), where rusage is the resource.struct_rusage of the
+        process, or None if it is not available.
+    """
+    if isinstance(p, _SpawnedProcess):
+        return p.reap(block)
+
+    if p.returncode is not None:
+        return True, None
+
+    if sys.platform == 'win32':
+        if block:
+            p.wait()
+        return p.poll() is not None, None
+
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0 if block else os.WNOHANG)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.ECHILD:
+                raise
+            # the process was reaped elsewhere, e.g. SIGCHLD is ignored. Same as Popen.
+            p.returncode = 0
+            return True, None
+
+    if pid == 0:
+        return False, None
+
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return True, rusage
+
+
+def _signal_group(pgid, sig):
+    """ Send a signal to a process group, ignoring a group which no longer exists.
+    """
+    try:
+        os.killpg(pgid, sig)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def _is_live_member(pid, pgid):
+    """ Returns True if the process is in the process group and is not a zombie. Linux only.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # "pid (comm) state ppid pgrp ...", where comm may contain anything.
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, IndexError):
+        return False
+    return int(fields[2]) == pgid and fields[0] != 'Z'
+
+
+def _is_group_alive(pgid, cache=None):
+    """ Returns True if any process is left in the process group.
+
+    Zombies are not counted under Linux, where /proc is read to tell them apart: orphaned
+    members of the group remain zombies until init reaps them, which may take a while. /proc
+    is only scanned when signal 0 finds the group, and not while the member found by the last
+    scan is still alive.
+
+    Args:
+        pgid : id of the process group.
+        cache: optional dictionary kept across calls for the same group, in which the live
+               member found by the last scan is remembered.
+    """
+    try:
+        os.killpg(pgid, 0)
+    except OSError as e:
+        # EPERM means a process exists, but belongs to someone else.
+        return e.errno != errno.ESRCH
+
+    if not sys.platform.startswith('linux'):
+        return True
+    if cache is not None and cache.get('pid') is not None and \
+            _is_live_member(cache['pid'], pgid):
+        return True
+    try:
+        pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    except OSError:
+        return True
+    for pid in pids:
+        if _is_live_member(pid, pgid):
+            if cache is not None:
+                cache['pid'] = pid
+            return True
+    return False
+
+
+def _wait_group_exit(pgid, is_exited, deadline):
+    """ Wait until the leader of a process group has been reaped and the rest of the group
+    has exited, or the deadline passes.
+
+    Args:
+        pgid     : id of the process group, which is also the pid of its leader.
+        is_exited: function returning True once the leader has been reaped.
+        deadline : monotonic time at which to give up.
+    Returns:
+        True if the group exited, False if the deadline passed first.
+    """
+    delay = 0.001
+    cache = {}
+    while not (is_exited() and not _is_group_alive(pgid, cache)):
+        remaining = deadline - _monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+    return True
+
+
+class _ExitWatcher(threading.Thread):
+    """ Waits for a process to exit in a background thread and sets an event once it does.
+
+    This lets the caller block until the process exits, or a deadline passes, without
+    polling. The watcher is the only thread which may reap the process; use is_exited instead of
+    Popen.poll() while it runs.
+
+    Attributes:
+        is_exited : boolean indicating if the process has exited and been reaped.
+        rusage    : resource usage of the process once reaped, or None if not available.
+        exit_time : monotonic time at which the process was reaped, or None.
+    """
+    def __init__(self, p, event):
+        """ Constructor
+
+        Args:
+            p     : Popen object to wait on.
+            event : _WakeupEvent to set once the process exits.
+        """
+        self.is_exited = False
+        self.rusage = None
+        self.exit_time = None
+        self._p = p
+        self._event = event
+        super(_ExitWatcher, self).__init__()
+        self.daemon = True
+
+    def run(self):
+        try:
+            self.rusage = _reap(self._p)[1]
+        finally:
+            self.exit_time = _monotonic()
+            self.is_exited = True
+            self._event.set()
+
+
+class _Poller(object):
+    """ Waits for file descriptors to become readable or writable using the best mechanism the
+    platform provides: epoll, then poll, then select.
+
+    A hang-up or error condition on a file descriptor is reported as ready, as the next read or
+    write will return EOF or raise the error.
+
+    Note select() does not support pipes under Windows, hence _Poller is only used on POSIX
+    platforms.
+    """
+    READ = 1
+    WRITE = 2
+
+    def __init__(self):
+        """ Constructor
+        """
+        self._fds = {}
+        if hasattr(select, 'epoll'):
+            self._kind = 'epoll'
+            self._impl = select.epoll()
+            self._masks = {_Poller.READ: select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR,
+                           _Poller.WRITE: select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR}
+        elif hasattr(select, 'poll'):
+            self._kind = 'poll'
+            self._impl = select.poll()
+            self._masks = {_Poller.READ: select.POLLIN | select.POLLHUP | select.POLLERR,
+                           _Poller.WRITE: select.POLLOUT | select.POLLHUP | select.POLLERR}
+        else:
+            self._kind = 'select'
+            self._impl = None
+
+    def register(self, fd, event=READ):
+        """ Start monitoring fd.
+
+        Args:
+            fd   : file descriptor to monitor.
+            event: _Poller.READ to wait for fd to be readable, or _Poller.WRITE to wait for it
+                   to be writable. Defaults to _Poller.READ.
+        """
+        if self._impl is not None:
+            self._impl.register(fd, self._masks[event])
+        self._fds[fd] = event
+
+    def unregister(self, fd):
+        """ Stop monitoring fd.
+        """
+        if fd in self._fds:
+            del self._fds[fd]
+            if self._impl is not None:
+                self._impl.unregister(fd)
+
+    def poll(self, timeout=None):
+        """ Block until at least one registered fd is ready or the timeout expires.
+
+        Args:
+            timeout: Seconds to wait. None waits indefinitely.
+        Returns:
+            A list of ready file descriptors. The list is empty if the timeout expired or the
+            wait was interrupted by a signal.
+        """
+        try:
+            if self._kind == 'epoll':
+                return [fd for fd, _ in self._impl.poll(-1 if timeout is None else timeout)]
+            elif self._kind == 'poll':
+                # poll() takes milliseconds, and a negative value to block.
+                ms = -1 if timeout is None else int(math.ceil(timeout * 1000))
+                return [fd for fd, _ in self._impl.poll(ms)]
+            else:
+                read_fds = [fd for fd, event in self._fds.items() if event == _Poller.READ]
+                write_fds = [fd for fd, event in self._fds.items() if event == _Poller.WRITE]
+                ready = select.select(read_fds, write_fds, [], timeout)
+                return ready[0] + ready[1]
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        """ Release the underlying OS resources, if any.
+        """
+        if hasattr(self._impl, 'close'):
+            self._impl.close()
+        self._fds.clear()
+
+
+class _PipeInput(object):
+    """ Feeds the input of a command through a pipe without blocking, one chunk at a time.
+
+    Only the chunk being written is held in memory, hence the input may be larger than the
+    available memory if it is read from a file or an iterator.
+
+    Attributes:
+        stdin_fd : file descriptor of the read end of the pipe. Pass this to the command as its
+                   stdin.
+        fd       : file descriptor of the write end of the pipe, or None once closed.
+    """
+    # Number of bytes read from an input file, or sliced from an input string, at a time.
+    CHUNK_SIZE = 65536
+
+    def __init__(self, data):
+        """ Constructor
+
+        Args:
+            data: the input, either a string, a file object opened for reading, or an iterable
+                  of strings.
+        Exceptions:
+            RunCmdInvalidInputError : data is none of the above.
+        """
+        size = _PipeInput.CHUNK_SIZE
+        if isinstance(data, (str, bytearray, memoryview)):
+            view = memoryview(data)
+            self._chunks = (view[i:i + size] for i in xrange(0, len(view), size))
+        elif hasattr(data, 'read'):
+            self._chunks = iter(lambda: data.read(size), '')
+        elif not isinstance(data, unicode) and hasattr(data, '__iter__'):
+            self._chunks = iter(data)
+        else:
+            raise RunCmdInvalidInputError('Error: input must be a string, a file object or an '
+                                          'iterable of strings.')
+
+        self._pending = None
+        self.stdin_fd, self.fd = _pipe()
+        _set_nonblocking(self.fd)
+
+    def write(self):
+        """ Write as much of the input as the pipe accepts.
+
+        Returns:
+            True if there is input left to write, False once all the input was written or the
+            command stopped reading it. The pipe is closed in the latter case.
+        """
+        while True:
+            if not self._pending:
+                try:
+                    self._pending = memoryview(next(self._chunks))
+                except StopIteration:
+                    self.close()
+                    return False
+                continue
+
+            try:
+                written = os.write(self.fd, self._pending)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return True
+                elif e.errno == errno.EPIPE:
+                    # the command exited or closed its stdin.
+                    self.close()
+                    return False
+                raise
+            self._pending = self._pending[written:]
+
+    def close(self):
+        """ Close the write end of the pipe, which signals EOF to the command.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self._pending = None
+
+
+def _get_sinks(dest):
+    """ Returns the list of sinks given as the destination of some output: either a file
+    object or a callable, or a list or tuple of them.
+    """
+    return list(dest) if isinstance(dest, (list, tuple)) else [dest]
+
+
+def _is_view_writable(sink):
+    """ Returns True if a file object can be handed a memoryview of the buffer to write. Binary
+    file objects copy whatever they are given. Text files only take strings, and other file-like
+    objects may keep a reference to the buffer, so they must be given a copy instead.
+    """
+    if isinstance(sink, (io.RawIOBase, io.BufferedIOBase)):
+        return True
+    return isinstance(sink, file) and 'b' in getattr(sink, 'mode', '')
+
+
+def _is_callable_sink(sink):
+    """ Returns True if a sink is a callable taking the data, rather than a file object.
+    """
+    return callable(sink) and not hasattr(sink, 'write')
+
+
+class _WriteQueue(threading.Thread):
+    """ Writes the chunks read by _PipeData from a thread of its own, so a slow destination does
+    not hold up the reading of the command's output.
+
+    The chunks are copied into a bounded set of reusable buffers, which are handed to the
+    writing thread in order. When every buffer is in use, the overflow policy decides what
+    happens to the next chunk:
+        RunCmd.OVERFLOW_BLOCK      : wait for a buffer to be written out.
+        RunCmd.OVERFLOW_DROP_OLDEST: drop the oldest chunk not yet written, and reuse its buffer.
+        RunCmd.OVERFLOW_SPILL      : append the chunk to a temporary file, from which it is
+                                     written out in turn.
+
+    Attributes:
+        depth         : number of chunks waiting to be written.
+        max_depth     : largest number of chunks which were waiting at once.
+        dropped_bytes : number of bytes dropped by OVERFLOW_DROP_OLDEST, or discarded by abort().
+        spilled_bytes : number of bytes moved to the temporary file by OVERFLOW_SPILL.
+        wait_time     : seconds spent waiting for a buffer by OVERFLOW_BLOCK.
+    """
+    OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+
+    def __init__(self, write, flush, size, chunk_size, overflow, is_flush, on_error):
+        """ Constructor. The thread is started with start().
+
+        Args:
+            write     : callable writing a memoryview of a chunk out.
+            flush     : callable flushing what was written.
+            size      : number of buffers.
+            chunk_size: size of each buffer, i.e. of the largest chunk.
+            overflow  : overflow policy, one of OVERFLOW_POLICIES.
+            is_flush  : if True, flush whenever every queued chunk has been written.
+            on_error  : callable invoked with the exception raised by write or flush. Nothing
+                        more is written afterwards.
+        Exceptions:
+            RunCmdInvalidInputError : There were fewer than 2 buffers, or the overflow policy
+                                      was unknown.
+        """
+        if size < 2:
+            raise RunCmdInvalidInputError('Error: write_queue must be at least 2.')
+        if overflow not in _WriteQueue.OVERFLOW_POLICIES:
+            raise RunCmdInvalidInputError('Error: unknown overflow policy {!r}; expected one of '
+                                          '{}.'.format(overflow,
+                                                       ', '.join(_WriteQueue.OVERFLOW_POLICIES)))
+        super(_WriteQueue, self).__init__()
+        self.daemon = True
+        self._write = write
+        self._flush = flush
+        self._size = size
+        self._chunk_size = chunk_size
+        self._overflow = overflow
+        self._is_flush = is_flush
+        self._on_error = on_error
+        self._cond = threading.Condition()
+        # tuples of (buffer, size) in order; a buffer of None means the chunk was spilled.
+        self._entries = collections.deque()
+        self._free = []
+        self._allocated = 0
+        self._is_closing = False
+        self._is_aborted = False
+        self._is_failed = False
+        self._spill_files = None
+        self.max_depth = 0
+        self.dropped_bytes = 0
+        self.spilled_bytes = 0
+        self.wait_time = 0.0
+
+    @property
+    def depth(self):
+        return len(self._entries)
+
+    def put(self, view):
+        """ Queue a chunk to be written. Called by the reading thread.
+
+        Args:
+            view: memoryview of the chunk, which may be reused once this returns.
+        """
+        size = len(view)
+        with self._cond:
+            buff = self._get_buffer(size)
+            if self._is_aborted:
+                self.dropped_bytes += size
+                return
+            if buff is None:
+                self._spill(view)
+            else:
+                memoryview(buff)[:size] = view
+            self._entries.append((buff, size))
+            self.max_depth = max(self.max_depth, len(self._entries))
+            self._cond.notify_all()
+
+    def _get_buffer(self, size):
+        """ Returns a free buffer for a chunk, or None if the chunk is to be spilled. Called with
+        the lock held.
+        """
+        if not self._free and self._allocated < self._size:
+            self._allocated += 1
+            self._free.append(bytearray(self._chunk_size))
+        if self._free:
+            return self._free.pop()
+
+        if self._overflow == 'spill':
+            return None
+        if self._overflow == 'drop_oldest':
+            for i, (buff, dropped) in enumerate(self._entries):
+                if buff is not None:
+                    del self._entries[i]
+                    self.dropped_bytes += dropped
+                    return buff
+
+        start = _monotonic()
+        while not self._free and not self._is_aborted:
+            self._cond.wait()
+        self.wait_time += _monotonic() - start
+        return self._free.pop() if self._free else None
+
+    def _spill(self, view):
+        """ Append a chunk to the temporary file. Called with the lock held.
+        """
+        if self._spill_files is None:
+            fd, path = tempfile.mkstemp(prefix='runcmd-')
+            try:
+                self._spill_files = (os.fdopen(fd, 'wb'), open(path, 'rb'))
+            finally:
+                os.unlink(path)
+        self._spill_files[0].write(view)
+        # make the chunk visible to the writing thread's own file object.
+        self._spill_files[0].flush()
+        self.spilled_bytes += len(view)
+
+    def run(self):
+        """ Write the queued chunks out in order, until close() is called and every chunk has
+        been written.
+        """
+        while True:
+            with self._cond:
+                while not self._entries and not self._is_closing:
+                    self._cond.wait()
+                if not self._entries:
+                    break
+                buff, size = self._entries.popleft()
+
+            if not self._is_failed:
+                try:
+                    if buff is not None:
+                        self._write(memoryview(buff)[:size])
+                    else:
+                        self._write(memoryview(self._spill_files[1].read(size)))
+                    if self._is_flush and not self._entries:
+                        self._flush()
+                except Exception as e:
+                    # keep taking chunks off the queue, so the reading thread never waits.
+                    self._is_failed = True
+                    self._on_error(e)
+
+            with self._cond:
+                if buff is not None:
+                    self._free.append(buff)
+                self._cond.notify_all()
+
+    def abort(self):
+        """ Discard the chunks not written yet, and every chunk put from now on, so neither the
+        reading thread nor the caller waits for a slow destination any longer. The chunk being
+        written, if any, is still written.
+        """
+        with self._cond:
+            self._is_aborted = True
+            for buff, size in self._entries:
+                self.dropped_bytes += size
+                if buff is not None:
+                    self._free.append(buff)
+            self._entries.clear()
+            self._cond.notify_all()
+
+    def close(self, is_wait=True):
+        """ Stop the thread once every queued chunk has been written.
+
+        Args:
+            is_wait: if True, wait for the chunks to be written, then flush.
+        """
+        with self._cond:
+            self._is_closing = True
+            self._cond.notify_all()
+        if not is_wait:
+            return
+
+        if self.is_alive():
+            self.join()
+        if self._spill_files is not None:
+            for f in self._spill_files:
+                f.close()
+            self._spill_files = None
+        if not self._is_failed:
+            try:
+                self._flush()
+            except Exception as e:
+                self._on_error(e)
+
+
+class _PipeSource(object):
+    """ One of the pipes read by _PipeData, and the sinks its data is written to.
+
+    Every chunk is written to each sink in turn. File objects which copy what they are given
+    share a memoryview of the read buffer; the other sinks share a single copy of the chunk.
+    A sink which fails is dropped and the others carry on; once every sink has failed, the
+    error is raised.
+
+    Attributes:
+        in_fd       : file descriptor of the write end of the pipe. Pass this to the source of
+                      the data to be read.
+        out_file    : an internal file object representing the read end of the pipe.
+        matcher     : _OutputMatcher searching the data, or None.
+        sink_errors : list of the messages of the sinks which failed and were dropped.
+        queue       : _WriteQueue writing to the sinks from a thread of its own, or None to
+                      write to them directly.
+        recorder    : callable called with a memoryview of every chunk before it is written or
+                      queued, or None. It must not raise.
+    """
+    def __init__(self, dest, patterns=None):
+        """ Constructor
+
+        Args:
+            dest     : file object where the data will be written into, a callable which is
+                       called with every chunk of data, or a list or tuple of them.
+            patterns : optional dictionary of patterns to look for in the data, and their
+                       actions. See RunCmd.run_fd().
+        """
+        self._sinks = []
+        for sink in _get_sinks(dest):
+            if _is_callable_sink(sink):
+                self._sinks.append((sink, False))
+                continue
+            _check_writable(sink)
+            self._sinks.append((sink, _is_view_writable(sink)))
+        if not self._sinks:
+            raise RunCmdInvalidInputError('Error: no file object given to write the output to.')
+        self.matcher = _OutputMatcher(patterns) if patterns else None
+        self.sink_errors = []
+        self.queue = None
+        self.recorder = None
+
+        r, w = _pipe()
+        if sys.platform != 'win32':
+            _set_nonblocking(r)
+        self.in_fd = w
+        self.out_file = io.FileIO(r, 'rb')
+
+    def write(self, view):
+        """ Write a chunk of data to every sink, or queue it to be written.
+
+        Args:
+            view: memoryview of the chunk.
+        """
+        if self.recorder is not None:
+            self.recorder(view)
+        if self.queue is not None:
+            self.queue.put(view)
+        else:
+            self._write(view)
+
+    def _write(self, view):
+        """ Write a chunk of data to every sink.
+        """
+        data = None
+        for sink, is_view_writable in list(self._sinks):
+            try:
+                if is_view_writable:
+                    sink.write(view)
+                    continue
+                if data is None:
+                    data = view.tobytes()
+                if _is_callable_sink(sink):
+                    sink(data)
+                else:
+                    sink.write(data)
+            except Exception as e:
+                self._drop(sink, e)
+
+    def flush(self):
+        """ Flush every sink which is a file object. Done by the queue, if there is one.
+        """
+        if self.queue is None:
+            self._flush()
+
+    def _flush(self):
+        for sink, _ in list(self._sinks):
+            if not _is_callable_sink(sink):
+                try:
+                    sink.flush()
+                except Exception as e:
+                    self._drop(sink, e)
+
+    def _drop(self, sink, e):
+        """ Stop writing to a sink which failed, and raise the error if it was the last one.
+        """
+        self._sinks = [entry for entry in self._sinks if entry[0] is not sink]
+        if not self._sinks:
+            raise e
+        self.sink_errors.append('{!r} raised exception {}'.format(sink, e))
+
+
+class _PipeData(threading.Thread):
+    """ A pipe which continuously reads from a source and writes to a destination file object
+    in the background.
+
+    Use the "with" statement to manage the context of the _PipeData instance,
+    e.g.:
+        is_keep_reading = True
+        with _PipeData(out_file) as pipe:
+            while is_keep_reading and not pipe.is_error:
+                # do something.
+
+            if pipe.is_error:
+                print pipe.error_msg
+
+    Once the pipe has finished, it cannot be reused. Instead, a new PipeData instance must be
+    created.
+
+    The background thread sleeps until the source has data available (or reaches EOF), then
+    drains everything currently buffered in the pipe. Under POSIX the wait is done by _Poller;
+    under Windows, where pipes cannot be polled, the thread blocks on read instead.
+
+    A second pipe can be read into a separate destination, e.g. to keep the stderr of a command
+    apart from its stdout. The thread can also feed input to the command through a third pipe,
+    while it reads the output. All pipes are served by the same thread. This is only supported
+    under POSIX.
+
+    Attributes:
+        is_stop     : boolean indicating if the pipe has been asked to stop reading from the
+                      source.
+        in_fd       : file descriptor representing the input to the pipe. Pass this to the
+                      source of the data to be read
+        err_fd      : file descriptor representing the input to the second pipe, or None if
+                      there is no second pipe.
+        stdin_fd    : file descriptor the command reads its input from, or None if there is no
+                      input.
+        is_error    : error status. True if an unrecoverable error has occurred. The caller
+                      should monitor this value regularly.
+        error_msg   : contains the error message. If no error had occurred, this is set to None.
+        total_bytes : number of bytes read from the sources.
+        first_read_time : monotonic time at which the first byte was read, or None.
+        last_read_time : monotonic time at which the latest chunk was read, or None.
+        kill_pattern: the first pattern found whose action is RunCmd.MATCH_KILL, or None.
+        sink_errors : list of the messages of the sinks which failed while others carried on.
+
+        _sources    : list of the _PipeSource objects being read.
+        _input      : the _PipeInput feeding the command, or None.
+        _finished   : event set once the pipe has finished reading from the source.
+        _view       : a memoryview over the buffer used to temporarily store the chunks of data
+                      read from the source. The buffer is reused for every chunk, and grows
+                      whenever a read fills it, up to the maximum chunk size.
+    """
+    # Default smallest and largest number of bytes to read in at a time. A largest chunk size of
+    # None means the capacity of the pipe.
+    MIN_CHUNK_SIZE = 1024
+    MAX_CHUNK_SIZE = None
+
+    def __init__(self, dest_file, wakeup=None, min_chunk_size=None, max_chunk_size=None,
+                 err_file=None, input=None, on_read=None, patterns=None, write_queue=None,
+                 overflow='block', is_flush=False, recorders=None):
+        """ Constructor
+
+        Args:
+            dest_file     : file object where the data will be written into, a callable which is
+                            called with every chunk of data, or a list or tuple of them. See
+                            _PipeSource.
+            wakeup        : optional _WakeupEvent which is set if an error occurs, so the caller
+                            does not need to poll is_error.
+            min_chunk_size: number of bytes to read in at a time initially. Defaults to
+                            MIN_CHUNK_SIZE.
+            max_chunk_size: upper limit the chunk size may grow to. Defaults to MAX_CHUNK_SIZE.
+            err_file      : optional file object where the data of the second pipe will be
+                            written into, or a callable or a list or tuple, like dest_file.
+            input         : optional input to feed to the command. See _PipeInput.
+            on_read       : optional callable invoked from the background thread after every
+                            chunk read, with the number of bytes read before the chunk and the
+                            total number of bytes read so far.
+            patterns      : optional dictionary of patterns to look for in the data of every
+                            pipe, and their actions. See RunCmd.run_fd(). The wakeup event is
+                            set once a pattern to kill the command is found.
+            write_queue   : optional number of chunks which may be queued to be written by a
+                            thread of its own for each pipe. See _WriteQueue. None writes from
+                            the reading thread.
+            overflow      : what to do once write_queue chunks are queued, one of
+                            _WriteQueue.OVERFLOW_POLICIES. Defaults to 'block'.
+            is_flush      : if True, flush the destinations whenever the data read so far has
+                            been written, rather than only once the pipe stops.
+            recorders     : optional list of callables, one per pipe, which are called with
+                            every chunk of its data, e.g. to keep a copy. See _PipeSource.
+        """
+        # set is_stop to True and _finished during init to avoid hanging if _PipeData fails to
+        # initialise. Both are reset upon __enter__
+        self.is_stop = True
+        self._finished = threading.Event()
+        self._finished.set()
+        self.is_error = False
+        self.error_msg = None
+        self.total_bytes = 0
+        self.first_read_time = None
+        self.last_read_time = None
+        self.kill_pattern = None
+        self._wakeup = wakeup
+        self._on_read = on_read
+        self._sources = []
+        self._input = None
+        self._is_aborted = False
+        self._abort_fds = None
+        self._is_flush = is_flush
+
+        if sys.platform == 'win32':
+            if err_file is not None:
+                raise RunCmdInvalidInputError('Error: a separate err_file is not supported under '
+                                              'Windows.')
+            if input is not None:
+                raise RunCmdInvalidInputError('Error: input is not supported under Windows.')
+
+        try:
+            for f in (dest_file, err_file):
+                if f is not None:
+                    self._sources.append(_PipeSource(f, patterns))
+            if input is not None:
+                self._input = _PipeInput(input)
+        except RunCmdInvalidInputError:
+            self._close()
+            raise
+
+        if sys.platform != 'win32':
+            # written to by _stop() to give up on reading.
+            self._abort_fds = _pipe()
+
+        self.in_fd = self._sources[0].in_fd
+        self.err_fd = self._sources[1].in_fd if err_file is not None else None
+        self.stdin_fd = self._input.stdin_fd if self._input is not None else None
+        for source, recorder in zip(self._sources, recorders or ()):
+            source.recorder = recorder
+
+        self._min_chunk_size = min_chunk_size or _PipeData.MIN_CHUNK_SIZE
+        self._max_chunk_size = max(self._min_chunk_size,
+                                   max_chunk_size or _PipeData.MAX_CHUNK_SIZE or
+                                   _get_pipe_capacity(self.in_fd))
+        self._view = memoryview(bytearray(self._min_chunk_size))
+
+        if write_queue is not None:
+            try:
+                for source in self._sources:
+                    source.queue = _WriteQueue(source._write, source._flush, write_queue,
+                                               self._max_chunk_size, overflow, is_flush,
+                                               self._set_error)
+            except RunCmdInvalidInputError:
+                self._close()
+                raise
+
+        super(_PipeData, self).__init__()
+
+    def __enter__(self):
+        self._finished.clear()
+        self.is_stop = False
+        for source in self._sources:
+            if source.queue is not None:
+                source.queue.start()
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop()
+
+    def run(self):
+        """ Read from the sources and write to the destination file objects as soon as data
+        arrives, until every source reaches EOF.
+
+        This runs in a background thread. EOF is seen once every copy of in_fd is closed, i.e.
+        the command has exited and the user called stop().
+        """
+        poller = None
+        try:
+            if sys.platform == 'win32':
+                # _read() blocks until EOF, hence the poller is never needed.
+                self._read(self._sources[0])
+                return
+
+            poller = _Poller()
+            sources = {}
+            for source in self._sources:
+                sources[source.out_file.fileno()] = source
+                poller.register(source.out_file.fileno())
+            if self._input is not None:
+                poller.register(self._input.fd, _Poller.WRITE)
+            poller.register(self._abort_fds[0])
+
+            while sources and not self.is_error and not self._is_aborted:
+                for fd in poller.poll():
+                    if fd in sources:
+                        if not self._read(sources[fd]):
+                            poller.unregister(fd)
+                            del sources[fd]
+                    elif fd == self._abort_fds[0]:
+                        break
+                    elif not self._input.write():
+                        poller.unregister(fd)
+        except Exception as e:
+            self._set_error(e)
+        finally:
+            if poller is not None:
+                poller.close()
+            if self._input is not None:
+                self._input.close()
+            self._finish_writing()
+            self._finished.set()
+
+    def _read(self, source):
+        """ Read all content buffered in the pipe one chunk at a time and write to the
+        destination file object.
+
+        Args:
+            source: _PipeSource to read from.
+        Returns:
+            True if the source may have more data, False once EOF was reached or an error
+            occurred.
+        """
+        try:
+            # None means the pipe is empty for now, 0 means EOF.
+            read_size = source.out_file.readinto(self._view)
+            if read_size and self.first_read_time is None:
+                self.first_read_time = _monotonic()
+            while read_size:
+                # tracked per chunk, since under Windows this loop only ends at EOF.
+                self.last_read_time = _monotonic()
+                self.total_bytes += read_size
+                if self._on_read is not None:
+                    self._on_read(self.total_bytes - read_size, self.total_bytes)
+                write_size = read_size
+                if source.matcher is not None:
+                    write_size = min(read_size,
+                                     source.matcher.feed(self._view[:read_size].tobytes()))
+                    self._check_kill_pattern(source)
+                if write_size:
+                    source.write(self._view[:write_size])
+
+                # a full buffer means the source is producing data faster than it is read;
+                # read more at a time from now on.
+                if read_size == len(self._view) and read_size < self._max_chunk_size:
+                    self._view = memoryview(bytearray(min(read_size * 2, self._max_chunk_size)))
+                read_size = source.out_file.readinto(self._view)
+            if self._is_flush:
+                source.flush()
+            if read_size == 0 and source.matcher is not None:
+                source.matcher.finish()
+                self._check_kill_pattern(source)
+            return read_size is None
+        except Exception as e:
+            self._set_error(e)
+            return False
+
+    @property
+    def sink_errors(self):
+        return [e for source in self._sources for e in source.sink_errors]
+
+    @property
+    def queue_stats(self):
+        """ Returns a dictionary of the metrics of the write queues, summed over the pipes, or
+        None if there are none. See _WriteQueue. Up to date while the pipe runs.
+        """
+        queues = [source.queue for source in self._sources if source.queue is not None]
+        if not queues:
+            return None
+        return {
+            'depth': sum(q.depth for q in queues),
+            'max_depth': max(q.max_depth for q in queues),
+            'dropped_bytes': sum(q.dropped_bytes for q in queues),
+            'spilled_bytes': sum(q.spilled_bytes for q in queues),
+            'wait_time': sum(q.wait_time for q in queues),
+        }
+
+    def _finish_writing(self):
+        """ Write out and flush what is left for every destination. Destinations held up by
+        a stuck write are given up on once the pipe was aborted.
+        """
+        for source in self._sources:
+            if source.queue is not None:
+                source.queue.close(not self._is_aborted)
+                continue
+            try:
+                source.flush()
+            except Exception as e:
+                self._set_error(e)
+
+    def _check_kill_pattern(self, source):
+        """ Wake up the caller once a pattern to kill the command was found in a source.
+        """
+        if self.kill_pattern is None and source.matcher.kill_pattern is not None:
+            self.kill_pattern = source.matcher.kill_pattern
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def _set_error(self, e):
+        """ Record an unrecoverable error.
+        """
+        self.is_error = True
+        self.error_msg = "{} raised exception {}".format(self.__class__.__name__, str(e))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _stop(self, timeout=None):
+        """ Signal to pipe to stop reading from in_fd and write everything out.
+
+        Once this is called, this object cannot be run again.
+
+        Args:
+            timeout: seconds to wait for the rest of the output, which may never end if a
+                     process outside the command's process group holds the pipe open. None
+                     waits indefinitely. Only supported under POSIX.
+        """
+        if self.is_stop:
+            return
+
+        # Close the write end of pipe. Wait until everything has been read
+        # from the pipe before closing the read end of the pipe as well.
+        self.is_stop = True
+        for source in self._sources:
+            os.close(source.in_fd)
+        if self._input is not None:
+            os.close(self._input.stdin_fd)
+        if not self._finished.wait(timeout) and self._abort_fds is not None:
+            self._is_aborted = True
+            # the reading thread may be waiting for a write queue to make room.
+            for source in self._sources:
+                if source.queue is not None:
+                    source.queue.abort()
+            os.write(self._abort_fds[1], 'x')
+            self._finished.wait()
+
+        for source in self._sources:
+            source.out_file.close()
+        self._close_abort_fds()
+        self.join()
+
+    def _close_abort_fds(self):
+        if self._abort_fds is not None:
+            for fd in self._abort_fds:
+                os.close(fd)
+            self._abort_fds = None
+
+    def _close(self):
+        """ Close the pipes of a _PipeData which failed to initialise.
+        """
+        for source in self._sources:
+            os.close(source.in_fd)
+            source.out_file.close()
+        if self._input is not None:
+            os.close(self._input.stdin_fd)
+            self._input.close()
+        self._close_abort_fds()
+
+    def __del__(self):
+        """ Stop the monitoring process if object gets deleted.
+        """
+        self._stop()
+
+
+class _OutputSplitter(object):
+    """ Turns the chunks of a stream of output into the items yielded by RunCmd.iter_output(),
+    i.e. decodes them and splits them into lines if required.
+    """
+    def __init__(self, lines, encoding):
+        """ Constructor
+
+        Args:
+            lines   : If True, split the output into lines.
+            encoding: If given, the encoding to decode the output with.
+        """
+        self._lines = lines
+        self._decoder = codecs.getincrementaldecoder(encoding)('replace') if encoding else None
+        self._partial = u'' if self._decoder else ''
+
+    def feed(self, chunk):
+        """ Returns the list of items completed by the chunk.
+        """
+        if self._decoder is not None:
+            chunk = self._decoder.decode(chunk)
+        if not self._lines:
+            return [chunk] if chunk else []
+
+        split = (self._partial + chunk).split('\n')
+        self._partial = split.pop()
+        return [line + '\n' for line in split]
+
+    def finish(self):
+        """ Returns the list of items left once the output has ended.
+        """
+        partial = self._partial
+        if self._decoder is not None:
+            partial += self._decoder.decode('', True)
+        return [partial] if partial else []
+
+
+class _OutputMatcher(object):
+    """ Looks for patterns in a stream of output which arrives one chunk at a time, and carries
+    out the action of each pattern found. See RunCmd.run_fd().
+
+    All literal patterns are searched for at once, with a single regular expression which
+    looks ahead for any of them, hence each chunk is scanned once however many literals there
+    are. Every literal is reported at every position it is found, even where it overlaps another
+    match. The last bytes of the previous chunk, one fewer than the longest literal, are scanned
+    again with the next chunk so matches spanning two chunks are found; only matches ending past
+    the bytes already searched are reported, so the result does not depend on the chunk sizes.
+
+    Regular expressions may match any number of bytes, hence they are searched for in whole
+    lines instead: the start of a line is held back until its end arrives, up to MAX_LINE_SIZE
+    bytes. Several lines are searched at a time.
+
+    Attributes:
+        kill_pattern : the first pattern found whose action is RunCmd.MATCH_KILL, or None.
+        is_capturing : False once a pattern whose action is RunCmd.MATCH_STOP_CAPTURE was found.
+    """
+    # Number of bytes of a line held back at most, before it is searched regardless.
+    MAX_LINE_SIZE = 65536
+
+    def __init__(self, patterns):
+        """ Constructor
+
+        Args:
+            patterns: dictionary of the action for each pattern. See RunCmd.run_fd().
+        Exceptions:
+            RunCmdInvalidInputError : A pattern or an action was invalid.
+        """
+        self._actions = dict(patterns)
+        literals = []
+        self._regexes = []
+        for pattern, action in self._actions.items():
+            if action not in (RunCmd.MATCH_KILL, RunCmd.MATCH_STOP_CAPTURE) and \
+                    not callable(action):
+                raise RunCmdInvalidInputError('Error: invalid action {!r} for pattern {!r}.'
+                                              .format(action, pattern))
+            if isinstance(pattern, bytes) and pattern:
+                literals.append(pattern)
+            elif hasattr(pattern, 'finditer'):
+                self._regexes.append(pattern)
+            else:
+                raise RunCmdInvalidInputError('Error: pattern {!r} is neither a non-empty string '
+                                              'nor a compiled regular expression.'
+                                              .format(pattern))
+
+        # the lookahead finds every position at which a literal starts, the literals starting
+        # there are then told apart by their first byte.
+        self._literals = re.compile('(?=' + '|'.join(re.escape(l) for l in literals) + ')') \
+            if literals else None
+        self._by_first = collections.defaultdict(list)
+        for literal in literals:
+            self._by_first[literal[0]].append(literal)
+        self._overlap = max(len(l) for l in literals) - 1 if literals else 0
+        self._tail = ''
+        self._offset = 0
+        self._partial = ''
+        self.kill_pattern = None
+        self.is_capturing = True
+
+    def feed(self, chunk):
+        """ Search a chunk of output, and carry out the actions of the patterns found.
+
+        Returns:
+            The number of bytes at the start of the chunk to capture.
+        """
+        keep = len(chunk) if self.is_capturing else 0
+        if self._literals is not None:
+            data = self._tail + chunk
+            # stream offset of the start of data, and of the first byte not searched before.
+            data_offset = self._offset - len(self._tail)
+            for m in self._literals.finditer(data):
+                pos = m.start()
+                for literal in self._by_first[data[pos]]:
+                    match_end = data_offset + pos + len(literal)
+                    # matches ending in the tail were reported with the previous chunk.
+                    if match_end > self._offset and data.startswith(literal, pos):
+                        keep = min(keep, self._act(literal, literal, match_end - self._offset))
+            self._tail = data[-self._overlap:] if self._overlap else ''
+            self._offset += len(chunk)
+
+        if self._regexes:
+            end = chunk.rfind('\n') + 1
+            if end == 0 and len(self._partial) + len(chunk) < self.MAX_LINE_SIZE:
+                self._partial += chunk
+                return keep
+            if end == 0:
+                end = len(chunk)
+            start = len(self._partial)
+            lines = self._partial + chunk[:end]
+            self._partial = chunk[end:]
+            for pattern, match, match_end in self._search(lines):
+                keep = min(keep, self._act(pattern, match, max(0, match_end - start)))
+        return keep
+
+    def finish(self):
+        """ Search the last line of the output, once the output has ended.
+        """
+        lines, self._partial = self._partial, ''
+        for pattern, match, match_end in self._search(lines):
+            self._act(pattern, match, match_end)
+
+    def _search(self, lines):
+        """ Yields a tuple of (pattern, match, end) for every match of the regular expressions.
+        """
+        if lines:
+            for regex in self._regexes:
+                for m in regex.finditer(lines):
+                    yield regex, m.group(0), m.end()
+
+    def _act(self, pattern, match, end):
+        """ Carry out the action of a pattern found in the output.
+
+        Args:
+            pattern: the pattern found.
+            match  : the bytes matched.
+            end    : offset in the current chunk at which the match ends.
+        Returns:
+            The number of bytes at the start of the current chunk to capture.
+        """
+        action = self._actions[pattern]
+        if action == RunCmd.MATCH_KILL:
+            if self.kill_pattern is None:
+                self.kill_pattern = pattern
+        elif action == RunCmd.MATCH_STOP_CAPTURE:
+            if self.is_capturing:
+                self.is_capturing = False
+                return end
+        else:
+            action(pattern, match)
+        return sys.maxsize
+
+
+class BoundedBuffer(io.RawIOBase):
+    """ An in-memory file object which keeps at most the first head bytes and the last tail
+    bytes written to it, and counts the bytes dropped in between.
+
+    Memory use is bounded by head + tail, however much is written. For example, to keep the
+    last 64 KB of a build log:
+        buff = BoundedBuffer(tail=65536)
+        RunCmd().run_fd('make', buff, shell=True)
+        print buff.getvalue(), buff.dropped_bytes
+
+    Attributes:
+        head        : maximum number of bytes kept from the start of the data.
+        tail        : maximum number of bytes kept from the end of the data.
+        total_bytes : number of bytes written.
+    """
+    def __init__(self, head=0, tail=0):
+        """ Constructor
+
+        Args:
+            head: maximum number of bytes kept from the start of the data. Defaults to 0.
+            tail: maximum number of bytes kept from the end of the data. Defaults to 0.
+        Exceptions:
+            RunCmdInvalidInputError : head or tail was negative.
+        """
+        if head < 0 or tail < 0:
+            raise RunCmdInvalidInputError('Error: head and tail must not be negative.')
+
+        super(BoundedBuffer, self).__init__()
+        self.head = head
+        self.tail = tail
+        self.total_bytes = 0
+        self._head = bytearray()
+        # the tail is a ring buffer; _tail_pos is where the next byte is written.
+        self._tail = bytearray(tail)
+        self._tail_pos = 0
+        self._tail_len = 0
+
+    @property
+    def dropped_bytes(self):
+        """ Number of bytes written but not kept.
+        """
+        return self.total_bytes - len(self._head) - self._tail_len
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """ Write data, keeping only what falls within the head or the tail.
+
+        Returns:
+            The number of bytes written, i.e. the length of data.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+
+        view = memoryview(data)
+        size = len(view)
+        self.total_bytes += size
+
+        if len(self._head) < self.head:
+            n = min(size, self.head - len(self._head))
+            self._head += view[:n]
+            view = view[n:]
+
+        n = len(view)
+        if not self.tail or not n:
+            return size
+
+        if n >= self.tail:
+            self._tail[:] = view[n - self.tail:]
+            self._tail_pos = 0
+            self._tail_len = self.tail
+        else:
+            # write up to the end of the ring, then wrap around to its start.
+            first = min(n, self.tail - self._tail_pos)
+            self._tail[self._tail_pos:self._tail_pos + first] = view[:first]
+            self._tail[:n - first] = view[first:]
+            self._tail_pos = (self._tail_pos + n) % self.tail
+            self._tail_len = min(self.tail, self._tail_len + n)
+        return size
+
+    def getvalue(self):
+        """ Returns the head followed by the tail as a string.
+        """
+        if self._tail_len < self.tail:
+            tail = self._tail[:self._tail_len]
+        else:
+            tail = self._tail[self._tail_pos:] + self._tail[:self._tail_pos]
+        return str(self._head + tail)
+
+
+class SpooledBuffer(io.RawIOBase):
+    """ A file object which holds the data written to it in memory until it exceeds max_size
+    bytes, then moves it to a temporary file.
+
+    Once moved to a file, the data is returned as a read-only memory map of the file, hence
+    it never needs to be copied into memory as a whole. For example:
+        buff = SpooledBuffer(max_size=1048576)
+        RunCmd().run_fd('make', buff, shell=True)
+        out = buff.getvalue()
+        print len(out), out[-100:]
+
+    Attributes:
+        max_size : number of bytes held in memory before the data is moved to a file.
+        is_spilled : boolean indicating if the data has been moved to a file.
+    """
+    def __init__(self, max_size, dir=None):
+        """ Constructor
+
+        Args:
+            max_size: number of bytes held in memory before the data is moved to a file.
+            dir     : directory to create the temporary file in. Defaults to the directory of
+                      the tempfile module.
+        Exceptions:
+            RunCmdInvalidInputError : max_size was negative.
+        """
+        if max_size < 0:
+            raise RunCmdInvalidInputError('Error: max_size must not be negative.')
+
+        super(SpooledBuffer, self).__init__()
+        self.max_size = max_size
+        self.is_spilled = False
+        self._dir = dir
+        self._buffer = io.BytesIO()
+        self._file = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """ Write data, moving everything to a temporary file once max_size is exceeded.
+
+        Returns:
+            The number of bytes written, i.e. the length of data.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+
+        if not self.is_spilled and self._buffer.tell() + len(data) > self.max_size:
+            self._file = tempfile.TemporaryFile(dir=self._dir)
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+            self.is_spilled = True
+
+        if self.is_spilled:
+            self._file.write(data)
+        else:
+            self._buffer.write(data)
+        return len(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def getvalue(self):
+        """ Returns the data written: a string if it is held in memory, otherwise a read-only
+        mmap.mmap of the temporary file. The memory map stays valid after the buffer is closed.
+        """
+        if not self.is_spilled:
+            return self._buffer.getvalue()
+
+        self._file.flush()
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """ Close the buffer. The temporary file is deleted once every memory map of it is
+        closed.
+        """
+        super(SpooledBuffer, self).close()
+        if self._file is not None:
+            self._file.close()
+
+
+def _get_compressor(format):
+    """ Returns a new compressor object for a compression format. See RunCmd.run_fd().
+
+    Exceptions:
+        RunCmdInvalidInputError : The format is unknown, or not available.
+    """
+    if format == 'gzip':
+        # a window size over 16 makes zlib write a gzip header and trailer.
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if format == 'zlib':
+        return zlib.compressobj()
+    if format == 'bz2':
+        return bz2.BZ2Compressor()
+    if format == 'lzma':
+        if lzma is None:
+            raise RunCmdInvalidInputError('Error: lzma compression requires the lzma module, '
+                                          'e.g. from the backports.lzma package.')
+        return lzma.LZMACompressor()
+    raise RunCmdInvalidInputError('Error: unknown compression format {!r}; expected one of {}.'
+                                  .format(format, ', '.join(RunCmd.COMPRESS_FORMATS)))
+
+
+class _CompressWriter(object):
+    """ A file object which compresses the data written to it into another file object, in a
+    background thread.
+
+    write() only queues the data, hence the thread reading a command's output is not held up
+    by the compression. At most QUEUE_SIZE writes are queued; once the queue is full, write()
+    blocks until the compression catches up, which in turn makes the command wait to write.
+
+    Attributes:
+        error       : the exception raised while compressing or writing out the data, or None.
+        total_bytes : number of compressed bytes written to the destination.
+    """
+    # Number of writes queued at most.
+    QUEUE_SIZE = 64
+
+    def __init__(self, dest_file, format):
+        """ Constructor. Starts the background thread.
+
+        Args:
+            dest_file: file object where the compressed data will be written into.
+            format   : compression format. See RunCmd.COMPRESS_FORMATS.
+        Exceptions:
+            RunCmdInvalidInputError : The format is unknown, or dest_file is not writable.
+        """
+        self._compressor = _get_compressor(format)
+        _check_writable(dest_file)
+        self._dest_file = dest_file
+        self._queue = Queue.Queue(self.QUEUE_SIZE)
+        self.error = None
+        self.total_bytes = 0
+        self.closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        """ Queue data to be compressed.
+
+        Returns:
+            The number of bytes written, i.e. the length of data.
+        Exceptions:
+            IOError : An earlier write could not be compressed or written out.
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if self.error is not None:
+            raise IOError('compression failed: {}'.format(self.error))
+        if data:
+            self._queue.put(data)
+        return len(data)
+
+    def flush(self):
+        """ Does nothing. The data is written out as soon as it is compressed; close() ends
+        the compressed stream.
+        """
+        pass
+
+    def close(self):
+        """ Compress the data still queued, end the compressed stream and flush the
+        destination, which is left open. Check error afterwards.
+        """
+        if not self.closed:
+            self.closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        """ Compress the queued data until close() queues None.
+        """
+        try:
+            data = self._queue.get()
+            while data is not None:
+                self._write(self._compressor.compress(data))
+                data = self._queue.get()
+            self._write(self._compressor.flush())
+            self._dest_file.flush()
+        except Exception as e:
+            self.error = e
+            # keep taking data off the queue, so write() does not block until it notices.
+            while data is not None:
+                data = self._queue.get()
+
+    def _write(self, data):
+        if data:
+            self._dest_file.write(data)
+            self.total_bytes += len(data)
+
+
+class _CacheRecorder(object):
+    """ Keeps a copy of the output of a command in temporary files in the directory of a
+    RunCmdCache, to be stored once the command has finished. See RunCmdCache.
+
+    Writing the copy never fails the command: the first error is recorded and the rest of the
+    output is ignored, which in turn stops the result from being stored.
+
+    Attributes:
+        writers : list of callables, one per stream (stdout, then stderr if captured
+                  separately), which write a chunk of the stream to its copy.
+        error   : the exception raised while keeping the copy, or None.
+    """
+    def __init__(self, cache, key, stream_count):
+        """ Constructor
+
+        Args:
+            cache       : the RunCmdCache to store the result in.
+            key         : the key of the result. See RunCmdCache.get_key().
+            stream_count: number of streams of output, 1 or 2.
+        """
+        self._cache = cache
+        self._key = key
+        self._files = []
+        self._paths = []
+        self.error = None
+        try:
+            for _ in range(stream_count):
+                fd, path = tempfile.mkstemp(suffix='.tmp', dir=cache.directory)
+                self._paths.append(path)
+                self._files.append(os.fdopen(fd, 'wb'))
+        except (OSError, IOError) as e:
+            self.error = e
+        self.writers = [(lambda i: lambda view: self._write(i, view))(i)
+                        for i in range(stream_count)]
+
+    def _write(self, i, view):
+        if self.error is None:
+            try:
+                self._files[i].write(view)
+            except (OSError, IOError) as e:
+                self.error = e
+
+    def close(self, return_code):
+        """ Store the copy in the cache as the result of the command, or discard it.
+
+        Args:
+            return_code: return code of the command, or None if it did not complete. Negative
+                         return codes, i.e. RunCmd's error return codes and commands killed by
+                         a signal, are not stored.
+        """
+        for f in self._files:
+            try:
+                f.close()
+            except (OSError, IOError) as e:
+                self.error = self.error or e
+        paths = self._paths
+        if return_code is not None and return_code >= 0 and self.error is None:
+            try:
+                self._cache._store(self._key, return_code, paths)
+                return
+            except (OSError, IOError) as e:
+                self.error = e
+        for path in paths:
+            _remove_file(path)
+
+
+def _remove_file(path):
+    """ Remove a file, ignoring it not being there.
+    """
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class RunCmdCache(object):
+    """ A cache of the results of commands on disk, which lets RunCmd replay the return code
+    and output of a command run before instead of running it again. Only use it for commands
+    whose output depends on nothing but what the key covers, e.g. deterministic tools.
+
+    A result is keyed by the command, the shell flag, the directory it runs in, whether stderr
+    is captured separately, the values of the environment variables named in env_keys, and the
+    content of the input files given to RunCmd.run() or run_fd(). The input files are hashed
+    with SHA-256, and hashed again only once their size or modification time changes.
+
+    Results whose return code is negative, i.e. commands which timed out, were killed or could
+    not be run, are not stored. Neither are the results of commands given input or patterns.
+
+    The results are stored as files in directory, and their total size is kept under max_size
+    by evicting the least recently used ones. An index of them is kept in memory, and rebuilt
+    from the directory by the constructor, hence the directory can be shared by RunCmdCache
+    instances of several processes. It is safe to use from several threads.
+
+    For example:
+        cache = RunCmdCache('/var/cache/runcmd', max_size=256 * 1024 * 1024, env_keys=['PATH'])
+        ret, out = RunCmd(cache=cache).run(['lint', 'main.c'], cache_inputs=['main.c'])
+
+    Attributes:
+        directory: Directory the results are stored in.
+        max_size : Largest number of bytes stored at once.
+        env_keys : Names of the environment variables which are part of the key.
+        size     : Number of bytes currently stored.
+        hits     : Number of results replayed from the cache.
+        misses   : Number of results not found in the cache.
+        evictions: Number of results evicted to make room for newer ones.
+    """
+    # Default largest number of bytes stored at once.
+    MAX_SIZE = 1024 * 1024 * 1024
+
+    # Number of bytes read at a time when hashing input files or replaying output.
+    BLOCK_SIZE = 65536
+
+    def __init__(self, directory, max_size=None, env_keys=None):
+        """ Constructor. Creates the directory if needed.
+
+        Args:
+            directory: Directory to store the results in.
+            max_size : Largest number of bytes to store at once. Defaults to MAX_SIZE.
+            env_keys : List of the names of the environment variables which are part of the
+                       key. Defaults to None, which leaves the environment out of the key.
+        Exceptions:
+            RunCmdInvalidInputError : max_size was not positive, or the directory could not be
+                                      created.
+        """
+        if max_size is not None and max_size <= 0:
+            raise RunCmdInvalidInputError('Error: max_size must be positive.')
+        self.directory = os.path.abspath(directory)
+        self.max_size = RunCmdCache.MAX_SIZE if max_size is None else max_size
+        self.env_keys = sorted(env_keys or [])
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # maps the keys to the sizes of their results, the least recently used first.
+        self._index = collections.OrderedDict()
+        # maps the paths of input files to their (size, mtime, digest).
+        self._digests = {}
+
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._load()
+        except OSError as e:
+            raise RunCmdInvalidInputError('Error: cannot use {} as the cache directory: {}'
+                                          .format(self.directory, e))
+
+    @property
+    def stats(self):
+        """ Dictionary of the metrics of the cache: 'hits', 'misses', 'evictions', 'entries',
+        the number of results stored, and 'size', the number of bytes stored.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._index), 'size': self.size}
+
+    def get_key(self, cmd, shell=False, cwd=None, inputs=None, is_split=False):
+        """ Returns the key of the result of a command.
+
+        Args:
+            cmd     : Command to run.
+            shell   : Boolean to indicate if the shell should be invoked or not.
+            cwd     : Directory to run command in. None means the current directory.
+            inputs  : List of the paths of the files the output of the command depends on.
+            is_split: Boolean to indicate if stderr is captured separately from stdout.
+        Returns:
+            The key, as a string of hex digits.
+        Exceptions:
+            RunCmdInvalidInputError : An input file could not be read.
+        """
+        env = [(name, os.environ.get(name)) for name in self.env_keys]
+        digests = [(os.path.abspath(path), self._get_digest(path)) for path in inputs or []]
+        data = json.dumps([cmd, bool(shell), os.path.abspath(cwd or os.getcwd()),
+                           bool(is_split), env, digests])
+        return hashlib.sha256(data).hexdigest()
+
+    def clear(self):
+        """ Remove every result stored.
+        """
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+
+    def _get_digest(self, path):
+        """ Returns the SHA-256 of the content of a file, hashing it only if it changed since
+        it was last hashed.
+        """
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+            with self._lock:
+                cached = self._digests.get(path)
+            if cached is not None and cached[:2] == (st.st_size, st.st_mtime):
+                return cached[2]
+
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(RunCmdCache.BLOCK_SIZE), ''):
+                    sha.update(block)
+        except (OSError, IOError) as e:
+            raise RunCmdInvalidInputError('Error: cannot hash the input file {}: {}'
+                                          .format(path, e))
+        digest = sha.hexdigest()
+        with self._lock:
+            self._digests[path] = (st.st_size, st.st_mtime, digest)
+        return digest
+
+    def _get_paths(self, key):
+        """ Returns the paths of the files of a result: its metadata, stdout and stderr.
+        """
+        path = os.path.join(self.directory, key)
+        return path + '.meta', path + '.out', path + '.err'
+
+    def _load(self):
+        """ Rebuild the index from the results in the directory, ordered by when they were last
+        used.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.meta'):
+                continue
+            key = name[:-len('.meta')]
+            size = 0
+            mtime = None
+            for path in self._get_paths(key):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                size += st.st_size
+                if mtime is None:
+                    mtime = st.st_mtime
+            if mtime is not None:
+                entries.append((mtime, key, size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.size += size
+        while self.size > self.max_size:
+            self._evict()
+
+    def _lookup(self, key):
+        """ Look up the result of a command, and mark it as the most recently used.
+
+        Returns:
+            A tuple of (return_code, files), where files are the file objects of its stdout,
+            and of its stderr if captured separately, opened for reading, or None if the
+            result is not in the cache.
+        """
+        meta_path, out_path, err_path = self._get_paths(key)
+        with self._lock:
+            if key in self._index:
+                files = []
+                try:
+                    with open(meta_path, 'rb') as f:
+                        meta = json.load(f)
+                    files.append(open(out_path, 'rb'))
+                    if meta['is_split']:
+                        files.append(open(err_path, 'rb'))
+                    # the modification time of the metadata orders the results on reload.
+                    os.utime(meta_path, None)
+                except (OSError, IOError, ValueError, KeyError):
+                    # removed by another process, or left incomplete.
+                    for f in files:
+                        f.close()
+                    self._remove(key)
+                else:
+                    self._index[key] = self._index.pop(key)
+                    self.hits += 1
+                    return meta['return_code'], files
+            self.misses += 1
+        return None
+
+    def _record(self, key, stream_count):
+        """ Returns a _CacheRecorder keeping a copy of the output of a command.
+        """
+        return _CacheRecorder(self, key, stream_count)
+
+    def _store(self, key, return_code, paths):
+        """ Store the result of a command, from the temporary files holding its output, then
+        evict the least recently used results until the cache is under max_size.
+        """
+        meta_path, out_path, err_path = self._get_paths(key)
+        meta = json.dumps({'return_code': return_code, 'is_split': len(paths) > 1})
+        size = sum(os.path.getsize(path) for path in paths) + len(meta)
+        if size > self.max_size:
+            for path in paths:
+                _remove_file(path)
+            return
+
+        with self._lock:
+            if key in self._index:
+                self._remove(key)
+            for path, dest in zip(paths, (out_path, err_path)):
+                os.rename(path, dest)
+            # the metadata is written last, so only complete results are loaded.
+            fd, path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(meta)
+            os.rename(path, meta_path)
+            self._index[key] = size
+            self.size += size
+            while self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """ Remove the least recently used result. Call with the lock held.
+        """
+        self._remove(next(iter(self._index)))
+        self.evictions += 1
+
+    def _remove(self, key):
+        """ Remove a result. Call with the lock held.
+        """
+        self.size -= self._index.pop(key)
+        for path in self._get_paths(key):
+            _remove_file(path)
+
+
+class RunCmd(object):
+    """ Runs a command in a subprocess and wait for it to return or timeout.
+
+    This is a substitute for a common subprocess usage pattern:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        ret, out = p.communicate()
+
+    With additional support for a timeout for the command. This is a blocking call,
+    which will wait for either the command to complete or a timeout to occur.
+
+    Attributes:
+        returncode  : The return code as returned from the process. There are also special
+                      returncode values set if RunCmd encounters issues running the command.
+                      See Error ReturnCode section for more details.
+        cmd         : The command used.
+        dropped_bytes : Number of bytes of output dropped by the last call to run() because of
+                      its capture_head and capture_tail limits.
+        min_chunk_size : Number of bytes initially read from the command's output at a time.
+        max_chunk_size : Upper limit the chunk size may grow to.
+        spawn_server: RunCmdSpawnServer starting the commands, or None.
+        kill_grace_period : Seconds a command is given to exit after SIGTERM.
+        reap_timeout : Seconds to wait for a command to exit after SIGKILL.
+        cache       : RunCmdCache the results of commands are replayed from, or None.
+        return_codes: Return codes of each stage of the last pipeline run by run_pipeline().
+        result      : RunCmdResult of the last command, with its timings, output size and
+                      resource usage. Kept up to date while iter_output() runs.
+
+    Error ReturnCode:
+        INVALID_INPUT_ERR: Invalid parameters were used.
+        INTERRUPT_ERR    : Command was interrupted, e.g. Keyboard interrupt signal sent
+        TIMEOUT_ERR      : Runtime of command has exceed set timeout and was forced to
+                           terminate.
+        IDLE_TIMEOUT_ERR : Command produced no output for longer than its idle timeout and was
+                           forced to terminate.
+        MATCH_KILL_ERR   : Command's output matched a pattern whose action is MATCH_KILL, and
+                           the command was forced to terminate.
+
+    Pattern Actions: see run_fd().
+        MATCH_KILL       : Terminate the command.
+        MATCH_STOP_CAPTURE: Stop capturing the output after the match.
+
+    Overflow Policies: see run_fd().
+        OVERFLOW_BLOCK   : Wait for the output to be written.
+        OVERFLOW_DROP_OLDEST: Drop the oldest output not yet written.
+        OVERFLOW_SPILL   : Move the output to a temporary file until it can be written.
+
+    Compression Formats: see run_fd().
+        COMPRESS_FORMATS : 'gzip', 'zlib', 'bz2' and 'lzma'. lzma requires the lzma module,
+                           which under Python 2 comes from the backports.lzma package.
+
+    Streams:
+        STDOUT           : Tags output read from the command's stdout.
+        STDERR           : Tags output read from the command's stderr.
+
+    Hook Events: see add_hook().
+        HOOK_PRE_SPAWN   : The command is about to be started.
+        HOOK_SPAWN       : The command has been started.
+        HOOK_FIRST_OUTPUT: The first chunk of output has been read.
+        HOOK_OUTPUT      : Another OUTPUT_HOOK_INTERVAL bytes of output have been read.
+        HOOK_TIMEOUT     : The command has exceeded its timeout or idle timeout.
+        HOOK_PRE_KILL    : The command is about to be killed.
+        HOOK_POST_KILL   : The command has been killed.
+        HOOK_REAP        : The command has exited and been reaped.
+    """
+
+    STDOUT = 1
+    STDERR = 2
+
+    HOOK_PRE_SPAWN = 'pre_spawn'
+    HOOK_SPAWN = 'spawn'
+    HOOK_FIRST_OUTPUT = 'first_output'
+    HOOK_OUTPUT = 'output'
+    HOOK_TIMEOUT = 'timeout'
+    HOOK_PRE_KILL = 'pre_kill'
+    HOOK_POST_KILL = 'post_kill'
+    HOOK_REAP = 'reap'
+    HOOK_EVENTS = (HOOK_PRE_SPAWN, HOOK_SPAWN, HOOK_FIRST_OUTPUT, HOOK_OUTPUT, HOOK_TIMEOUT,
+                   HOOK_PRE_KILL, HOOK_POST_KILL, HOOK_REAP)
+
+    MATCH_KILL = 'kill'
+    MATCH_STOP_CAPTURE = 'stop_capture'
+
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_SPILL = 'spill'
+
+    COMPRESS_FORMATS = ('gzip', 'zlib', 'bz2', 'lzma')
+
+    # Number of bytes of output between HOOK_OUTPUT events.
+    OUTPUT_HOOK_INTERVAL = 1024 * 1024
+
+    MATCH_KILL_ERR = -6
+    IDLE_TIMEOUT_ERR = -5
+    INVALID_INPUT_ERR = -4
+    INTERRUPT_ERR = -3
+    TIMEOUT_ERR = -2
+
+    # Default seconds to wait for a command to exit after SIGTERM before sending SIGKILL, and
+    # after SIGKILL before giving up on reaping it.
+    KILL_GRACE_PERIOD = 5.0
+    REAP_TIMEOUT = 5.0
+
+    def __init__(self, min_chunk_size=None, max_chunk_size=None, spawn_server=None,
+                 kill_grace_period=None, reap_timeout=None, cache=None):
+        """ Constructor
+
+        Args:
+            min_chunk_size: Number of bytes to read from the command's output at a time
+                            initially. The chunk size grows while the command produces output
+                            faster than it is read. Defaults to 1 KB.
+            max_chunk_size: Upper limit the chunk size may grow to. Defaults to the capacity of
+                            the pipe.
+            spawn_server  : RunCmdSpawnServer to start the commands, or None to start them
+                            directly. Defaults to None.
+            kill_grace_period: Seconds a command is given to exit after SIGTERM, before it is
+                            sent SIGKILL. Defaults to KILL_GRACE_PERIOD.
+            reap_timeout  : Seconds to wait for a command to exit after SIGKILL, and for the
+                            rest of its output. Once a command times out, the call returns
+                            within kill_grace_period + reap_timeout (twice that with output
+                            held open by escaped processes). Defaults to REAP_TIMEOUT.
+            cache         : RunCmdCache to replay the results of run() and run_fd() from, and
+                            store them in, or None to always run the commands. Defaults to
+                            None.
+        Exceptions:
+            RunCmdInvalidInputError : Chunk sizes were not positive, or the minimum chunk size
+                                      exceeded the maximum.
+        """
+        for size in (min_chunk_size, max_chunk_size):
+            if size is not None and size <= 0:
+                raise RunCmdInvalidInputError('Error: chunk sizes must be positive.')
+        if min_chunk_size and max_chunk_size and min_chunk_size > max_chunk_size:
+            raise RunCmdInvalidInputError('Error: min_chunk_size must not exceed max_chunk_size.')
+
+        self.return_code = -1
+        self.return_codes = None
+        self.cmd = ''
+        self.dropped_bytes = 0
+        self.result = None
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.spawn_server = spawn_server
+        self.kill_grace_period = RunCmd.KILL_GRACE_PERIOD if kill_grace_period is None \
+            else kill_grace_period
+        self.reap_timeout = RunCmd.REAP_TIMEOUT if reap_timeout is None else reap_timeout
+        self.cache = cache
+        self._hooks = {}
+        self._hook_error = None
+
+    def add_hook(self, event, callback):
+        """ Register a callback to be invoked when an event occurs while running a command.
+
+        The callback is invoked as callback(event, timestamp, value), where timestamp is the
+        monotonic time at which the event occurred, and value depends on the event:
+            HOOK_PRE_SPAWN                 : the command.
+            HOOK_SPAWN, HOOK_TIMEOUT,
+            HOOK_PRE_KILL, HOOK_POST_KILL  : the pid of the command.
+            HOOK_FIRST_OUTPUT, HOOK_OUTPUT : the total number of bytes of output read so far.
+            HOOK_REAP                      : the exit status of the command.
+
+        HOOK_FIRST_OUTPUT and HOOK_OUTPUT are invoked from the thread reading the output, except
+        under iter_output(); an exception raised by them is reported as a RunCmdInternalError.
+        An exception raised by any other hook does not keep the command from being killed and
+        reaped; it is reported as a RunCmdInternalError once the command has finished.
+        Callbacks should return quickly, as the command is not serviced while they run. When no
+        hook is registered, none of the timestamps are taken.
+
+        Args:
+            event   : One of RunCmd.HOOK_EVENTS.
+            callback: Callable to invoke.
+        Exceptions:
+            RunCmdInvalidInputError : The event is unknown.
+        """
+        if event not in RunCmd.HOOK_EVENTS:
+            raise RunCmdInvalidInputError('Error: unknown hook event %r.' % (event,))
+        self._hooks.setdefault(event, []).append(callback)
+
+    def remove_hook(self, event, callback):
+        """ Unregister a callback registered by add_hook(). Unknown callbacks are ignored.
+        """
+        callbacks = self._hooks.get(event, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self._hooks.pop(event, None)
+
+    def run(self, cmd, timeout=0, shell=False, cwd=None, split_stderr=False, input=None,
+            capture_head=None, capture_tail=None, spool_size=None, idle_timeout=0,
+            patterns=None, compress=None, cache_inputs=None):
+        """ Runs the command and return the return code and output.
+
+        This is similar to Popen.communicate().Note that it is assumed the output of the command
+        will not exceed the available memory, unless capture_head, capture_tail or spool_size
+        are given. For larger outputs, use cmd_fd()
+
+        Args:
+            cmd     : Command to run.
+            timeout : Seconds to wait before terminating command. Timeout must be a positive
+                      number and may be a fraction of a second. If timeout <= 0, RunCmd will
+                      wait indefinitely. Defaults to 0.
+            shell   : Boolean to indicate if the shell should be invoked or not.
+                      Defaults to False.
+            cwd:    : Directory to run command in. If none is given the command will be run in
+                      the current directory. Default is None.
+            split_stderr: If True, capture stderr separately from stdout. Only supported under
+                      POSIX. Defaults to False.
+            input   : Input to feed to the command's stdin. Either a string, a file object or an
+                      iterable of strings. See run_fd(). Defaults to None.
+            capture_head: If given, keep at most this many bytes from the start of the output.
+                      Defaults to None.
+            capture_tail: If given, keep at most this many bytes from the end of the output.
+                      When either capture_head or capture_tail is given, memory use is bounded
+                      by their sum, the output is the head followed by the tail, and the
+                      number of bytes dropped in between is available from dropped_bytes. The
+                      limits apply to stdout and stderr each. Defaults to None.
+            spool_size: If given, output larger than this many bytes is moved to a temporary
+                      file and returned as a read-only mmap.mmap of the file instead of a string.
+                      Cannot be combined with capture_head or capture_tail. Defaults to None.
+            idle_timeout: Seconds the command may go without producing any output before it is
+                      terminated. See run_fd(). Defaults to 0.
+            patterns: Dictionary of patterns to look for in the output, and their actions. See
+                      run_fd(). Defaults to None.
+            compress: If given, the output is returned compressed in this format. See run_fd().
+                      Cannot be combined with capture_head or capture_tail. Defaults to None.
+            cache_inputs: List of the paths of the files the output depends on, for the cache.
+                      See run_fd(). Defaults to None.
+        Returns:
+            A tuple of (returncode, out) where returncode is the returncode from the subprocess
+            and out is a buffer containing the output. If split_stderr is True, a tuple of
+            (returncode, out, err) where err is a buffer containing stderr.
+
+        Exceptions:
+            RunCmdInvalidInputError : Command had invalid parameters.
+            RunCmdInterruptError    : Command was interrupted, e.g. a Keyboard interrupt signal.
+        """
+        is_bounded = capture_head is not None or capture_tail is not None
+        if is_bounded and spool_size is not None:
+            raise RunCmdInvalidInputError('Error: spool_size cannot be combined with capture_head '
+                                          'or capture_tail.')
+        if is_bounded and compress is not None:
+            raise RunCmdInvalidInputError('Error: compress cannot be combined with capture_head '
+                                          'or capture_tail.')
+
+        if is_bounded:
+            make_buffer = lambda: BoundedBuffer(capture_head or 0, capture_tail or 0)
+        elif spool_size is not None:
+            make_buffer = lambda: SpooledBuffer(spool_size)
+        else:
+            make_buffer = io.BytesIO
+
+        buff = None
+        err_buff = None
+        with contextlib.closing(make_buffer()) as f:
+            with contextlib.closing(make_buffer()) as err_f:
+                self.run_fd(cmd, f, timeout, shell, cwd, err_file=err_f if split_stderr else None,
+                            input=input, idle_timeout=idle_timeout, patterns=patterns,
+                            compress=compress, cache_inputs=cache_inputs)
+                buff = f.getvalue()
+                err_buff = err_f.getvalue()
+                self.dropped_bytes = getattr(f, 'dropped_bytes', 0) + \
+                    getattr(err_f, 'dropped_bytes', 0)
+                self.result.output = buff
+
+        if split_stderr:
+            return self.return_code, buff, err_buff
+        return self.return_code, buff
+
+    def run_fd(self, cmd, out_file, timeout=0, shell=False, cwd=None, zero_copy=False,
+               err_file=None, input=None, idle_timeout=0, patterns=None, compress=None,
+               write_queue=None, overflow=OVERFLOW_BLOCK, flush=False, cache_inputs=None):
+        """ Runs the command and writes the output into the user specified file object.
+
+        Similar to RunCmd.run() but allows user to specify a file object where the output will be
+        written into. The returncode can be retrieved from the member value, returncode.
+
+        Args:
+            cmd     : Command to run.
+            out_file: File object which the command will write its output to. It may also be a
+                      callable, which is called with every chunk of output, or a list or tuple
+                      of file objects and callables, which all receive the output in a single
+                      pass. If a sink raises an exception, it is dropped and the others carry
+                      on; its error is recorded in result.sink_errors. RunCmdInternalError is
+                      only raised once every sink has failed.
+            timeout : Seconds to wait before terminating command. Timeout must be a positive
+                      number and may be a fraction of a second. If timeout <= 0, RunCmd will
+                      wait indefinitely. Defaults to 0.
+            shell   : Boolean to indicate if the shell should be invoked or not.
+                      Defaults to False.
+            cwd:    : Directory to run command in. If none is given the command will be run in
+                      the current directory. Default is None.
+            zero_copy: If True and out_file is backed by an OS file (i.e. has a fileno()), the
+                      command writes into it directly and the output never passes through
+                      Python. RunCmd cannot detect out_file being closed while the command
+                      runs in this mode. Ignored for other file objects. Defaults to False.
+            err_file: File object which the command will write its stderr to, or a callable or
+                      a list or tuple of them, like out_file. Both stdout and stderr are read
+                      by the same thread, hence neither can block the other. Only supported
+                      under POSIX. Defaults to None, which merges stderr into out_file.
+            input   : Input to feed to the command's stdin. Either a string, a file object to
+                      read the input from, or an iterable of strings. The input is written by
+                      the thread reading the output, one chunk at a time as the command consumes
+                      it, hence it does not need to fit in memory. Only supported under POSIX.
+                      Defaults to None, which lets the command inherit the caller's stdin.
+            idle_timeout: Seconds the command may go without producing any output, counted from
+                      its start or the last chunk of output read, before it is terminated and
+                      return_code is set to IDLE_TIMEOUT_ERR. It applies alongside timeout and
+                      may be a fraction of a second. If idle_timeout <= 0, the command may stay
+                      silent indefinitely. zero_copy is ignored when it is set, as the output
+                      must be read to be seen. Defaults to 0.
+            patterns: Dictionary of patterns to look for in the output as it is read, and the
+                      action to take when each is found. A pattern is either a string, which is
+                      found anywhere, even across chunks, or a compiled regular expression,
+                      which is searched for in whole lines; compile it with re.MULTILINE for ^
+                      and $ to match at every line. The action is one of:
+                        MATCH_KILL        : terminate the command, and set return_code to
+                                            MATCH_KILL_ERR. The output read until the command
+                                            exits is still captured.
+                        MATCH_STOP_CAPTURE: stop writing the output after the match. The rest
+                                            of the output is still read, so the command does
+                                            not block.
+                        a callable        : called with the pattern and the bytes matched, from
+                                            the thread reading the output. It must not block.
+                      Stdout and stderr are searched separately. zero_copy is ignored when
+                      patterns are given. Defaults to None.
+            compress: If given, one of COMPRESS_FORMATS. The output is compressed on its way
+                      to out_file (and err_file, as a separate stream) by a background thread,
+                      so the thread reading the output only hands it over. The compressed
+                      stream is ended and out_file flushed, but not closed, before run_fd()
+                      returns. Patterns are searched for in the uncompressed output. zero_copy
+                      is ignored when compress is given. Defaults to None.
+            write_queue: If given, the output is written to out_file (and err_file) by a
+                      thread of its own, which is handed the chunks read through a queue of
+                      this many reusable buffers, each as large as the largest chunk. A slow
+                      destination then does not stop the output from being read. The queue's
+                      metrics are available from result.queue_stats. Must be at least 2.
+                      Defaults to None, which writes from the thread reading the output.
+            overflow: What to do with the output once write_queue chunks are queued:
+                        OVERFLOW_BLOCK      : wait, which in turn makes the command wait.
+                        OVERFLOW_DROP_OLDEST: drop the oldest chunk queued.
+                        OVERFLOW_SPILL      : queue the output in a temporary file instead.
+                      Defaults to OVERFLOW_BLOCK.
+            flush   : If True, flush out_file (and err_file) whenever the output read so far
+                      has been written. Otherwise they are only flushed once the command has
+                      finished. Defaults to False.
+            cache_inputs: List of the paths of the files the output of the command depends on.
+                      If the RunCmd has a cache, their content is part of the key of the result.
+                      When the result is found in the cache, the command is not run: its output
+                      is written to out_file and err_file, return_code is set, and
+                      result.is_cached is True. Otherwise the output is copied into the cache
+                      as it is read. Commands given input or patterns are always run, and
+                      zero_copy is ignored while a result is stored. Defaults to None.
+        Exceptions:
+            RunCmdInvalidInputError : Command had invalid parameters.
+            RunCmdInterruptError    : Command was interrupted, e.g. a Keyboard interrupt signal.
+        """
+        self.cmd = cmd
+        result = self.result = RunCmdResult(RunCmdJob(cmd, timeout, shell, cwd, idle_timeout,
+                                                      patterns))
+
+        # if no command was sent in, consider it successful and return.
+        if cmd is None or len(cmd) == 0:
+            self.return_code = result.return_code = 0
+            return
+
+        if not out_file:
+            raise RunCmdInvalidInputError("Error: out_file is None; expected file object.")
+
+        cache = self.cache if input is None and not patterns else None
+        cached = None
+        if cache is not None:
+            key = cache.get_key(cmd, shell, cwd, cache_inputs, err_file is not None)
+            cached = cache._lookup(key)
+
+        timeout = float(timeout)
+        deadline = _monotonic() + timeout if timeout > 0 else None
+        idle_timeout = float(idle_timeout)
+        zero_copy = zero_copy and idle_timeout <= 0 and not patterns and compress is None and \
+            cache is None
+        out_fd = _get_fileno(out_file) if zero_copy else None
+        err_fd = _get_fileno(err_file) if zero_copy and err_file is not None else None
+
+        writers = []
+        if compress is not None:
+            # compress into each file object; callables are given the output as it is.
+            try:
+                dests = []
+                for dest in (out_file, err_file):
+                    sinks = None
+                    if dest is not None:
+                        sinks = _get_sinks(dest)
+                        for i, sink in enumerate(sinks):
+                            if not _is_callable_sink(sink):
+                                sinks[i] = _CompressWriter(sink, compress)
+                                writers.append(sinks[i])
+                    dests.append(sinks)
+                out_file, err_file = dests
+            except RunCmdInvalidInputError:
+                for writer in writers:
+                    writer.close()
+                if cached is not None:
+                    for f in cached[1]:
+                        f.close()
+                raise
+
+        recorder = None
+        if cache is not None and cached is None:
+            recorder = cache._record(key, 1 if err_file is None else 2)
+        is_complete = False
+        wakeup = _WakeupEvent()
+        try:
+            if cached is not None:
+                self._replay(cached, out_file, err_file)
+            elif out_fd is not None and (err_file is None or err_fd is not None) and input is None:
+                # hand the files straight to the command; anything still buffered in them
+                # must be written out first to keep the output in order.
+                files = [(out_file, out_fd)] + ([(err_file, err_fd)] if err_fd else [])
+                offsets = []
+                for f, fd in files:
+                    _check_writable(f)
+                    f.flush()
+                    offsets.append(_get_fd_offset(fd))
+                try:
+                    self._run_process(cmd, shell, cwd, out_fd, err_fd, None, None, wakeup,
+                                      deadline, idle_timeout)
+                finally:
+                    for (f, fd), start in zip(files, offsets):
+                        end = _sync_file_position(f, fd)
+                        if start is not None and end is not None:
+                            result.output_bytes += end - start
+            else:
+                with _PipeData(out_file, wakeup, self.min_chunk_size, self.max_chunk_size,
+                               err_file, input, self._get_read_hook(), patterns, write_queue,
+                               overflow, flush, recorder and recorder.writers) as pipe:
+                    try:
+                        self._run_process(cmd, shell, cwd, pipe.in_fd, pipe.err_fd,
+                                          pipe.stdin_fd, pipe, wakeup, deadline, idle_timeout)
+                    finally:
+                        # stop the pipe first, so the counts include the last of the output. Do
+                        # not wait indefinitely for output held open by escaped processes of a
+                        # command which was killed.
+                        pipe._stop(self.reap_timeout if result.is_killed else None)
+                        result.output_bytes = pipe.total_bytes
+                        result.first_output_time = pipe.first_read_time
+                        result.sink_errors = pipe.sink_errors
+                        result.queue_stats = pipe.queue_stats
+            is_complete = True
+        finally:
+            result.return_code = self.return_code
+            wakeup.close()
+            for writer in writers:
+                writer.close()
+            if recorder is not None:
+                recorder.close(self.return_code if is_complete else None)
+
+        errors = [str(writer.error) for writer in writers if writer.error is not None]
+        if errors:
+            result.error_msg = 'compression failed: {}'.format('; '.join(errors))
+            raise RunCmdInternalError(result.error_msg)
+
+    def run_pipeline(self, stages, timeout=0, split_stderr=False, input=None):
+        """ Runs several commands connected like a shell pipeline, A | B | C, without a shell.
+
+        For example:
+            cmd = RunCmd()
+            return_codes, out = cmd.run_pipeline([['grep', 'ERROR', 'build.log'],
+                                                  ['sort'],
+                                                  RunCmdJob(['uniq', '-c'], env=env)])
+
+        The stdout of each stage is connected straight to the stdin of the next through an OS
+        pipe, so the data never passes through Python; only the output of the last stage is
+        read by RunCmd. The stderr of every stage is captured along with the output, or
+        separately with split_stderr. The timeout applies to the pipeline as a whole, and once
+        it expires every stage is killed. Only supported under POSIX platforms.
+
+        Args:
+            stages  : List of the commands to run. Each is either a command, which is run
+                      without a shell, or a RunCmdJob giving its shell, cwd and env as well.
+                      The timeouts and patterns of the jobs are not used.
+            timeout : Seconds to wait before terminating the pipeline. If timeout <= 0, RunCmd
+                      will wait indefinitely. Defaults to 0.
+            split_stderr: If True, capture stderr separately from stdout. Defaults to False.
+            input   : Input to feed to the first stage's stdin. See run_fd(). Defaults to None.
+        Returns:
+            A tuple of (return_codes, out) where return_codes is the list of the return codes
+            of each stage and out is a buffer containing the output of the last stage. If
+            split_stderr is True, a tuple of (return_codes, out, err). return_code is set to
+            the return code of the last stage, or one of RunCmd's error return codes.
+
+        Exceptions:
+            RunCmdInvalidInputError : Command had invalid parameters.
+            RunCmdInterruptError    : Command was interrupted, e.g. a Keyboard interrupt signal.
+        """
+        if sys.platform == 'win32':
+            raise RunCmdInvalidInputError('Error: run_pipeline() is not supported under '
+                                          'Windows.')
+        if not stages:
+            raise RunCmdInvalidInputError('Error: the pipeline has no stages.')
+
+        jobs = [stage if isinstance(stage, RunCmdJob) else RunCmdJob(stage) for stage in stages]
+        for job in jobs:
+            if job.cmd is None or len(job.cmd) == 0:
+                raise RunCmdInvalidInputError('Error: every stage of the pipeline must have a '
+                                              'command.')
+
+        timeout = float(timeout)
+        deadline = _monotonic() + timeout if timeout > 0 else None
+        self.cmd = [job.cmd for job in jobs]
+        self.return_codes = [None] * len(jobs)
+        result = self.result = RunCmdResult(RunCmdJob(self.cmd, timeout))
+        result.return_codes = self.return_codes
+
+        wakeup = _WakeupEvent()
+        try:
+            with contextlib.closing(io.BytesIO()) as f:
+                with contextlib.closing(io.BytesIO()) as err_f:
+                    with _PipeData(f, wakeup, self.min_chunk_size, self.max_chunk_size,
+                                   err_f if split_stderr else None, input,
+                                   self._get_read_hook()) as pipe:
+                        try:
+                            self._run_stages(jobs, pipe, wakeup, deadline)
+                        finally:
+                            pipe._stop(self.reap_timeout if result.is_killed else None)
+                            result.output_bytes = pipe.total_bytes
+                            result.first_output_time = pipe.first_read_time
+                    buff = result.output = f.getvalue()
+                    err_buff = err_f.getvalue()
+        finally:
+            result.return_code = self.return_code
+            wakeup.close()
+
+        if split_stderr:
+            return self.return_codes, buff, err_buff
+        return self.return_codes, buff
+
+    def _replay(self, cached, out_file, err_file):
+        """ Write the output of a result found in the cache to the destinations given to
+        run_fd(), as if the command had been run. Like the output of a command, a sink which
+        fails is dropped while the others carry on.
+
+        Args:
+            cached  : tuple of (return_code, files) returned by RunCmdCache._lookup(). The files
+                      are closed once written out.
+            out_file: the destination of stdout. See run_fd().
+            err_file: the destination of stderr, or None if it was merged into stdout.
+        Exceptions:
+            RunCmdInternalError : Every sink of a destination failed.
+        """
+        return_code, files = cached
+        result = self.result
+        result.is_cached = True
+        result.start_time = _monotonic()
+        try:
+            for f, dest in zip(files, (out_file, err_file)):
+                sinks = _get_sinks(dest)
+                for sink in sinks:
+                    if not _is_callable_sink(sink):
+                        _check_writable(sink)
+                for data in iter(lambda: f.read(RunCmdCache.BLOCK_SIZE), ''):
+                    if result.first_output_time is None:
+                        result.first_output_time = _monotonic()
+                    result.output_bytes += len(data)
+                    for sink in list(sinks):
+                        try:
+                            if _is_callable_sink(sink):
+                                sink(data)
+                            else:
+                                sink.write(data)
+                        except Exception as e:
+                            sinks.remove(sink)
+                            if not sinks:
+                                result.error_msg = str(e)
+                                raise RunCmdInternalError(result.error_msg)
+                            result.sink_errors.append('{!r} raised exception {}'.format(sink, e))
+                for sink in sinks:
+                    if not _is_callable_sink(sink):
+                        sink.flush()
+        finally:
+            for f in files:
+                f.close()
+            result.end_time = _monotonic()
+        self.return_code = return_code
+
+    def iter_output(self, cmd, timeout=0, shell=False, cwd=None, lines=False, encoding=None,
+                    split_stderr=False, idle_timeout=0):
+        """ Runs the command and yields its output while it is being produced.
+
+        For example:
+            cmd = RunCmd()
+            for line in cmd.iter_output('make', timeout=600, lines=True):
+                print line,
+            print cmd.return_code
+
+        The output is only read from the command when the caller asks for more, hence a slow
+        caller makes the command block on writing rather than buffering its output. The timeout
+        is checked each time the generator resumes. If the caller stops iterating before the
+        output ends, the command is killed. The return code is available from return_code once
+        the generator is exhausted. Only supported under POSIX platforms.
+
+        Args:
+            cmd     : Command to run.
+            timeout : Seconds to wait before terminating command. Timeout must be a positive
+                      number and may be a fraction of a second. If timeout <= 0, RunCmd will
+                      wait indefinitely. Defaults to 0.
+            shell   : Boolean to indicate if the shell should be invoked or not.
+                      Defaults to False.
+            cwd:    : Directory to run command in. If none is given the command will be run in
+                      the current directory. Default is None.
+            lines   : If True, yield the output one line at a time, including the line ending.
+                      Otherwise yield chunks as they are read. Defaults to False.
+            encoding: If given, the output is decoded with this encoding and unicode is yielded.
+                      Undecodable bytes are replaced. Defaults to None.
+            split_stderr: If True, read stderr separately from stdout and yield tuples of
+                      (stream, output), where stream is RunCmd.STDOUT or RunCmd.STDERR, in the
+                      order the output was read. Defaults to False.
+            idle_timeout: Seconds the command may go without producing any output before it is
+                      terminated. See run_fd(). Time spent by the caller between items does not
+                      count. Defaults to 0.
+        Returns:
+            A generator of the output.
+        Exceptions:
+            RunCmdInvalidInputError : Command had invalid parameters.
+            RunCmdInterruptError    : Command was interrupted, e.g. a Keyboard interrupt signal.
+        """
+        if sys.platform == 'win32':
+            raise RunCmdInvalidInputError('Error: iter_output() is not supported under Windows.')
+
+        chunks = self._iter_chunks(cmd, timeout, shell, cwd, split_stderr, idle_timeout)
+        splitters = {RunCmd.STDOUT: _OutputSplitter(lines, encoding),
+                     RunCmd.STDERR: _OutputSplitter(lines, encoding)}
+        try:
+            for stream, chunk in chunks:
+                for item in splitters[stream].feed(chunk):
+                    yield (stream, item) if split_stderr else item
+
+            for stream in (RunCmd.STDOUT, RunCmd.STDERR):
+                for item in splitters[stream].finish():
+                    yield (stream, item) if split_stderr else item
+        finally:
+            chunks.close()
+
+    def _iter_chunks(self, cmd, timeout, shell, cwd, split_stderr, idle_timeout):
+        """ Runs the command and yields tuples of (stream, chunk) of its output. See
+        iter_output().
+        """
+        self.cmd = cmd
+        result = self.result = RunCmdResult(RunCmdJob(cmd, timeout, shell, cwd, idle_timeout))
+
+        # if no command was sent in, consider it successful and return.
+        if cmd is None or len(cmd) == 0:
+            self.return_code = result.return_code = 0
+            return
+
+        timeout = float(timeout)
+        deadline = _monotonic() + timeout if timeout > 0 else None
+        idle_timeout = float(idle_timeout)
+
+        pipes = [_pipe() for _ in range(2 if split_stderr else 1)]
+        self._hook_error = None
+        self._fire(RunCmd.HOOK_PRE_SPAWN, cmd)
+        result.start_time = _monotonic()
+        try:
+            p = _spawn(cmd, shell, cwd, pipes[0][1], pipes[1][1] if split_stderr else None,
+                       server=self.spawn_server)
+        except (WindowsError, OSError):
+            for r, _ in pipes:
+                os.close(r)
+            self.return_code = result.return_code = RunCmd.INVALID_INPUT_ERR
+            result.error_msg = traceback.format_exc()
+            raise RunCmdInvalidInputError(result.error_msg)
+        finally:
+            for _, w in pipes:
+                os.close(w)
+
+        # the stream each pipe is read from, keyed by the file descriptor of the pipe.
+        streams = {}
+        poller = _Poller()
+        for (r, _), stream in zip(pipes, (RunCmd.STDOUT, RunCmd.STDERR)):
+            _set_nonblocking(r)
+            streams[r] = (stream, io.FileIO(r, 'rb'))
+            poller.register(r)
+        self._fire(RunCmd.HOOK_SPAWN, p.pid)
+        wakeup = _WakeupEvent()
+        watcher = _ExitWatcher(p, wakeup)
+        watcher.start()
+        on_read = self._get_read_hook()
+        view = memoryview(bytearray(self.max_chunk_size or _get_pipe_capacity(pipes[0][0])))
+        is_timeout = False
+        is_idle_timeout = False
+        # monotonic time of the last output, or of the caller asking for more.
+        last_active_time = result.start_time
+        try:
+            # read until EOF, then wait for the command to exit.
+            open_fds = set(streams)
+            while open_fds or not watcher.is_exited:
+                remaining = None if deadline is None else deadline - _monotonic()
+                if remaining is not None and remaining <= 0:
+                    is_timeout = True
+                    break
+                if idle_timeout > 0:
+                    idle_remaining = last_active_time + idle_timeout - _monotonic()
+                    if idle_remaining <= 0:
+                        is_idle_timeout = True
+                        break
+                    remaining = idle_remaining if remaining is None else \
+                        min(remaining, idle_remaining)
+
+                if not open_fds:
+                    wakeup.wait(remaining)
+                    continue
+
+                for fd in poller.poll(remaining):
+                    stream, out_file = streams[fd]
+                    read_size = out_file.readinto(view)
+                    if read_size:
+                        if result.first_output_time is None:
+                            result.first_output_time = _monotonic()
+                        result.output_bytes += read_size
+                        if on_read is not None:
+                            on_read(result.output_bytes - read_size, result.output_bytes)
+                        yield stream, view[:read_size].tobytes()
+                        last_active_time = _monotonic()
+                    elif read_size == 0:
+                        poller.unregister(fd)
+                        open_fds.discard(fd)
+
+            if is_timeout:
+                self.return_code = RunCmd.TIMEOUT_ERR
+                result.is_timeout = result.is_killed = True
+                self._fire(RunCmd.HOOK_TIMEOUT, p.pid)
+                self._terminate(p, watcher)
+            elif is_idle_timeout:
+                self.return_code = RunCmd.IDLE_TIMEOUT_ERR
+                result.is_idle_timeout = result.is_killed = True
+                self._fire(RunCmd.HOOK_TIMEOUT, p.pid)
+                self._terminate(p, watcher)
+            else:
+                self.return_code = p.returncode
+
+        except KeyboardInterrupt:
+            self.return_code = RunCmd.INTERRUPT_ERR
+            result.is_killed = True
+            self._terminate(p, watcher)
+            raise RunCmdInterruptError(cmd, traceback.format_exc())
+
+        finally:
+            # the caller stopped iterating early, unless the command was killed already but has
+            # not exited yet.
+            if not watcher.is_exited and not result.is_killed:
+                self.return_code = RunCmd.INTERRUPT_ERR
+                result.is_killed = True
+                self._terminate(p, watcher)
+            self._fire(RunCmd.HOOK_REAP, p.returncode, watcher.exit_time)
+            result.return_code = self.return_code
+            result.end_time = _monotonic()
+            result.set_rusage(watcher.rusage)
+            poller.close()
+            for _, out_file in streams.values():
+                out_file.close()
+            wakeup.close()
+        self._check_hooks()
+
+    def _run_process(self, cmd, shell, cwd, out_fd, err_fd, stdin_fd, pipe, wakeup, deadline,
+                     idle_timeout):
+        """ Start the command and wait for it to exit, time out or for the pipe to fail.
+
+        Args:
+            cmd     : Command to run.
+            shell   : Boolean to indicate if the shell should be invoked or not.
+            cwd     : Directory to run command in.
+            out_fd  : file descriptor the command writes its output to.
+            err_fd  : file descriptor the command writes its errors to, or None to merge them
+                      into out_fd.
+            stdin_fd: file descriptor the command reads its input from, or None to inherit the
+                      caller's stdin.
+            pipe    : _PipeData reading out_fd, or None if the command writes to a file
+                      directly.
+            wakeup  : _WakeupEvent set once the command exits or the pipe fails.
+            deadline: monotonic time after which the command is terminated. None waits
+                      indefinitely.
+            idle_timeout: seconds after the last output read by pipe, or the start of the
+                      command, after which the command is terminated. 0 waits indefinitely.
+        """
+        p = None
+        watcher = None
+        result = self.result
+        self._hook_error = None
+        try:
+            self._fire(RunCmd.HOOK_PRE_SPAWN, cmd)
+            result.start_time = _monotonic()
+            p = _spawn(cmd, shell, cwd, out_fd, err_fd, stdin_fd, self.spawn_server)
+            self._fire(RunCmd.HOOK_SPAWN, p.pid)
+
+            # Block until either the process has finished, the pipe failed or the process
+            # timed out. If the process has exceeded the timeout limit, kill it.
+            # Note the "pipe" is continuously reading the output in a the background thread.
+            watcher = _ExitWatcher(p, wakeup)
+            watcher.start()
+            is_timeout = False
+            is_idle_timeout = False
+            is_pipe_error = False
+            is_match = False
+            while not watcher.is_exited and not is_pipe_error and not is_match:
+                remaining = None if deadline is None else deadline - _monotonic()
+                if remaining is not None and remaining <= 0:
+                    is_timeout = True
+                    break
+                if idle_timeout > 0:
+                    # the pipe does not wake us on output; check again once the last output
+                    # read so far would be too old.
+                    idle_remaining = (pipe.last_read_time or result.start_time) + idle_timeout - \
+                        _monotonic()
+                    if idle_remaining <= 0:
+                        is_idle_timeout = True
+                        break
+                    remaining = idle_remaining if remaining is None else \
+                        min(remaining, idle_remaining)
+                wakeup.wait(remaining)
+                is_pipe_error = pipe is not None and pipe.is_error
+                is_match = pipe is not None and pipe.kill_pattern is not None
+
+            if watcher.is_exited:
+                #normal case
+                self.return_code = p.returncode
+            elif is_pipe_error:
+                # pipe error
+                result.is_killed = True
+                result.error_msg = pipe.error_msg
+                self._terminate(p, watcher)
+                raise RunCmdInternalError(pipe.error_msg)
+            elif is_timeout:
+                # timeout
+                self.return_code = RunCmd.TIMEOUT_ERR
+                result.is_timeout = result.is_killed = True
+                self._fire(RunCmd.HOOK_TIMEOUT, p.pid)
+                self._terminate(p, watcher)
+            elif is_idle_timeout:
+                # no output for too long
+                self.return_code = RunCmd.IDLE_TIMEOUT_ERR
+                result.is_idle_timeout = result.is_killed = True
+                self._fire(RunCmd.HOOK_TIMEOUT, p.pid)
+                self._terminate(p, watcher)
+            elif is_match:
+                # the output showed the command is to be killed
+                self.return_code = RunCmd.MATCH_KILL_ERR
+                result.kill_pattern = pipe.kill_pattern
+                result.is_killed = True
+                self._terminate(p, watcher)
+
+        except (WindowsError, OSError):
+            self.return_code = RunCmd.INVALID_INPUT_ERR
+            result.error_msg = traceback.format_exc()
+            raise RunCmdInvalidInputError(result.error_msg)
+
+        except KeyboardInterrupt:
+            self.return_code = RunCmd.INTERRUPT_ERR
+            result.is_killed = True
+            self._terminate(p, watcher)
+            raise RunCmdInterruptError(cmd, traceback.format_exc())
+
+        finally:
+            result.end_time = _monotonic()
+            if watcher is not None:
+                result.set_rusage(watcher.rusage)
+                if watcher.is_exited:
+                    self._fire(RunCmd.HOOK_REAP, p.returncode, watcher.exit_time)
+        self._check_hooks()
+
+    def _run_stages(self, jobs, pipe, wakeup, deadline):
+        """ Start the stages of a pipeline and wait for them all to exit, time out or for the
+        pipe to fail. See run_pipeline().
+
+        Args:
+            jobs    : list of RunCmdJob, one per stage.
+            pipe    : _PipeData reading the output of the last stage, and the stderr of all.
+            wakeup  : _WakeupEvent set whenever a stage exits or the pipe fails.
+            deadline: monotonic time after which the pipeline is terminated. None waits
+                      indefinitely.
+        """
+        processes = []
+        result = self.result
+        self._hook_error = None
+        try:
+            result.start_time = _monotonic()
+            next_stdin = pipe.stdin_fd
+            try:
+                for i, job in enumerate(jobs):
+                    stdin_fd = next_stdin
+                    next_stdin = None
+                    if i == len(jobs) - 1:
+                        out_fd, err_fd = pipe.in_fd, pipe.err_fd
+                    else:
+                        next_stdin, out_fd = _pipe()
+                        # stderr must not go down the pipeline with the output.
+                        err_fd = pipe.in_fd if pipe.err_fd is None else pipe.err_fd
+                    try:
+                        self._fire(RunCmd.HOOK_PRE_SPAWN, job.cmd)
+                        p = _spawn(job.cmd, job.shell, job.cwd, out_fd, err_fd, stdin_fd,
+                                   self.spawn_server, job.env)
+                    finally:
+                        # the stages hold their own copies of the pipes between them.
+                        if out_fd != pipe.in_fd:
+                            os.close(out_fd)
+                        if i > 0:
+                            os.close(stdin_fd)
+                    self._fire(RunCmd.HOOK_SPAWN, p.pid)
+                    watcher = _ExitWatcher(p, wakeup)
+                    watcher.start()
+                    processes.append((p, watcher))
+            finally:
+                if next_stdin is not None:
+                    os.close(next_stdin)
+
+            is_timeout = False
+            is_pipe_error = False
+            while True:
+                # every stage sets the event on exit, hence it is cleared before checking them.
+                wakeup.clear()
+                is_pipe_error = pipe.is_error
+                if is_pipe_error or all(watcher.is_exited for _, watcher in processes):
+                    break
+                remaining = None if deadline is None else deadline - _monotonic()
+                if remaining is not None and remaining <= 0:
+                    is_timeout = True
+                    break
+                wakeup.wait(remaining)
+
+            if is_pipe_error:
+                result.is_killed = True
+                result.error_msg = pipe.error_msg
+                self._terminate_many(processes)
+                raise RunCmdInternalError(pipe.error_msg)
+            elif is_timeout:
+                self.return_code = RunCmd.TIMEOUT_ERR
+                result.is_timeout = result.is_killed = True
+                self._fire(RunCmd.HOOK_TIMEOUT, processes[0][0].pid)
+                self._terminate_many(processes)
+            else:
+                self.return_code = processes[-1][0].returncode
+
+        except (WindowsError, OSError):
+            self.return_code = RunCmd.INVALID_INPUT_ERR
+            result.error_msg = traceback.format_exc()
+            result.is_killed = bool(processes)
+            self._terminate_many(processes)
+            raise RunCmdInvalidInputError(result.error_msg)
+
+        except KeyboardInterrupt:
+            self.return_code = RunCmd.INTERRUPT_ERR
+            result.is_killed = True
+            self._terminate_many(processes)
+            raise RunCmdInterruptError(self.cmd, traceback.format_exc())
+
+        finally:
+            result.end_time = _monotonic()
+            rusages = [watcher.rusage for _, watcher in processes if watcher.rusage is not None]
+            if rusages:
+                result.set_rusage(_Rusage(sum(r.ru_utime for r in rusages),
+                                          sum(r.ru_stime for r in rusages),
+                                          max(r.ru_maxrss for r in rusages)))
+            for i, (p, watcher) in enumerate(processes):
+                if watcher.is_exited:
+                    self.return_codes[i] = p.returncode
+                    self._fire(RunCmd.HOOK_REAP, p.returncode, watcher.exit_time)
+        self._check_hooks()
+
+    def _fire(self, event, value, timestamp=None):
+        """ Invoke the callbacks registered for event, if any. The first exception raised by a
+        callback is kept for _check_hooks(), so the command is still serviced.
+
+        Args:
+            event    : One of RunCmd.HOOK_EVENTS.
+            value    : Value passed to the callbacks. See add_hook().
+            timestamp: Monotonic time at which the event occurred. Defaults to now.
+        """
+        try:
+            self._invoke(event, value, timestamp)
+        except Exception:
+            if self._hook_error is None:
+                self._hook_error = traceback.format_exc()
+
+    def _invoke(self, event, value, timestamp=None):
+        """ Invoke the callbacks registered for event, if any, letting their exceptions through.
+        See _fire().
+        """
+        callbacks = self._hooks.get(event)
+        if callbacks:
+            if timestamp is None:
+                timestamp = _monotonic()
+            for callback in callbacks:
+                callback(event, timestamp, value)
+
+    def _check_hooks(self):
+        """ Raise the exception of a hook which failed while the command ran, if any.
+
+        Exceptions:
+            RunCmdInternalError : A hook raised an exception.
+        """
+        if self._hook_error is not None:
+            self.result.error_msg, self._hook_error = self._hook_error, None
+            raise RunCmdInternalError(self.result.error_msg)
+
+    def _get_read_hook(self):
+        """ Returns the callable to invoke for every chunk of output read, or None if no hook
+        needs to know about the output.
+        """
+        if RunCmd.HOOK_FIRST_OUTPUT in self._hooks or RunCmd.HOOK_OUTPUT in self._hooks:
+            return self._on_read
+        return None
+
+    def _on_read(self, prev_bytes, total_bytes):
+        """ Fire the output hooks for a chunk of output. See _PipeData.
+        """
+        if prev_bytes == 0:
+            self._invoke(RunCmd.HOOK_FIRST_OUTPUT, total_bytes)
+        interval = self.OUTPUT_HOOK_INTERVAL
+        if total_bytes // interval > prev_bytes // interval:
+            self._invoke(RunCmd.HOOK_OUTPUT, total_bytes)
+
+    def _terminate(self, p, watcher):
+        """ Kill the process, firing the kill hooks around it. See _kill().
+        """
+        if p is None:
+            return
+        self._terminate_many([(p, watcher)])
+
+    def _terminate_many(self, processes):
+        """ Kill the processes of a pipeline at once, firing the kill hooks around it with the
+        pid of the first one. See _kill_many().
+        """
+        if not processes:
+            return
+        pid = processes[0][0].pid
+        self._fire(RunCmd.HOOK_PRE_KILL, pid)
+        self.result.kill_signal = self._kill_many(processes, self.kill_grace_period,
+                                                  self.reap_timeout)
+        self._fire(RunCmd.HOOK_POST_KILL, pid)
+
+    @staticmethod
+    def _kill(p, watcher=None, grace_period=None, reap_timeout=None):
+        """ Terminate the process group of the process, and reap the process.
+
+        SIGTERM is sent first. If the group has not exited after grace_period seconds, SIGKILL
+        is sent. The call returns at most grace_period + reap_timeout seconds after it was
+        made, even if the process could not be reaped, e.g. as it is stuck in the kernel.
+
+        Args:
+            p           : sub-process to be killed.
+            watcher     : _ExitWatcher reaping p, if one was started.
+            grace_period: seconds to wait after SIGTERM. Defaults to KILL_GRACE_PERIOD.
+            reap_timeout: seconds to wait after SIGKILL. Defaults to REAP_TIMEOUT.
+        Returns:
+            The signal which ended the process group, signal.SIGTERM or signal.SIGKILL. None
+            if the process was not running, if it had not exited by the time the call returned,
+            or under Windows.
+        """
+        if p is None:
+            return None
+        return RunCmd._kill_many([(p, watcher)], grace_period, reap_timeout)
+
+    @staticmethod
+    def _kill_many(processes, grace_period=None, reap_timeout=None):
+        """ Terminate the process groups of several processes at once, and reap the processes.
+        Every group is signalled before waiting on any of them. See _kill().
+
+        Args:
+            processes   : list of tuples of (process, _ExitWatcher reaping it or None).
+            grace_period: seconds to wait after SIGTERM. Defaults to KILL_GRACE_PERIOD.
+            reap_timeout: seconds to wait after SIGKILL. Defaults to REAP_TIMEOUT.
+        Returns:
+            The signal which ended the last of the process groups, or None. See _kill().
+        """
+        running = []
+        for p, watcher in processes:
+            if watcher is not None:
+                is_exited = (lambda w: lambda: w.is_exited)(watcher)
+            else:
+                is_exited = (lambda p: lambda: _reap(p, block=False)[0])(p)
+            if not is_exited():
+                running.append((p.pid, is_exited))
+        if not running:
+            return None
+
+        # Popen.kill() does not kill processes in Windows, only attempts to terminate it,
+        # hence we need to kill process here.
+        if sys.platform == 'win32':
+            for pid, _ in running:
+                k = subprocess.Popen('TASKKILL /PID {} /T /F >NUL 2>&1'.format(pid), shell=True)
+                k.communicate()
+            return None
+
+        grace_period = RunCmd.KILL_GRACE_PERIOD if grace_period is None else grace_period
+        reap_timeout = RunCmd.REAP_TIMEOUT if reap_timeout is None else reap_timeout
+        for sig, wait_time in ((signal.SIGTERM, grace_period), (signal.SIGKILL, reap_timeout)):
+            for pid, _ in running:
+                _signal_group(pid, sig)
+                if sig == signal.SIGTERM:
+                    # let stopped processes handle SIGTERM.
+                    _signal_group(pid, signal.SIGCONT)
+            deadline = _monotonic() + wait_time
+            running = [(pid, is_exited) for pid, is_exited in running
+                       if not _wait_group_exit(pid, is_exited, deadline)]
+            if not running:
+                return sig
+        return None
+
+
+class _SessionStream(object):
+    """ An output stream of RunCmdSession's shell, split into the output of each command.
+
+    The shell ends the output of every command with a line "<marker> R <return code>". The
+    stdout of a command also starts with a line "<marker> P <pid>".
+
+    Attributes:
+        fd : file descriptor of the read end of the stream.
+    """
+    def __init__(self, fd, marker):
+        """ Constructor
+        """
+        _set_nonblocking(fd)
+        self.fd = fd
+        self._file = io.FileIO(fd, 'rb')
+        self._view = memoryview(bytearray(_get_pipe_capacity(fd)))
+        self._buffer = bytearray()
+        self._start_marker = marker + ' P '
+        self._end_marker = marker + ' R '
+        self._start = 0
+        self._scanned = 0
+
+    def read(self):
+        """ Read everything buffered in the pipe.
+
+        Returns:
+            False once the stream reached EOF, otherwise True.
+        """
+        read_size = self._file.readinto(self._view)
+        while read_size:
+            self._buffer += self._view[:read_size]
+            read_size = self._file.readinto(self._view)
+        return read_size is None
+
+    def get_pid(self):
+        """ Returns the pid from the start of the command's stdout, or None if not read yet.
+        The pid is 0 if the shell could not tell it. Output left over from earlier commands,
+        e.g. by their background processes, is dropped.
+        """
+        value, end = self._find(self._start_marker, 0)
+        if value is None:
+            return None
+        self._start = self._scanned = end
+        return int(value) if value.isdigit() else 0
+
+    def get_output(self):
+        """ Returns a tuple of (return code, output) of the command once its end was read,
+        otherwise None. The stream then moves on to the next command.
+        """
+        value, end = self._find(self._end_marker, self._start)
+        if value is None:
+            # the marker may have been partly read; look at its start again next time.
+            self._scanned = max(self._start, len(self._buffer) - len(self._end_marker) - 32)
+            return None
+
+        output = str(self._buffer[self._start:end - len(value) - len(self._end_marker) - 1])
+        del self._buffer[:end]
+        self._start = self._scanned = 0
+        return int(value), output
+
+    def get_partial_output(self):
+        """ Returns the output of the command read so far, and drops it.
+        """
+        output = str(self._buffer[self._start:])
+        del self._buffer[:]
+        self._start = self._scanned = 0
+        return output
+
+    def close(self):
+        self._file.close()
+
+    def _find(self, marker, start):
+        """ Returns a tuple of (value, end) of the first complete "<marker><value>\\n" line
+        after start, where end is the index after the line, or (None, None).
+        """
+        i = self._buffer.find(marker, max(start, self._scanned))
+        if i < 0:
+            return None, None
+        j = self._buffer.find('\n', i)
+        if j < 0:
+            return None, None
+        return str(self._buffer[i + len(marker):j]), j + 1
+
+
+class RunCmdSession(object):
+    """ Runs successive shell commands through one long-lived shell, instead of starting a new
+    shell for each.
+
+    For example:
+        with RunCmdSession() as session:
+            for f in files:
+                ret, out = session.run(['gzip', '-t', f], timeout=10)
+
+    Each command runs in a background job of the shell, hence in a subshell: a "cd" or
+    "export" does not carry over to the next command, just like with RunCmd.run(). The shell
+    must support job control without a terminal, which bash does, so each job gets its own
+    process group. On timeout, only the job's process group is terminated, escalating from
+    SIGTERM to SIGKILL as RunCmd does. The shell is restarted if the job still has not finished
+    reap_timeout seconds after SIGKILL, or if the shell has no job control. The commands' stdin
+    is /dev/null. A session is not thread-safe. Only supported under POSIX platforms.
+
+    Attributes:
+        return_code : The return code of the last command, or one of RunCmd's error return
+                      codes.
+        cmd         : The last command used.
+        shell       : Path of the shell.
+        pid         : Process id of the shell, or None if it is not running.
+        kill_grace_period : Seconds a command is given to exit after SIGTERM.
+        reap_timeout : Seconds to wait for a command to exit after SIGKILL.
+    """
+    SHELL = '/bin/bash'
+
+    def __init__(self, shell=None, kill_grace_period=None, reap_timeout=None):
+        """ Constructor. The shell is started by the first command.
+
+        Args:
+            shell: Path of the shell. Defaults to SHELL.
+            kill_grace_period: Seconds a command is given to exit after SIGTERM, before it is
+                            sent SIGKILL. Defaults to RunCmd.KILL_GRACE_PERIOD.
+            reap_timeout  : Seconds to wait for a command to exit after SIGKILL, before the
+                            shell is restarted. Defaults to RunCmd.REAP_TIMEOUT.
+        Exceptions:
+            RunCmdInvalidInputError : The platform is not supported.
+        """
+        if sys.platform == 'win32':
+            raise RunCmdInvalidInputError('Error: RunCmdSession is not supported under Windows.')
+
+        self.return_code = -1
+        self.cmd = ''
+        self.shell = shell or RunCmdSession.SHELL
+        self.pid = None
+        self.kill_grace_period = RunCmd.KILL_GRACE_PERIOD if kill_grace_period is None \
+            else kill_grace_period
+        self.reap_timeout = RunCmd.REAP_TIMEOUT if reap_timeout is None else reap_timeout
+        self._marker = '__RUNCMD_{}__'.format(binascii.hexlify(os.urandom(8)))
+        self._p = None
+        self._job_pid = None
+        self._stdin_fd = None
+        self._out = None
+        self._err = None
+        self._poller = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def run(self, cmd, timeout=0, shell=False, cwd=None, split_stderr=False):
+        """ Runs the command in the session's shell and return the return code and output.
+
+        Args:
+            cmd     : Command to run.
+            timeout : Seconds to wait before terminating command. Timeout must be a positive
+                      number and may be a fraction of a second. If timeout <= 0, the session
+                      will wait indefinitely. Defaults to 0.
+            shell   : If True, cmd is a shell command line. Otherwise cmd is a program and its
+                      arguments, which are quoted for the shell. Defaults to False, as with
+                      RunCmd.run().
+            cwd:    : Directory to run command in. If none is given the command will be run in
+                      the current directory. Default is None.
+            split_stderr: If True, capture stderr separately from stdout. Defaults to False.
+        Returns:
+            A tuple of (returncode, out), or (returncode, out, err) if split_stderr is True.
+            See RunCmd.run().
+
+        Exceptions:
+            RunCmdInvalidInputError : Command had invalid parameters, or without shell, its
+                                      program was not found.
+            RunCmdInternalError     : The shell exited unexpectedly.
+            RunCmdInterruptError    : Command was interrupted, e.g. a Keyboard interrupt signal.
+        """
+        self.cmd = cmd
+
+        # if no command was sent in, consider it successful and return.
+        if cmd is None or len(cmd) == 0:
+            self.return_code = 0
+            return (0, '', '') if split_stderr else (0, '')
+
+        if cwd is not None and not os.path.isdir(cwd):
+            raise RunCmdInvalidInputError('Error: cwd {} is not a directory.'.format(cwd))
+
+        if isinstance(cmd, basestring):
+            cmd = [cmd]
+        if not shell and not _is_program(cmd[0], cwd):
+            self.return_code = RunCmd.INVALID_INPUT_ERR
+            raise RunCmdInvalidInputError('Error: program {!r} not found.'.format(cmd[0]))
+        cmd = ' '.join(cmd if shell else [pipes.quote(arg) for arg in cmd])
+        if cwd is not None:
+            cmd = 'cd -- {} && {}'.format(pipes.quote(cwd), cmd)
+
+        timeout = float(timeout)
+        deadline = _monotonic() + timeout if timeout > 0 else None
+        if self._p is None:
+            self._start()
+
+        # eval keeps a syntax error in the command from breaking the framing.
+        script = ('{{ printf "%s P %s\\n" {marker} "$BASHPID"; eval {cmd}; }} '
+                  '</dev/null {redirect}&\n'
+                  'wait $!\n'
+                  'rc=$?\n'
+                  'printf "%s R %d\\n" {marker} $rc >&2\n'
+                  'printf "%s R %d\\n" {marker} $rc\n').format(
+                      marker=self._marker, cmd=pipes.quote(cmd),
+                      redirect='' if split_stderr else '2>&1 ')
+        try:
+            view = memoryview(script)
+            while view:
+                view = view[os.write(self._stdin_fd, view):]
+            return_code, out, err = self._collect(deadline)
+        except KeyboardInterrupt:
+            self.return_code = RunCmd.INTERRUPT_ERR
+            self._stop(self._job_pid)
+            raise RunCmdInterruptError(self.cmd, traceback.format_exc())
+        except OSError:
+            self._stop(self._job_pid)
+            raise RunCmdInternalError('Error: the session shell exited unexpectedly.\n' +
+                                      traceback.format_exc())
+
+        self.return_code = return_code
+        if split_stderr:
+            return return_code, out, err
+        return return_code, out
+
+    def close(self):
+        """ Stop the shell. It is started again by the next command.
+        """
+        if self._p is not None:
+            os.close(self._stdin_fd)
+            self._p.wait()
+            self._close()
+
+    def _start(self):
+        """ Start the shell, with job control so each job has a process group of its own.
+        """
+        pipes_ = [_pipe() for _ in range(3)]
+        try:
+            self._p = _spawn([self.shell], False, None, pipes_[1][1], pipes_[2][1], pipes_[0][0])
+        except OSError:
+            for r, w in pipes_:
+                os.close(r)
+                os.close(w)
+            raise RunCmdInvalidInputError(traceback.format_exc())
+
+        for fd in (pipes_[0][0], pipes_[1][1], pipes_[2][1]):
+            os.close(fd)
+        self.pid = self._p.pid
+        self._stdin_fd = pipes_[0][1]
+        self._out = _SessionStream(pipes_[1][0], self._marker)
+        self._err = _SessionStream(pipes_[2][0], self._marker)
+        self._poller = _Poller()
+        self._poller.register(self._out.fd)
+        self._poller.register(self._err.fd)
+        self._job_pid = None
+        os.write(self._stdin_fd, 'set -m 2>/dev/null\n')
+
+    def _collect(self, deadline):
+        """ Read the output of the command until it finishes, terminating it at the deadline.
+
+        Returns:
+            A tuple of (return code, stdout, stderr).
+        """
+        self._job_pid = None
+        out_result = err_result = None
+        is_timeout = is_killed = False
+        kill_deadline = None
+        while out_result is None or err_result is None:
+            now = _monotonic()
+            if kill_deadline is not None and now >= kill_deadline:
+                # the job would not die; start over with a new shell.
+                if is_killed or not self._kill_job(signal.SIGKILL):
+                    break
+                is_killed = True
+                kill_deadline = now + self.reap_timeout
+            if kill_deadline is None and deadline is not None and now >= deadline:
+                is_timeout = True
+                if not self._kill_job(signal.SIGTERM):
+                    break
+                kill_deadline = now + self.kill_grace_period
+
+            wait_until = kill_deadline if kill_deadline is not None else deadline
+            for fd in self._poller.poll(None if wait_until is None else max(0, wait_until - now)):
+                stream = self._out if fd == self._out.fd else self._err
+                if not stream.read():
+                    raise OSError(errno.EPIPE, 'The shell closed its output.')
+
+            if self._job_pid is None:
+                self._job_pid = self._out.get_pid()
+            if self._job_pid is not None and out_result is None:
+                out_result = self._out.get_output()
+            if err_result is None:
+                err_result = self._err.get_output()
+
+        if out_result is None or err_result is None:
+            out = out_result[1] if out_result else self._out.get_partial_output()
+            err = err_result[1] if err_result else self._err.get_partial_output()
+            self._stop(self._job_pid)
+            return RunCmd.TIMEOUT_ERR, out, err
+
+        return_code = RunCmd.TIMEOUT_ERR if is_timeout else out_result[0]
+        return return_code, out_result[1], err_result[1]
+
+    def _kill_job(self, sig):
+        """ Send a signal to the process group of the running job.
+
+        Returns:
+            False if the job has no process group of its own, so the shell must be restarted.
+        """
+        if not self._job_pid:
+            return False
+        try:
+            if os.getpgid(self._job_pid) != self._job_pid:
+                return False
+            os.killpg(self._job_pid, sig)
+        except OSError as e:
+            # the job has just exited.
+            if e.errno != errno.ESRCH:
+                raise
+        return True
+
+    def _stop(self, job_pid=None):
+        """ Kill the shell, and the job's process group if given.
+        """
+        if self._p is None:
+            return
+        for pgid in (job_pid, self._p.pid):
+            if pgid:
+                try:
+                    os.killpg(pgid, signal.SIGKILL)
+                except OSError:
+                    pass
+        os.close(self._stdin_fd)
+        self._p.wait()
+        self._close()
+
+    def _close(self):
+        self._out.close()
+        self._err.close()
+        self._poller.close()
+        self._p = None
+        self.pid = None
+
+
+class RunCmdJob(object):
+    """ A command to be run by RunCmdPool, along with its own settings.
+
+    Attributes:
+        cmd     : Command to run.
+        timeout : Seconds to wait before terminating command. If timeout <= 0, the command may
+                  run indefinitely.
+        shell   : Boolean to indicate if the shell should be invoked or not.
+        cwd     : Directory to run command in. None runs it in the current directory.
+        idle_timeout : Seconds the command may go without producing any output before it is
+                  terminated. If idle_timeout <= 0, the command may stay silent indefinitely.
+        patterns: Dictionary of patterns to look for in the output, and their actions, or None.
+                  See RunCmd.run_fd().
+        env     : Dictionary of the environment of the command. None inherits the environment
+                  of the caller.
+    """
+    def __init__(self, cmd, timeout=0, shell=False, cwd=None, idle_timeout=0, patterns=None,
+                 env=None):
+        """ Constructor
+        """
+        self.cmd = cmd
+        self.timeout = float(timeout)
+        self.shell = shell
+        self.cwd = cwd
+        self.idle_timeout = float(idle_timeout)
+        self.patterns = patterns
+        self.env = env
+
+
+class RunCmdResult(object):
+    """ The outcome of running a command, and the resources it used.
+
+    The resource usage is collected when the command is reaped, using wait4() under POSIX. It
+    covers the command and the descendants it waited for; descendants left running when the
+    command exited are not included. It is not available under Windows.
+
+    Attributes:
+        cmd         : The command used.
+        job         : The RunCmdJob which was run.
+        return_code : The return code of the command, or one of RunCmd's error return codes.
+        output      : The output of the command, if it was captured in memory, otherwise None.
+        error_msg   : Description of the error if the command could not be run, otherwise None.
+        start_time  : Monotonic time at which the command was started.
+        end_time    : Monotonic time at which the command finished.
+        first_output_time : Monotonic time at which the first byte of output was read, or
+                      None if there was no output or it was not read by RunCmd.
+        output_bytes: Number of bytes of output, including stderr.
+        user_time   : Seconds of CPU time spent in user mode, or None if unknown.
+        system_time : Seconds of CPU time spent in the kernel, or None if unknown.
+        max_rss     : Peak resident set size, as reported by getrusage() (KB under Linux), or
+                      None if unknown.
+        is_timeout  : True if the command was terminated for exceeding its timeout.
+        is_idle_timeout : True if the command was terminated for exceeding its idle timeout.
+        kill_pattern: The pattern found in the output which got the command terminated, or None.
+        sink_errors : Messages of the sinks given to run_fd() which failed, while the others
+                      carried on receiving the output.
+        queue_stats : Dictionary of the metrics of run_fd()'s write_queue, or None if it was
+                      not used: 'depth', the number of chunks still queued when the command
+                      finished, 'max_depth', the largest number of chunks queued at once,
+                      'dropped_bytes' and 'spilled_bytes', the number of bytes dropped or
+                      moved to a temporary file when the queue was full, and 'wait_time', the
+                      seconds spent waiting for room in the queue.
+        is_killed   : True if RunCmd had to kill the command, e.g. on timeout or interrupt.
+        kill_signal : The signal which ended the killed command, signal.SIGTERM or
+                      signal.SIGKILL, or None if it was not killed or did not exit in time.
+        is_cached   : True if the result was replayed from RunCmd's cache rather than run. The
+                      resource usage is then unknown.
+        return_codes: List of the return codes of each stage of a pipeline run by
+                      RunCmd.run_pipeline(), None for a stage which did not exit, or None for
+                      a single command. The resource usage is the total of the stages, and
+                      max_rss that of the largest.
+    """
+    def __init__(self, job, return_code=-1, output=None, start_time=None, end_time=None,
+                 error_msg=None):
+        """ Constructor
+        """
+        self.cmd = job.cmd
+        self.job = job
+        self.return_code = return_code
+        self.output = output
+        self.error_msg = error_msg
+        self.start_time = _monotonic() if start_time is None else start_time
+        self.end_time = self.start_time if end_time is None else end_time
+        self.first_output_time = None
+        self.output_bytes = 0 if output is None else len(output)
+        self.user_time = None
+        self.system_time = None
+        self.max_rss = None
+        self.is_timeout = False
+        self.is_idle_timeout = False
+        self.kill_pattern = None
+        self.sink_errors = []
+        self.queue_stats = None
+        self.is_killed = False
+        self.kill_signal = None
+        self.is_cached = False
+        self.return_codes = None
+
+    @property
+    def elapsed(self):
+        """ Seconds taken to run the command.
+        """
+        return self.end_time - self.start_time
+
+    @property
+    def time_to_first_output(self):
+        """ Seconds from the start of the command until its first byte of output, or None.
+        """
+        if self.first_output_time is None:
+            return None
+        return self.first_output_time - self.start_time
+
+    @property
+    def throughput(self):
+        """ Bytes of output per second over the run time of the command.
+        """
+        return self.output_bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def set_rusage(self, rusage):
+        """ Record the resource usage returned by wait4(). None is ignored.
+        """
+        if rusage is not None:
+            self.user_time = rusage.ru_utime
+            self.system_time = rusage.ru_stime
+            self.max_rss = rusage.ru_maxrss
+
+
+class _PoolEntry(object):
+    """ A command started by RunCmdPool, and the state needed to collect its output.
+
+    Attributes:
+        fd             : file descriptor of the read end of the command's output pipe.
+        p              : Popen object of the command.
+        deadline       : monotonic time after which the command is terminated, or None.
+        is_timeout     : boolean indicating if the command was terminated for timing out.
+        is_idle_timeout: boolean indicating if the command was terminated for being silent.
+        is_interrupted : boolean indicating if the command was terminated by the caller.
+        first_output_time : monotonic time at which the first output was read, or None.
+        last_output_time : monotonic time at which output was last read, or the command was
+                         started.
+        kill_pattern   : the pattern found in the output which got the command terminated, or
+                         None.
+        rusage         : resource usage of the command once reaped, or None.
+        kill_signal    : the last signal sent to terminate the command, or None.
+        kill_deadline  : monotonic time after which the termination escalates, or None.
+        kill_grace_period : seconds the command is given to exit after SIGTERM.
+        reap_timeout   : seconds the command is given to exit after SIGKILL.
+    """
+    def __init__(self, job, spawn_server=None, kill_grace_period=None, reap_timeout=None):
+        """ Constructor. Starts the command.
+
+        Args:
+            job         : RunCmdJob to run.
+            spawn_server: RunCmdSpawnServer to start the command, or None.
+            kill_grace_period: seconds to wait after SIGTERM. Defaults to
+                          RunCmd.KILL_GRACE_PERIOD.
+            reap_timeout: seconds to wait after SIGKILL. Defaults to RunCmd.REAP_TIMEOUT.
+        """
+        self.job = job
+        self.p = None
+        self.is_timeout = False
+        self.is_idle_timeout = False
+        self.is_interrupted = False
+        self.start_time = _monotonic()
+        self.first_output_time = None
+        self.last_output_time = self.start_time
+        self.kill_pattern = None
+        self._matcher = _OutputMatcher(job.patterns) if job.patterns else None
+        self.rusage = None
+        self.kill_signal = None
+        self.kill_deadline = None
+        self.kill_grace_period = RunCmd.KILL_GRACE_PERIOD if kill_grace_period is None \
+            else kill_grace_period
+        self.reap_timeout = RunCmd.REAP_TIMEOUT if reap_timeout is None else reap_timeout
+        self.deadline = self.start_time + job.timeout if job.timeout > 0 else None
+        self._output = io.BytesIO()
+
+        r, w = _pipe()
+        try:
+            self.p = _spawn(job.cmd, job.shell, job.cwd, w, server=spawn_server, env=job.env)
+        except Exception:
+            os.close(r)
+            raise
+        finally:
+            os.close(w)
+
+        _set_nonblocking(r)
+        self.fd = r
+        self._out_file = io.FileIO(r, 'rb')
+
+    def read(self, view):
+        """ Read everything buffered in the output pipe.
+
+        Args:
+            view: memoryview of the buffer to read into.
+        Returns:
+            False once the output has reached EOF, otherwise True.
+        """
+        read_size = self._out_file.readinto(view)
+        if read_size:
+            self.last_output_time = _monotonic()
+            if self.first_output_time is None:
+                self.first_output_time = self.last_output_time
+        while read_size:
+            write_size = read_size
+            if self._matcher is not None:
+                write_size = min(read_size, self._matcher.feed(view[:read_size].tobytes()))
+            self._output.write(view[:write_size])
+            read_size = self._out_file.readinto(view)
+
+        if read_size == 0 and self._matcher is not None:
+            self._matcher.finish()
+        if self._matcher is not None and self._matcher.kill_pattern is not None and \
+                not self.is_killed:
+            self.kill_pattern = self._matcher.kill_pattern
+            self.kill()
+        return read_size is None
+
+    @property
+    def is_killed(self):
+        """ True once the command is being terminated.
+        """
+        return self.is_timeout or self.is_idle_timeout or self.is_interrupted or \
+            self.kill_pattern is not None
+
+    def get_deadline(self):
+        """ Returns the monotonic time at which the command must be checked on next, or None.
+        """
+        if self.is_killed:
+            return self.kill_deadline
+        deadline = self.deadline
+        if self.job.idle_timeout > 0:
+            idle_deadline = self.last_output_time + self.job.idle_timeout
+            deadline = idle_deadline if deadline is None else min(deadline, idle_deadline)
+        return deadline
+
+    def kill(self, is_timeout=False, is_idle_timeout=False, is_interrupted=False):
+        """ Terminate the command's process group without waiting for it to exit. See
+        escalate() for what happens if it does not.
+        """
+        self.is_timeout = self.is_timeout or is_timeout
+        self.is_idle_timeout = self.is_idle_timeout or is_idle_timeout
+        self.is_interrupted = self.is_interrupted or is_interrupted
+        if self.kill_signal is None:
+            self.kill_signal = signal.SIGTERM
+            self.kill_deadline = _monotonic() + self.kill_grace_period
+            _signal_group(self.p.pid, signal.SIGTERM)
+            _signal_group(self.p.pid, signal.SIGCONT)
+
+    def escalate(self):
+        """ Called once the command has not finished by kill_deadline. Sends SIGKILL after
+        kill_grace_period, and gives up reap_timeout later.
+
+        Returns:
+            False if the command should be given up on, otherwise True.
+        """
+        if self.kill_signal == signal.SIGTERM:
+            self.kill_signal = signal.SIGKILL
+            self.kill_deadline = _monotonic() + self.reap_timeout
+            _signal_group(self.p.pid, signal.SIGKILL)
+            return True
+
+        self.kill_signal = None
+        self.kill_deadline = None
+        return False
+
+    def close(self):
+        """ Close the output pipe.
+        """
+        self._out_file.close()
+
+    def get_result(self):
+        """ Returns the RunCmdResult of the finished command.
+        """
+        if self.is_interrupted:
+            return_code = RunCmd.INTERRUPT_ERR
+        elif self.is_timeout:
+            return_code = RunCmd.TIMEOUT_ERR
+        elif self.is_idle_timeout:
+            return_code = RunCmd.IDLE_TIMEOUT_ERR
+        elif self.kill_pattern is not None:
+            return_code = RunCmd.MATCH_KILL_ERR
+        else:
+            return_code = self.p.returncode
+        result = RunCmdResult(self.job, return_code, self._output.getvalue(), self.start_time,
+                              _monotonic())
+        result.first_output_time = self.first_output_time
+        result.is_timeout = self.is_timeout
+        result.is_idle_timeout = self.is_idle_timeout
+        result.kill_pattern = self.kill_pattern
+        result.is_killed = self.is_killed
+        result.kill_signal = self.kill_signal
+        result.set_rusage(self.rusage)
+        return result
+
+
+class _PoolLoop(object):
+    """ Starts commands for RunCmdPool and multiplexes their output with a single _Poller.
+
+    Attributes:
+        running : dictionary of the commands whose output is still open, keyed by the file
+                  descriptor of their output pipe.
+        exiting : list of the commands whose output reached EOF, but which have not exited yet.
+        abandoned : list of the commands given up on after SIGKILL, which are reaped once they
+                  exit so they do not linger as zombies.
+    """
+    def __init__(self, spawn_server=None, kill_grace_period=None, reap_timeout=None):
+        """ Constructor
+
+        Args:
+            spawn_server: RunCmdSpawnServer to start the commands, or None.
+            kill_grace_period: seconds a command is given to exit after SIGTERM, or None for
+                          RunCmd.KILL_GRACE_PERIOD.
+            reap_timeout: seconds a command is given to exit after SIGKILL, or None for
+                          RunCmd.REAP_TIMEOUT.
+        """
+        self._spawn_server = spawn_server
+        self._kill_grace_period = kill_grace_period
+        self._reap_timeout = reap_timeout
+        self.running = {}
+        self.exiting = []
+        self.abandoned = []
+        self._poller = _Poller()
+        self._view = memoryview(bytearray(RunCmdPool.CHUNK_SIZE))
+
+    def __len__(self):
+        return len(self.running) + len(self.exiting)
+
+    def start(self, job):
+        """ Start a command.
+
+        Args:
+            job: RunCmdJob to run.
+        Returns:
+            The _PoolEntry of the command, or a RunCmdResult with a return_code of
+            RunCmd.INVALID_INPUT_ERR if the command could not be started.
+        """
+        try:
+            entry = _PoolEntry(job, self._spawn_server, self._kill_grace_period,
+                               self._reap_timeout)
+        except (OSError, ValueError, RunCmdInvalidInputError):
+            now = _monotonic()
+            return RunCmdResult(job, RunCmd.INVALID_INPUT_ERR, '', now, now,
+                                traceback.format_exc())
+
+        self.running[entry.fd] = entry
+        self._poller.register(entry.fd)
+        return entry
+
+    def watch(self, fd):
+        """ Also wake up when fd becomes readable, e.g. to notice new work. The caller is
+        responsible for reading fd.
+        """
+        self._poller.register(fd)
+
+    def step(self, max_wait=None):
+        """ Wait until a command has output, exits or times out, then process it.
+
+        Args:
+            max_wait: maximum number of seconds to wait. None waits until something happens.
+        Returns:
+            A list of the _PoolEntry objects of the commands which finished.
+        """
+        wait_time = self._get_wait_time()
+        if max_wait is not None:
+            wait_time = max_wait if wait_time is None else min(wait_time, max_wait)
+
+        for fd in self._poller.poll(wait_time):
+            entry = self.running.get(fd)
+            if entry is not None and not entry.read(self._view):
+                self._poller.unregister(fd)
+                del self.running[fd]
+                entry.close()
+                self.exiting.append(entry)
+
+        now = _monotonic()
+        finished = []
+        for entry in self.running.values() + self.exiting:
+            deadline = entry.get_deadline()
+            if deadline is None or now < deadline:
+                continue
+            if not entry.is_killed:
+                if entry.deadline is not None and now >= entry.deadline:
+                    entry.kill(is_timeout=True)
+                else:
+                    entry.kill(is_idle_timeout=True)
+            elif not entry.escalate():
+                # stuck, or its output is held open by processes which left its group.
+                self._remove(entry)
+                finished.append(entry)
+                if entry.p.returncode is None:
+                    self.abandoned.append(entry)
+
+        self._reap_abandoned()
+        for entry in self.exiting:
+            is_exited, entry.rusage = _reap(entry.p, block=False)
+            if is_exited:
+                finished.append(entry)
+        for entry in finished:
+            if entry in self.exiting:
+                self.exiting.remove(entry)
+        return finished
+
+    def _remove(self, entry):
+        """ Stop tracking a command, closing its output pipe if it is still open.
+        """
+        if entry.fd in self.running:
+            self._poller.unregister(entry.fd)
+            del self.running[entry.fd]
+            entry.close()
+        else:
+            self.exiting.remove(entry)
+
+    def _reap_abandoned(self):
+        """ Reap the commands given up on which have exited since.
+        """
+        for entry in self.abandoned[:]:
+            if _reap(entry.p, block=False)[0]:
+                self.abandoned.remove(entry)
+
+    def close(self):
+        """ Kill the commands which are still running, and release the poller. Every command is
+        signalled before waiting on any, hence this takes at most kill_grace_period +
+        reap_timeout, however many commands are running.
+        """
+        entries = self.running.values() + self.exiting
+        RunCmd._kill_many([(entry.p, None) for entry in entries], self._kill_grace_period,
+                          self._reap_timeout)
+        for entry in self.running.values():
+            entry.close()
+        self.running.clear()
+        del self.exiting[:]
+        self._reap_abandoned()
+        self._poller.close()
+
+    def _get_wait_time(self):
+        """ Returns the number of seconds the loop may wait for output, or None to wait
+        indefinitely.
+        """
+        wait_time = RunCmdPool.REAP_INTERVAL if self.exiting else None
+        now = _monotonic()
+        for entry in self.running.values() + self.exiting:
+            deadline = entry.get_deadline()
+            if deadline is not None:
+                remaining = max(0, deadline - now)
+                wait_time = remaining if wait_time is None else min(wait_time, remaining)
+        return wait_time
+
+
+class RunCmdFuture(object):
+    """ The pending result of a command submitted to RunCmdPool.submit().
+
+    Attributes:
+        job : the RunCmdJob being run.
+    """
+    def __init__(self, pool, job):
+        """ Constructor
+        """
+        self.job = job
+        self._pool = pool
+        self._result = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.is_cancel_requested = False
+
+    def done(self):
+        """ Returns True if the command has finished.
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Block until the command has finished or the timeout expires.
+
+        Args:
+            timeout: Seconds to wait. None waits indefinitely.
+        Returns:
+            True if the command has finished.
+        """
+        return self._done.wait(timeout)
+
+    def result(self):
+        """ Block until the command has finished and return its RunCmdResult.
+        """
+        self._done.wait()
+        return self._result
+
+    def cancel(self):
+        """ Terminate the command's process group, or prevent it from starting if it has not
+        started yet. The result then has a return_code of RunCmd.INTERRUPT_ERR.
+
+        Returns:
+            False if the command had already finished, otherwise True.
+        """
+        if self.done():
+            return False
+        self._pool._cancel(self)
+        return True
+
+    def add_done_callback(self, fn):
+        """ Call fn with this future once the command finishes.
+
+        The callback is called from the pool's thread, hence it must not block. To resume an
+        asynchronous framework's coroutine, hand the result over to the framework's loop,
+        e.g. using asyncio's loop.call_soon_threadsafe(). If the command has already
+        finished, fn is called immediately.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set_result(self, result):
+        """ Mark the command as finished and run the callbacks.
+        """
+        with self._lock:
+            self._result = result
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+
+
+class RunCmdPool(object):
+    """ Runs many commands concurrently, keeping at most max_running of them running at a time.
+
+    A single loop multiplexes the output of every running command, hence no thread is created
+    per command. Commands can be run in batches, with the loop running in the caller's thread:
+        pool = RunCmdPool(max_running=16)
+        jobs = [RunCmdJob('ping -c 1 host{}'.format(i), timeout=5, shell=True)
+                for i in range(1000)]
+        for result in pool.run_many(jobs):
+            print result.cmd, result.return_code, result.elapsed
+
+    Or submitted one at a time, with the loop running in a single background thread:
+        with RunCmdPool(max_running=16) as pool:
+            future = pool.submit(RunCmdJob('ping -c 1 host', timeout=5, shell=True))
+            print future.result().return_code
+
+    Like RunCmd, the output of each command has its stderr merged into its stdout. Commands
+    which exceed their timeout have their process group terminated. RunCmdPool is only
+    supported under POSIX platforms.
+
+    Attributes:
+        max_running : maximum number of commands running at the same time, per call to
+                      run_many() and for submit() respectively.
+        spawn_server: RunCmdSpawnServer starting the commands, or None.
+        kill_grace_period : Seconds a command is given to exit after SIGTERM.
+        reap_timeout : Seconds to wait for a command to exit after SIGKILL.
+    """
+    # Seconds between checks for commands which closed their output but have not exited yet.
+    REAP_INTERVAL = 0.01
+    # Number of bytes to read from a command's output at a time. The buffer is shared by every
+    # command.
+    CHUNK_SIZE = 65536
+
+    def __init__(self, max_running=8, spawn_server=None, kill_grace_period=None,
+                 reap_timeout=None):
+        """ Constructor
+
+        Args:
+            max_running : maximum number of commands running at the same time. Defaults to 8.
+            spawn_server: RunCmdSpawnServer to start the commands, or None to start them
+                          directly. Defaults to None.
+            kill_grace_period: Seconds a command is given to exit after SIGTERM, before it is
+                          sent SIGKILL. Defaults to RunCmd.KILL_GRACE_PERIOD.
+            reap_timeout: Seconds to wait for a command to exit after SIGKILL, before it is
+                          given up on. Defaults to RunCmd.REAP_TIMEOUT.
+        Exceptions:
+            RunCmdInvalidInputError : max_running was not positive, or the platform is not
+                                      supported.
+        """
+        if sys.platform == 'win32':
+            raise RunCmdInvalidInputError('Error: RunCmdPool is not supported under Windows.')
+        if max_running <= 0:
+            raise RunCmdInvalidInputError('Error: max_running must be positive.')
+
+        self.max_running = max_running
+        self.spawn_server = spawn_server
+        self.kill_grace_period = RunCmd.KILL_GRACE_PERIOD if kill_grace_period is None \
+            else kill_grace_period
+        self.reap_timeout = RunCmd.REAP_TIMEOUT if reap_timeout is None else reap_timeout
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._cancelled = []
+        self._is_shutdown = False
+        self._thread = None
+        self._wakeup = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def run_many(self, jobs):
+        """ Run the commands and yield their results as they complete.
+
+        The commands are started in order as running commands complete. Commands which are not
+        yet consumed by the caller keep running, until their output fills the pipe. If the
+        caller stops iterating early, the commands still running are terminated.
+
+        Args:
+            jobs: iterable of RunCmdJob objects. A command on its own is run with the default
+                  settings of RunCmdJob.
+        Returns:
+            A generator of RunCmdResult objects, in order of completion. A command which could
+            not be started has a return_code of RunCmd.INVALID_INPUT_ERR and its error_msg set.
+        """
+        jobs = iter(jobs)
+        is_jobs_left = True
+        loop = _PoolLoop(self.spawn_server, self.kill_grace_period, self.reap_timeout)
+        try:
+            while True:
+                while is_jobs_left and len(loop) < self.max_running:
+                    try:
+                        job = next(jobs)
+                    except StopIteration:
+                        is_jobs_left = False
+                        break
+
+                    entry = loop.start(job if isinstance(job, RunCmdJob) else RunCmdJob(job))
+                    if isinstance(entry, RunCmdResult):
+                        yield entry
+
+                if not len(loop):
+                    break
+
+                for entry in loop.step():
+                    yield entry.get_result()
+        finally:
+            loop.close()
+
+    def submit(self, job):
+        """ Run the command in the pool's background thread.
+
+        The thread is started upon the first call, and serves every command submitted.
+
+        Args:
+            job: RunCmdJob to run. A command on its own is run with the default settings of
+                 RunCmdJob.
+        Returns:
+            A RunCmdFuture for the result of the command.
+        Exceptions:
+            RunCmdInvalidInputError : The pool has been shut down.
+        """
+        future = RunCmdFuture(self, job if isinstance(job, RunCmdJob) else RunCmdJob(job))
+        with self._lock:
+            if self._is_shutdown:
+                raise RunCmdInvalidInputError('Error: RunCmdPool has been shut down.')
+            self._pending.append(future)
+            if self._thread is None:
+                self._wakeup = _WakeupEvent()
+                self._thread = threading.Thread(target=self._serve)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def shutdown(self, wait=True):
+        """ Stop accepting commands. The commands already submitted still run.
+
+        Args:
+            wait: If True, block until every submitted command has finished.
+        """
+        with self._lock:
+            self._is_shutdown = True
+            thread = self._thread
+        if thread is not None:
+            self._wakeup.set()
+            if wait:
+                thread.join()
+
+    def _cancel(self, future):
+        """ Ask the background thread to cancel the command of future.
+        """
+        with self._lock:
+            future.is_cancel_requested = True
+            self._cancelled.append(future)
+        self._wakeup.set()
+
+    def _serve(self):
+        """ The loop of the background thread serving submit().
+        """
+        loop = _PoolLoop(self.spawn_server, self.kill_grace_period, self.reap_timeout)
+        loop.watch(self._wakeup.fileno())
+        futures = {}
+        try:
+            while True:
+                self._wakeup.clear()
+                # results are set once the lock is released, as done-callbacks may call
+                # submit() or cancel().
+                finished = []
+                with self._lock:
+                    cancelled, self._cancelled = set(self._cancelled), []
+                    while self._pending and len(loop) < self.max_running:
+                        future = self._pending.popleft()
+                        if future.is_cancel_requested:
+                            now = _monotonic()
+                            finished.append((future, RunCmdResult(future.job,
+                                                                  RunCmd.INTERRUPT_ERR, '', now,
+                                                                  now)))
+                            continue
+
+                        entry = loop.start(future.job)
+                        if isinstance(entry, RunCmdResult):
+                            finished.append((future, entry))
+                        else:
+                            futures[entry] = future
+                    is_done = self._is_shutdown and not self._pending and not len(loop)
+                    if is_done:
+                        self._thread = None
+
+                for future, result in finished:
+                    future._set_result(result)
+                if is_done:
+                    break
+
+                for entry, future in futures.items():
+                    if future in cancelled:
+                        entry.kill(is_interrupted=True)
+
+                for entry in loop.step():
+                    futures.pop(entry)._set_result(entry.get_result())
+        finally:
+            loop.close()
+            self._wakeup.close()
+
+
+def main():
+    """ Provides a command line interface to RunCmd.run(). The output is printed out to stdout.
+
+    Returns 0 if command was run successfully, otherwise an error had occurred.
+    """
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('-c', '--cmd',
+                      action='store',
+                      type='string',
+                      dest='cmd',
+                      help='Command to run. Must be enclosed in double quotes, '
+                           'e.g. -c"echo Hello"')
+
+    parser.add_option('-t', '--timeout',
+                      action='store',
+                      type='float',
+                      default=0,
+                      dest='timeout',
+                      help='Time in seconds to wait for the command to finish before forcibly '
+                           'terminating it. Defaults to 0 which makes it wait indefinitely.')
+
+    parser.add_option('-i', '--idle-timeout',
+                      action='store',
+                      type='float',
+                      default=0,
+                      dest='idle_timeout',
+                      help='Time in seconds the command may go without any output before it is '
+                           'forcibly terminated. Defaults to 0 which makes it wait indefinitely.')
 
     parser.add_option('-s', '--shell',
                       action='store_true',
@@ -417,7 +4941,8 @@ def main():
     return_code, out = cmd.run(options.cmd.strip('"'),
                                timeout=options.timeout,
                                shell=options.is_shell,
-                               cwd=options.dir)
+                               cwd=options.dir,
+                               idle_timeout=options.idle_timeout)
     print out
     return return_code
 
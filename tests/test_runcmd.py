@@ -31,13 +31,28 @@ import unittest
 import threading
 import os
 import sys
+import time
+import mmap
 import StringIO
+import hashlib
+import re
+import zlib
+import bz2
+import gzip
+import tempfile
+import shutil
+import select
 
 # add module's root folder as part of search path
 ROOT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
 sys.path.insert(0, ROOT_DIR)
 
 from runcmd import *
+from runcmd import _PipeData, _monotonic, _WakeupEvent, _OutputMatcher, \
+    _PoolLoop, _is_group_alive
+
+sys.path.insert(0, os.path.join(ROOT_DIR, 'util'))
+import generate_output
 
 # setup util file
 output_cmd = 'python ' + os.path.join(ROOT_DIR, 'util', 'generate_output.py') + ' %d %s %s'
@@ -125,6 +140,124 @@ class RunCmdTest(unittest.TestCase):
         cmd.run(test_cmds['sleep'] % (10), timeout=1, shell=True)
         self.assertEqual(cmd.return_code, RunCmd.TIMEOUT_ERR)
 
+    def test_subsecond_timeout(self):
+        """ A fractional timeout is honoured, measured from when the command starts.
+        """
+        cmd = RunCmd()
+        start = time.time()
+        cmd.run(test_cmds['sleep'] % (10), timeout=0.3, shell=True)
+        elapsed = time.time() - start
+        self.assertEqual(cmd.return_code, RunCmd.TIMEOUT_ERR)
+        self.assertTrue(0.3 <= elapsed < 1, elapsed)
+
+    def test_monotonic_threads(self):
+        """ The monotonic clock never goes backwards, even when read from several threads.
+        """
+        backwards = []
+
+        def read_clock():
+            last = _monotonic()
+            for _ in range(50000):
+                now = _monotonic()
+                if now < last:
+                    backwards.append(last - now)
+                last = now
+
+        threads = [threading.Thread(target=read_clock) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(backwards, [])
+
+    @unittest.skipIf(sys.platform == 'win32', 'RunCmdPool is only supported under POSIX')
+    def test_idle_timeout(self):
+        """ A command is terminated once it stops producing output, but not while it keeps
+        producing output.
+        """
+        silent = 'echo Hello; sleep 10'
+        chatty = 'for i in 1 2 3 4 5 6; do echo $i; sleep 0.1; done'
+
+        cmd = RunCmd()
+        ret, out = cmd.run(silent, shell=True, timeout=5, idle_timeout=0.3)
+        self.assertEqual(ret, RunCmd.IDLE_TIMEOUT_ERR)
+        self.assertEqual(out, 'Hello\n')
+        self.assertTrue(cmd.result.is_idle_timeout and not cmd.result.is_timeout)
+        self.assertTrue(0.3 <= cmd.result.elapsed < 1, cmd.result.elapsed)
+
+        ret, out = cmd.run(chatty, shell=True, idle_timeout=0.3)
+        self.assertEqual(ret, 0)
+        self.assertEqual(out.split(), ['1', '2', '3', '4', '5', '6'])
+
+        self.assertEqual(list(cmd.iter_output(silent, shell=True, idle_timeout=0.3)),
+                         ['Hello\n'])
+        self.assertEqual(cmd.return_code, RunCmd.IDLE_TIMEOUT_ERR)
+
+        jobs = [RunCmdJob(silent, shell=True, idle_timeout=0.3),
+                RunCmdJob(chatty, shell=True, idle_timeout=0.3)]
+        results = dict((r.cmd, r) for r in RunCmdPool(max_running=2).run_many(jobs))
+        self.assertEqual(results[silent].return_code, RunCmd.IDLE_TIMEOUT_ERR)
+        self.assertTrue(results[silent].elapsed < 1)
+        self.assertEqual(results[chatty].return_code, 0)
+
+    @unittest.skipIf(sys.platform == 'win32', 'RunCmdPool is only supported under POSIX')
+    def test_patterns(self):
+        """ Patterns are found in the output as it arrives, even across chunks, and their
+        actions are carried out.
+        """
+        found = []
+        patterns = {'FATAL': RunCmd.MATCH_KILL,
+                    re.compile(r'^warning: (\w+)$', re.M): lambda p, m: found.append(m)}
+        cmd = RunCmd(min_chunk_size=4, max_chunk_size=4)
+        start = time.time()
+        ret, out = cmd.run('echo warning: disk; echo "xx FATAL: no"; sleep 10', shell=True,
+                           timeout=5, patterns=patterns)
+        self.assertEqual(ret, RunCmd.MATCH_KILL_ERR)
+        self.assertEqual(out, 'warning: disk\nxx FATAL: no\n')
+        self.assertEqual(cmd.result.kill_pattern, 'FATAL')
+        self.assertEqual(found, ['warning: disk'])
+        self.assertTrue(time.time() - start < 2)
+
+        ret, out = cmd.run('echo one; echo --- two; echo three', shell=True,
+                           patterns={'---': RunCmd.MATCH_STOP_CAPTURE})
+        self.assertEqual((ret, out), (0, 'one\n---'))
+
+        self.assertRaises(RunCmdInvalidInputError, cmd.run, 'true', shell=True,
+                          patterns={'': RunCmd.MATCH_KILL})
+
+        job = RunCmdJob('echo FATAL; sleep 10', shell=True, patterns=patterns)
+        result = list(RunCmdPool(max_running=1).run_many([job]))[0]
+        self.assertEqual(result.return_code, RunCmd.MATCH_KILL_ERR)
+        self.assertTrue(result.elapsed < 2)
+
+    def test_overlapping_patterns(self):
+        """ Every literal is found at every position, whether it overlaps another match or not,
+        and however the output is split into chunks.
+        """
+        found = []
+        ret, out = RunCmd().run('echo "FATAL: x"; sleep 10', shell=True, timeout=5,
+                                patterns={'FATAL': lambda p, m: found.append(m),
+                                          'AL:': RunCmd.MATCH_KILL})
+        self.assertEqual(ret, RunCmd.MATCH_KILL_ERR)
+        self.assertEqual(found, ['FATAL'])
+
+        for chunks in [['aaa'], ['aa', 'a'], ['a', 'a', 'a'], ['a', 'aa']]:
+            found = []
+            matcher = _OutputMatcher({'aa': lambda p, m: found.append(m),
+                                      'a': lambda p, m: found.append(m)})
+            for chunk in chunks:
+                matcher.feed(chunk)
+            self.assertEqual(sorted(found), ['a', 'a', 'a', 'aa', 'aa'])
+
+    def test_fast_exit(self):
+        """ A command which exits immediately does not wait for a polling interval.
+        """
+        cmd = RunCmd()
+        start = time.time()
+        ret, out = cmd.run(test_cmds['echo'] % 'Hello', shell=True)
+        self.assertEqual(ret, 0)
+        self.assertTrue(time.time() - start < 0.25)
+
     def test_set_cwd(self):
         """ Change the current working directory using cwd
         """
@@ -246,6 +379,42 @@ class RunCmdTest(unittest.TestCase):
         self.assertEqual(cmd.return_code, 0)
         self.assertEqual(out, o)
 
+    def test_zero_copy(self):
+        """ With zero_copy, the command writes into a real file directly and the file object
+        keeps writing after the command's output.
+        """
+        out_path = os.path.join(ROOT_DIR, 'tests', 'tmp_zero_copy.txt')
+        try:
+            with open(out_path, 'wb') as f:
+                f.write('Start\n')
+                cmd = RunCmd()
+                cmd.run_fd(test_cmds['echo'] % 'Hello', f, shell=True, zero_copy=True)
+                f.write('End\n')
+
+            self.assertEqual(cmd.return_code, 0)
+            with open(out_path, 'rb') as f:
+                self.assertEqual(f.read().split(), ['Start', 'Hello', 'End'])
+        finally:
+            os.remove(out_path)
+
+    def test_chunk_size(self):
+        """ Output is unchanged while the chunk size grows between the configured limits.
+        """
+        cmd = RunCmd(min_chunk_size=16, max_chunk_size=4096)
+        ret, out = cmd.run(test_cmds['sim_log'] % (64, 'k', 0), shell=True)
+
+        p = subprocess.Popen(test_cmds['sim_log'] % (64, 'k', 0),
+                             shell=True,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        o = p.communicate()[0]
+
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, o)
+
+        self.assertRaises(RunCmdInvalidInputError, RunCmd, min_chunk_size=0)
+        self.assertRaises(RunCmdInvalidInputError, RunCmd, min_chunk_size=8, max_chunk_size=4)
+
     def test_invalid_input(self):
         """ Check command throws an exception when the command is invalid.
         For example, running a shell command with shell=False
@@ -259,10 +428,755 @@ class RunCmdTest(unittest.TestCase):
 
         self.assertTrue(False)
 
+    def test_pipe_data(self):
+        """ _PipeData forwards data as soon as it arrives and finishes promptly on stop.
+        """
+        f = StringIO.StringIO()
+        with _PipeData(f) as pipe:
+            os.write(pipe.in_fd, 'Hello')
+            start = time.time()
+            while not f.getvalue() and time.time() - start < 1:
+                time.sleep(0.001)
+            self.assertTrue(time.time() - start < 0.1)
+            os.write(pipe.in_fd, ' World')
+            start = time.time()
+
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertFalse(pipe.is_error)
+        self.assertEqual(f.getvalue(), 'Hello World')
+
+    @unittest.skipIf(sys.platform == 'win32', 'RunCmdPool requires POSIX')
+    def test_pool(self):
+        """ Run many commands with a concurrency limit, including one which times out and one
+        which cannot be started.
+        """
+        jobs = [RunCmdJob(test_cmds['echo'] % i, shell=True) for i in range(20)]
+        jobs.append(RunCmdJob(test_cmds['sleep'] % 10, timeout=0.5, shell=True))
+        jobs.append(test_cmds['echo'] % 'Hello')
+
+        pool = RunCmdPool(max_running=4)
+        results = dict((r.cmd, r) for r in pool.run_many(jobs))
+
+        self.assertEqual(len(results), 22)
+        for i in range(20):
+            result = results[test_cmds['echo'] % i]
+            self.assertEqual(result.return_code, 0)
+            self.assertEqual(result.output.strip(), str(i))
+            self.assertTrue(result.elapsed >= 0)
+
+        result = results[test_cmds['sleep'] % 10]
+        self.assertEqual(result.return_code, RunCmd.TIMEOUT_ERR)
+        self.assertTrue(0.5 <= result.elapsed < 2)
+
+        # a command on its own runs without the shell.
+        result = results[test_cmds['echo'] % 'Hello']
+        self.assertEqual(result.return_code, RunCmd.INVALID_INPUT_ERR)
+        self.assertTrue(result.error_msg)
+
+    @unittest.skipIf(sys.platform == 'win32', 'RunCmdPool requires POSIX')
+    def test_pool_submit(self):
+        """ Submit commands to the pool's background thread, and cancel one of them.
+        """
+        callback_results = []
+        with RunCmdPool(max_running=2) as pool:
+            futures = [pool.submit(RunCmdJob(test_cmds['echo'] % i, shell=True))
+                       for i in range(5)]
+            sleeper = pool.submit(RunCmdJob(test_cmds['sleep'] % 10, shell=True))
+            sleeper.add_done_callback(lambda f: callback_results.append(f.result()))
+
+            for i, future in enumerate(futures):
+                self.assertEqual(future.result().return_code, 0)
+                self.assertEqual(future.result().output.strip(), str(i))
+
+            self.assertFalse(sleeper.wait(0.2))
+            self.assertTrue(sleeper.cancel())
+            self.assertEqual(sleeper.result().return_code, RunCmd.INTERRUPT_ERR)
+            self.assertTrue(sleeper.result().elapsed < 5)
+            self.assertFalse(sleeper.cancel())
+
+        self.assertEqual(callback_results, [sleeper.result()])
+        self.assertRaises(RunCmdInvalidInputError, pool.submit, test_cmds['ls'])
+
+        # done-callbacks may submit more commands, also from commands which could not start
+        # or were cancelled before they started.
+        with RunCmdPool(max_running=1) as pool:
+            chained = []
+            blocker = pool.submit(RunCmdJob(test_cmds['sleep'] % 1, shell=True))
+            failed = pool.submit('/nonexistent/cmd')
+            cancelled = pool.submit(RunCmdJob(test_cmds['sleep'] % 10, shell=True))
+            for future in (failed, cancelled):
+                future.add_done_callback(
+                    lambda f: chained.append(pool.submit(RunCmdJob('echo chained', shell=True))))
+            self.assertTrue(cancelled.cancel())
+            self.assertEqual(blocker.result().return_code, 0)
+            self.assertEqual(failed.result().return_code, RunCmd.INVALID_INPUT_ERR)
+            self.assertEqual(cancelled.result().return_code, RunCmd.INTERRUPT_ERR)
+            start = time.time()
+            while len(chained) < 2 and time.time() - start < 5:
+                time.sleep(0.01)
+            self.assertEqual([f.result().output for f in chained], ['chained\n'] * 2)
+
+    @unittest.skipIf(sys.platform == 'win32', '_WakeupEvent uses a pipe only under POSIX')
+    def test_wakeup_event(self):
+        """ An event set by another thread while clear() drains the pipe stays set.
+        """
+        event = _WakeupEvent()
+        event.set()
+        setter = threading.Thread(target=event.set)
+        read = os.read
+
+        def read_and_set(fd, size):
+            os.read = read
+            setter.start()
+            setter.join(0.1)
+            return read(fd, size)
+
+        os.read = read_and_set
+        try:
+            event.clear()
+        finally:
+            os.read = read
+        setter.join()
+
+        self.assertTrue(event.is_set())
+        self.assertTrue(select.select([event.fileno()], [], [], 0)[0])
+        event.clear()
+        self.assertFalse(event.wait(0))
+
+    @unittest.skipIf(sys.platform == 'win32', 'iter_output requires POSIX')
+    def test_iter_output(self):
+        """ Iterate over the output line by line, time out while iterating, and stop early.
+        """
+        cmd = RunCmd()
+        out = list(cmd.iter_output(test_cmds['sim_log'] % (4, 'k', 0), shell=True, lines=True))
+
+        p = subprocess.Popen(test_cmds['sim_log'] % (4, 'k', 0),
+                             shell=True,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        o = p.communicate()[0]
+
+        self.assertEqual(cmd.return_code, 0)
+        self.assertEqual(out, o.splitlines(True))
+
+        out = list(cmd.iter_output(test_cmds['sleep'] % 10, timeout=0.3, shell=True))
+        self.assertEqual(out, [])
+        self.assertEqual(cmd.return_code, RunCmd.TIMEOUT_ERR)
+
+        output = cmd.iter_output(test_cmds['sim_log'] % (10, 'm', 0), shell=True)
+        self.assertTrue(next(output))
+        output.close()
+        self.assertEqual(cmd.return_code, RunCmd.INTERRUPT_ERR)
+
+    @unittest.skipIf(sys.platform == 'win32', 'split_stderr requires POSIX')
+    def test_split_stderr(self):
+        """ Capture stdout and stderr separately, and tagged in the order they were written.
+        """
+        script = 'echo out1; echo err1 1>&2; sleep 0.1; echo out2; echo err2 1>&2'
+        cmd = RunCmd()
+        ret, out, err = cmd.run(script, shell=True, split_stderr=True)
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, 'out1\nout2\n')
+        self.assertEqual(err, 'err1\nerr2\n')
+
+        out_file = StringIO.StringIO()
+        err_file = StringIO.StringIO()
+        cmd.run_fd(script, out_file, shell=True, err_file=err_file)
+        self.assertEqual(out_file.getvalue(), 'out1\nout2\n')
+        self.assertEqual(err_file.getvalue(), 'err1\nerr2\n')
+
+        tagged = list(cmd.iter_output(script, shell=True, lines=True, split_stderr=True))
+        self.assertEqual(sorted(tagged[:2]), [(RunCmd.STDOUT, 'out1\n'), (RunCmd.STDERR, 'err1\n')])
+        self.assertEqual(sorted(tagged[2:]), [(RunCmd.STDOUT, 'out2\n'), (RunCmd.STDERR, 'err2\n')])
+
+    @unittest.skipIf(sys.platform == 'win32', 'input requires POSIX')
+    def test_input(self):
+        """ Feed input to the command from a string, a file and an iterator.
+        """
+        cmd = RunCmd()
+        self.assertEqual(cmd.run('cat', input='Hello World'), (0, 'Hello World'))
+        self.assertEqual(cmd.run('cat', input=StringIO.StringIO('Hello World')),
+                         (0, 'Hello World'))
+
+        # more input than fits in the pipe, consumed while the output is read.
+        chunks = ('%d\n' % i for i in xrange(100000))
+        ret, out = cmd.run('cat', input=chunks)
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, ''.join('%d\n' % i for i in xrange(100000)))
+
+        # the command exits without reading all of its input.
+        ret, out = cmd.run('head -c 5', shell=True, input='x' * 1000000)
+        self.assertEqual((ret, out), (0, 'xxxxx'))
+
+        self.assertRaises(RunCmdInvalidInputError, cmd.run, 'cat', input=5)
+
+    def test_bounded_capture(self):
+        """ Keep only the head and tail of a large output, with the dropped bytes counted.
+        """
+        p = subprocess.Popen(test_cmds['sim_log'] % (1, 'm', 0),
+                             shell=True,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        o = p.communicate()[0]
+
+        cmd = RunCmd()
+        ret, out = cmd.run(test_cmds['sim_log'] % (1, 'm', 0), shell=True, capture_tail=100)
+        self.assertEqual(ret, 0)
+        self.assertEqual(out, o[-100:])
+        self.assertEqual(cmd.dropped_bytes, len(o) - 100)
+
+        ret, out = cmd.run(test_cmds['sim_log'] % (1, 'm', 0), shell=True,
+                           capture_head=50, capture_tail=100)
+        self.assertEqual(out, o[:50] + o[-100:])
+        self.assertEqual(cmd.dropped_bytes, len(o) - 150)
+
+        ret, out = cmd.run(test_cmds['echo'] % 'Hello', shell=True, capture_head=50)
+        self.assertEqual(out.strip(), 'Hello')
+        self.assertEqual(cmd.dropped_bytes, 0)
+
+        buff = BoundedBuffer(head=3, tail=4)
+        for data in ('ab', 'cdefg', 'hij', 'k'):
+            buff.write(data)
+        self.assertEqual(buff.getvalue(), 'abchijk')
+        self.assertEqual(buff.dropped_bytes, 4)
+
+    def test_spooled_capture(self):
+        """ Output beyond spool_size is moved to a file and returned as a memory map.
+        """
+        p = subprocess.Popen(test_cmds['sim_log'] % (1, 'm', 0),
+                             shell=True,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        o = p.communicate()[0]
+
+        cmd = RunCmd()
+        ret, out = cmd.run(test_cmds['sim_log'] % (1, 'm', 0), shell=True, spool_size=4096)
+        self.assertEqual(ret, 0)
+        self.assertTrue(isinstance(out, mmap.mmap))
+        self.assertEqual(len(out), len(o))
+        self.assertEqual(out[:], o)
+        out.close()
+
+        ret, out = cmd.run(test_cmds['echo'] % 'Hello', shell=True, spool_size=4096)
+        self.assertEqual(out.strip(), 'Hello')
+
+        self.assertRaises(RunCmdInvalidInputError, cmd.run, test_cmds['ls'], shell=True,
+                          spool_size=4096, capture_tail=100)
+
+    def test_compress(self):
+        """ The output is compressed on its way to the buffer or file.
+        """
+        cmd_str = test_cmds['sim_log'] % (1, 'm', 0)
+        o = RunCmd().run(cmd_str, shell=True)[1]
+
+        cmd = RunCmd()
+        ret, out = cmd.run(cmd_str, shell=True, compress='zlib')
+        self.assertEqual(ret, 0)
+        self.assertTrue(len(out) < len(o))
+        self.assertEqual(zlib.decompress(out), o)
+        self.assertEqual(cmd.result.output_bytes, len(o))
+
+        ret, out = cmd.run(cmd_str, shell=True, compress='bz2')
+        self.assertEqual(bz2.decompress(out), o)
+
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cmd.run_fd(cmd_str, f, shell=True, compress='gzip', zero_copy=True)
+            self.assertEqual(gzip.open(path, 'rb').read(), o)
+        finally:
+            os.remove(path)
+
+        self.assertRaises(RunCmdInvalidInputError, cmd.run, cmd_str, shell=True,
+                          compress='zip')
+        self.assertRaises(RunCmdInvalidInputError, cmd.run, cmd_str, shell=True,
+                          compress='gzip', capture_tail=100)
+
+    def test_text_file(self):
+        """ Text-mode files, such as sys.stdout, are given strings rather than views of the
+        buffer, also as one of several sinks and through a write queue.
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'out.txt')
+        other_path = os.path.join(directory, 'other.txt')
+        try:
+            cmd = RunCmd()
+            with open(path, 'w') as f:
+                cmd.run_fd('echo', f, shell=True)
+            self.assertEqual(cmd.return_code, 0)
+            self.assertEqual(open(path, 'rb').read(), '\n')
+
+            for kwargs in ({}, {'write_queue': 4}):
+                chunks = []
+                with open(path, 'w') as f:
+                    cmd.run_fd('echo Hello World', f, shell=True, **kwargs)
+                self.assertEqual(cmd.return_code, 0)
+                self.assertEqual(open(path, 'rb').read(), 'Hello World\n')
+
+                with open(path, 'w') as f, open(other_path, 'w') as other:
+                    cmd.run_fd('echo Hello World', [f, other, chunks.append], shell=True,
+                               **kwargs)
+                self.assertEqual(cmd.result.sink_errors, [])
+                self.assertEqual(open(path, 'rb').read(), 'Hello World\n')
+                self.assertEqual(open(other_path, 'rb').read(), 'Hello World\n')
+                self.assertEqual(''.join(chunks), 'Hello World\n')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_tee(self):
+        """ The output is written to several sinks in one pass, and a failing sink does not stop
+        the others.
+        """
+        class _FailingFile(object):
+            def write(self, data):
+                if data:
+                    raise IOError('disk full')
+
+            def flush(self):
+                pass
+
+        cmd_str = test_cmds['sim_log'] % (1, 'm', 0)
+        o = RunCmd().run(cmd_str, shell=True)[1]
+
+        chunks = []
+        tail = BoundedBuffer(tail=100)
+        cmd = RunCmd()
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cmd.run_fd(cmd_str, [f, tail, chunks.append, _FailingFile()], shell=True)
+            self.assertEqual(cmd.return_code, 0)
+            self.assertEqual(open(path, 'rb').read(), o)
+        finally:
+            os.remove(path)
+        self.assertEqual(tail.getvalue(), o[-100:])
+        self.assertEqual(''.join(chunks), o)
+        self.assertEqual(len(cmd.result.sink_errors), 1)
+        self.assertTrue('disk full' in cmd.result.sink_errors[0])
+
+        self.assertRaises(RunCmdInternalError, cmd.run_fd, cmd_str, [_FailingFile()],
+                          shell=True)
+
+    def test_write_queue(self):
+        """ A slow destination is written to from a thread of its own, and the overflow policy
+        applies once the queue is full.
+        """
+        class _SlowFile(object):
+            def __init__(self):
+                self.data = []
+
+            def write(self, data):
+                if data:
+                    time.sleep(0.01)
+                    self.data.append(data)
+
+            def flush(self):
+                pass
+
+        cmd_str = test_cmds['sim_log'] % (256, 'k', 0) + ' --block-size=65536'
+        o = RunCmd().run(cmd_str, shell=True)[1]
+
+        cmd = RunCmd(max_chunk_size=4096)
+        for overflow in (RunCmd.OVERFLOW_BLOCK, RunCmd.OVERFLOW_SPILL):
+            f = _SlowFile()
+            cmd.run_fd(cmd_str, f, shell=True, write_queue=4, overflow=overflow)
+            self.assertEqual(cmd.return_code, 0)
+            self.assertEqual(''.join(f.data), o)
+
+            stats = cmd.result.queue_stats
+            if overflow == RunCmd.OVERFLOW_BLOCK:
+                self.assertEqual(stats['max_depth'], 4)
+                self.assertTrue(stats['wait_time'] > 0)
+            else:
+                self.assertTrue(stats['spilled_bytes'] > 0)
+                self.assertEqual(stats['wait_time'], 0)
+
+        f = _SlowFile()
+        cmd.run_fd(cmd_str, f, shell=True, write_queue=4, overflow=RunCmd.OVERFLOW_DROP_OLDEST)
+        stats = cmd.result.queue_stats
+        self.assertTrue(stats['dropped_bytes'] > 0)
+        self.assertEqual(len(''.join(f.data)) + stats['dropped_bytes'], len(o))
+
+        # once the command timed out, the queued chunks do not hold up the call.
+        class _StuckFile(object):
+            def write(self, data):
+                if data:
+                    time.sleep(3)
+
+            def flush(self):
+                pass
+
+        cmd = RunCmd(kill_grace_period=0.2, reap_timeout=0.2)
+        start = time.time()
+        cmd.run_fd(['yes'], _StuckFile(), timeout=0.3, write_queue=2)
+        self.assertEqual(cmd.return_code, RunCmd.TIMEOUT_ERR)
+        self.assertTrue(time.time() - start < 2)
+        self.assertTrue(cmd.result.queue_stats['dropped_bytes'] > 0)
+
+        # no pipe is leaked by a bad overflow policy, even with input.
+        fd_count = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+        self.assertRaises(RunCmdInvalidInputError, cmd.run_fd, cmd_str, f, shell=True,
+                          write_queue=4, overflow='discard')
+        self.assertRaises(RunCmdInvalidInputError, cmd.run_fd, 'cat', f, shell=True,
+                          input='Hello', write_queue=4, overflow='discard')
+        if fd_count is not None:
+            self.assertEqual(len(os.listdir('/proc/self/fd')), fd_count)
+
+    def test_result(self):
+        """ The result of the last command records its timings, output size and resource usage.
+        """
+        cmd = RunCmd()
+        ret, out = cmd.run(test_cmds['sim_log'] % (100, 'k', 0), shell=True)
+        result = cmd.result
+        self.assertEqual(result.return_code, ret)
+        self.assertEqual(result.output_bytes, len(out))
+        self.assertTrue(result.output is out)
+        self.assertTrue(0 <= result.time_to_first_output <= result.elapsed)
+        self.assertTrue(result.throughput > 0)
+        self.assertFalse(result.is_timeout or result.is_killed)
+        if sys.platform != 'win32':
+            self.assertTrue(result.user_time >= 0 and result.system_time >= 0)
+            self.assertTrue(result.max_rss > 0)
+
+        cmd.run(test_cmds['sleep'] % 10, timeout=0.5, shell=True)
+        self.assertTrue(cmd.result.is_timeout and cmd.result.is_killed)
+        self.assertTrue(0.5 <= cmd.result.elapsed < 2)
+        self.assertEqual(cmd.result.output_bytes, 0)
+        self.assertTrue(cmd.result.time_to_first_output is None)
+
+    def test_hooks(self):
+        """ Hooks fire in order with timestamps, and every OUTPUT_HOOK_INTERVAL bytes.
+        """
+        events = []
+        cmd = RunCmd()
+        cmd.OUTPUT_HOOK_INTERVAL = 100 * 1024
+        for event in RunCmd.HOOK_EVENTS:
+            cmd.add_hook(event, lambda *args: events.append(args))
+
+        cmd.run(test_cmds['sim_log'] % (1, 'm', 0), shell=True)
+        names = [event for event, _, _ in events]
+        self.assertEqual(names[:3], [RunCmd.HOOK_PRE_SPAWN, RunCmd.HOOK_SPAWN,
+                                     RunCmd.HOOK_FIRST_OUTPUT])
+        self.assertTrue(names.count(RunCmd.HOOK_OUTPUT) >= 9)
+        # the output may still be drained after the command was reaped.
+        reaps = [e for e in events if e[0] == RunCmd.HOOK_REAP]
+        self.assertEqual(len(reaps), 1)
+        self.assertEqual(reaps[0][2], 0)
+        outputs = [t for event, t, _ in events if event != RunCmd.HOOK_REAP]
+        self.assertEqual(outputs, sorted(outputs))
+
+        del events[:]
+        cmd.run(test_cmds['sleep'] % 10, timeout=0.5, shell=True)
+        names = [event for event, _, _ in events]
+        self.assertEqual(names, [RunCmd.HOOK_PRE_SPAWN, RunCmd.HOOK_SPAWN, RunCmd.HOOK_TIMEOUT,
+                                 RunCmd.HOOK_PRE_KILL, RunCmd.HOOK_POST_KILL, RunCmd.HOOK_REAP])
+
+        self.assertRaises(RunCmdInvalidInputError, cmd.add_hook, 'unknown', len)
+
+        # a failing hook is reported once the command has still been killed and reaped.
+        def fail(event, timestamp, value):
+            raise RuntimeError('hook failed')
+
+        for event in (RunCmd.HOOK_SPAWN, RunCmd.HOOK_TIMEOUT, RunCmd.HOOK_PRE_KILL):
+            cmd = RunCmd()
+            cmd.add_hook(event, fail)
+            cmd.add_hook(RunCmd.HOOK_REAP, lambda *args: events.append(args))
+            del events[:]
+            start = time.time()
+            self.assertRaises(RunCmdInternalError, cmd.run, test_cmds['sleep'] % 10,
+                              timeout=0.5, shell=True)
+            self.assertTrue(time.time() - start < 2)
+            self.assertTrue('hook failed' in cmd.result.error_msg)
+            self.assertEqual([e[0] for e in events], [RunCmd.HOOK_REAP])
+            cmd.remove_hook(event, fail)
+            self.assertEqual(cmd.run('true', shell=True), (0, ''))
+
+    @unittest.skipIf(sys.platform == 'win32', 'split_stderr requires POSIX')
+    def test_block_output(self):
+        """ Binary output written in blocks to stdout and stderr arrives intact.
+        """
+        size = 3 * 1024 * 1024
+        cmd = RunCmd()
+        ret, out, err = cmd.run(test_cmds['sim_log'] % (3, 'm', 0) +
+                                ' --block-size=65536 --binary --stderr-every=3',
+                                shell=True, split_stderr=True)
+        self.assertEqual(ret, 0)
+        self.assertEqual(len(out) + len(err), size)
+
+        digests = generate_output.checksums(size, 65536, binary=True, stderr_every=3)
+        self.assertEqual(hashlib.md5(out).hexdigest(), digests[generate_output.STDOUT])
+        self.assertEqual(hashlib.md5(err).hexdigest(), digests[generate_output.STDERR])
+
+        # the checksum of the default, numbered lines matches them too.
+        ret, out = cmd.run(test_cmds['sim_log'] % (1, 'm', 0) + ' --checksum', shell=True)
+        ret, lines = cmd.run(test_cmds['sim_log'] % (1, 'm', 0), shell=True)
+        self.assertEqual(out.split()[1], hashlib.md5(lines).hexdigest())
+
+    @unittest.skipIf(sys.platform == 'win32', 'posix_spawnp is only used under POSIX')
+    def test_new_session(self):
+        """ Commands run in a session of their own, whichever way they are spawned.
+        """
+        ret, out = RunCmd().run('ps -o sid= -p $$', shell=True, cwd=ROOT_DIR)
+        self.assertEqual(ret, 0)
+        self.assertNotEqual(int(out), os.getsid(0))
+
+    @unittest.skipIf(sys.platform == 'win32', 'RunCmdSpawnServer requires POSIX')
+    def test_spawn_server(self):
+        """ Commands started by the spawn server behave as if started directly, and are started
+        directly once the server dies.
+        """
+        with RunCmdSpawnServer() as server:
+            cmd = RunCmd(spawn_server=server)
+            ret, out = cmd.run('echo $PPID', shell=True)
+            self.assertEqual(ret, 0)
+            self.assertEqual(int(out), server.pid)
+
+            ret, out = cmd.run(test_cmds['sleep'] % 10, shell=True, timeout=0.5)
+            self.assertEqual(ret, RunCmd.TIMEOUT_ERR)
+            self.assertTrue(cmd.result.elapsed < 2)
+
+            self.assertRaises(RunCmdInvalidInputError, cmd.run, 'no_such_command_exists')
+
+            # the commands inherit no signal dispositions from the server.
+            if os.path.exists('/proc/self/status'):
+                status_cmd = ['grep', '^Sig\(Ign\|Blk\)', '/proc/self/status']
+                self.assertEqual(cmd.run(status_cmd), RunCmd().run(status_cmd))
+
+            pool = RunCmdPool(max_running=4, spawn_server=server)
+            jobs = [RunCmdJob(test_cmds['echo'] % i, shell=True) for i in range(10)]
+            outputs = sorted(r.output.strip() for r in pool.run_many(jobs))
+            self.assertEqual(outputs, sorted(str(i) for i in range(10)))
+
+            os.kill(server.pid, signal.SIGKILL)
+            server._reader.join()
+            self.assertFalse(server.is_alive())
+            ret, out = cmd.run('echo $PPID', shell=True)
+            self.assertEqual(ret, 0)
+            self.assertEqual(int(out), os.getpid())
+
+    @unittest.skipIf(not os.path.exists(RunCmdSession.SHELL), 'RunCmdSession requires bash')
+    def test_session(self):
+        """ Successive commands run through one shell, which survives a command timing out.
+        """
+        with RunCmdSession() as session:
+            self.assertEqual(session.run('echo Hello; exit 3', shell=True), (3, 'Hello\n'))
+            pid = session.pid
+            self.assertEqual(session.run('echo out; echo err >&2', shell=True,
+                                         split_stderr=True),
+                             (0, 'out\n', 'err\n'))
+            self.assertEqual(session.run(['echo', "it's"]), (0, "it's\n"))
+            ret, out = session.run('pwd', cwd=ROOT_DIR)
+            self.assertEqual(os.path.realpath(out.strip()), os.path.realpath(ROOT_DIR))
+
+            start = time.time()
+            ret, out = session.run('echo Hello; ' + test_cmds['sleep'] % 10, shell=True,
+                                   timeout=0.5)
+            self.assertEqual(ret, RunCmd.TIMEOUT_ERR)
+            self.assertEqual(out, 'Hello\n')
+            self.assertTrue(time.time() - start < 2)
+
+            # only the job was killed, not the shell.
+            self.assertEqual(session.run(test_cmds['echo'] % 'Hello', shell=True),
+                             (0, 'Hello\n'))
+            self.assertEqual(session.pid, pid)
+
+            # without shell, the command is a program, as with RunCmd.run().
+            self.assertRaises(RunCmdInvalidInputError, session.run, 'echo hi')
+            self.assertEqual(session.return_code, RunCmd.INVALID_INPUT_ERR)
+
+        # a job ignoring SIGTERM is killed with SIGKILL once the grace period is over.
+        with RunCmdSession(kill_grace_period=0.3, reap_timeout=1) as session:
+            start = time.time()
+            ret, out = session.run("trap '' TERM; echo Hello; sleep 10; echo survived",
+                                   shell=True, timeout=0.3)
+            self.assertEqual((ret, out), (RunCmd.TIMEOUT_ERR, 'Hello\n'))
+            self.assertTrue(time.time() - start < 2)
+            pid = session.pid
+            self.assertEqual(session.run('true', shell=True), (0, ''))
+            self.assertEqual(session.pid, pid)
+
+    @unittest.skipIf(sys.platform == 'win32', 'signals are only sent under POSIX platforms')
+    def test_kill_escalation(self):
+        """ A command ignoring SIGTERM is killed with SIGKILL once the grace period is over.
+        """
+        cmd = RunCmd(kill_grace_period=0.3, reap_timeout=1)
+        ret, out = cmd.run('sleep 10', shell=True, timeout=0.3)
+        self.assertEqual(ret, RunCmd.TIMEOUT_ERR)
+        self.assertEqual(cmd.result.kill_signal, signal.SIGTERM)
+        self.assertTrue(cmd.result.elapsed < 1)
+
+        ret, out = cmd.run("trap '' TERM; echo Hello; sleep 10; echo survived", shell=True,
+                           timeout=0.3)
+        self.assertEqual(ret, RunCmd.TIMEOUT_ERR)
+        self.assertEqual(out, 'Hello\n')
+        self.assertEqual(cmd.result.kill_signal, signal.SIGKILL)
+        self.assertTrue(cmd.result.elapsed < 2)
+
+        cmd.run('true', shell=True)
+        self.assertEqual(cmd.result.kill_signal, None)
+
+        # a command which has not exited yet once given up on still reports the timeout.
+        cmd = RunCmd(kill_grace_period=0, reap_timeout=0)
+        for _ in range(3):
+            list(cmd.iter_output("trap '' TERM; sleep 10", shell=True, timeout=0.2))
+            self.assertEqual(cmd.return_code, RunCmd.TIMEOUT_ERR)
+
+        pool = RunCmdPool(kill_grace_period=0.3, reap_timeout=1)
+        job = RunCmdJob("trap '' TERM; sleep 10", timeout=0.3, shell=True)
+        result = list(pool.run_many([job]))[0]
+        self.assertEqual(result.return_code, RunCmd.TIMEOUT_ERR)
+        self.assertEqual(result.kill_signal, signal.SIGKILL)
+        self.assertTrue(result.elapsed < 2)
+
+        # a command given up on, as its output is held open by a process which left its
+        # group, is still reaped once it exits rather than left a zombie.
+        loop = _PoolLoop(kill_grace_period=0, reap_timeout=0)
+        entry = loop.start(RunCmdJob('setsid sleep 2 & sleep 10', timeout=0.5, shell=True))
+        start = time.time()
+        while not loop.step():
+            pass
+        self.assertTrue(time.time() - start < 1.5)
+        while loop.abandoned and time.time() - start < 2:
+            loop.step(0.05)
+        self.assertEqual(loop.abandoned, [])
+        self.assertEqual(entry.p.returncode, -signal.SIGTERM)
+        loop.close()
+
+        # the commands left running are killed at once when the caller stops iterating.
+        jobs = [RunCmdJob("trap '' TERM; sleep 10", shell=True) for _ in range(3)]
+        results = pool.run_many(jobs + [RunCmdJob('echo Hello', shell=True)])
+        self.assertEqual(next(results).output, 'Hello\n')
+        start = time.time()
+        results.close()
+        self.assertTrue(time.time() - start < 0.8)
+
+    @unittest.skipIf(not os.path.isdir('/proc/self'), 'zombies are only told apart with /proc')
+    def test_group_alive(self):
+        """ A group with a member left is alive until the member exits, and /proc is only scanned
+        again once the member found last has gone.
+        """
+        ret, out = RunCmd().run('setsid sh -c \'echo $$; sleep 1 >/dev/null 2>&1 &\'',
+                                shell=True)
+        pgid = int(out)
+        listdir = os.listdir
+        scans = []
+
+        def counting_listdir(path):
+            scans.append(path)
+            return listdir(path)
+
+        cache = {}
+        os.listdir = counting_listdir
+        try:
+            start = time.time()
+            calls = 0
+            while _is_group_alive(pgid, cache) and time.time() - start < 5:
+                calls += 1
+                time.sleep(0.01)
+        finally:
+            os.listdir = listdir
+        self.assertTrue(0.5 < time.time() - start < 3)
+        self.assertTrue(calls > 10)
+        self.assertTrue(len(scans) <= 2)
+
+    @unittest.skipIf(sys.platform == 'win32', 'pipelines are only supported under POSIX')
+    def test_pipeline(self):
+        """ The stages of a pipeline are connected to each other, each with its own cwd and env,
+        and the timeout kills every stage.
+        """
+        cwd = os.path.dirname(os.path.realpath(__file__))
+        cmd = RunCmd()
+        codes, out = cmd.run_pipeline([['printf', 'b\\na\\n'], ['sort'],
+                                       RunCmdJob(['ls', os.path.basename(__file__)], cwd=cwd)])
+        self.assertEqual(codes, [0, 0, 0])
+        self.assertEqual(out, os.path.basename(__file__) + '\n')
+
+        codes, out = cmd.run_pipeline([['printf', 'b\\na\\n'], ['sort']])
+        self.assertEqual((codes, out), ([0, 0], 'a\nb\n'))
+
+        env = dict(os.environ, X='x')
+        codes, out, err = cmd.run_pipeline(
+            [RunCmdJob('echo $X; echo oops >&2; exit 3', shell=True, env=env), ['tr', 'x', 'y']],
+            split_stderr=True)
+        self.assertEqual(codes, [3, 0])
+        self.assertEqual((out, err), ('y\n', 'oops\n'))
+        self.assertEqual(cmd.return_code, 0)
+
+        codes, out = cmd.run_pipeline([['cat'], ['wc', '-c']], input='x' * 100000)
+        self.assertEqual(int(out), 100000)
+
+        cmd = RunCmd(kill_grace_period=0.3, reap_timeout=1)
+        codes, out = cmd.run_pipeline([['sleep', '10'], ['cat']], timeout=0.3)
+        self.assertEqual(cmd.return_code, RunCmd.TIMEOUT_ERR)
+        self.assertEqual(codes, [-signal.SIGTERM, -signal.SIGTERM])
+        self.assertTrue(cmd.result.elapsed < 1)
+
+        self.assertRaises(RunCmdInvalidInputError, cmd.run_pipeline, [])
+        self.assertRaises(RunCmdInvalidInputError, cmd.run_pipeline, [['true'], ['no_such_cmd']])
+
+    def test_cache(self):
+        """ A result is replayed from the cache until its key changes, results of failed
+        commands are not stored, and the least recently used results are evicted.
+        """
+        directory = tempfile.mkdtemp()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cache = RunCmdCache(directory, env_keys=['RUNCMD_TEST'])
+            cmd = RunCmd(cache=cache)
+            ret, out, err = cmd.run('date +%N; echo oops >&2', shell=True, split_stderr=True)
+            self.assertFalse(cmd.result.is_cached)
+            self.assertEqual(cmd.run('date +%N; echo oops >&2', shell=True, split_stderr=True),
+                             (ret, out, err))
+            self.assertTrue(cmd.result.is_cached)
+            self.assertEqual(cmd.result.output_bytes, len(out) + len(err))
+
+            os.environ['RUNCMD_TEST'] = 'x'
+            try:
+                self.assertNotEqual(cmd.run('date +%N', shell=True)[1], out)
+            finally:
+                del os.environ['RUNCMD_TEST']
+
+            with open(path, 'wb') as f:
+                f.write('Hello')
+            self.assertEqual(cmd.run(['cat', path], cache_inputs=[path]), (0, 'Hello'))
+            with open(path, 'wb') as f:
+                f.write('Hello World')
+            self.assertEqual(cmd.run(['cat', path], cache_inputs=[path]), (0, 'Hello World'))
+            self.assertFalse(cmd.result.is_cached)
+            self.assertEqual(cmd.run(['cat', path], cache_inputs=[path]), (0, 'Hello World'))
+            self.assertTrue(cmd.result.is_cached)
+
+            ret, out = cmd.run('echo Hello', shell=True, compress='gzip')
+            self.assertEqual(cmd.run('echo Hello', shell=True)[1], 'Hello\n')
+            self.assertTrue(cmd.result.is_cached)
+            self.assertEqual(cmd.run('echo Hello', shell=True, compress='gzip')[1], out)
+
+            self.assertEqual(cmd.run('date +%N; sleep 10', shell=True, timeout=0.3)[0],
+                             RunCmd.TIMEOUT_ERR)
+            self.assertEqual(cmd.run('date +%N; sleep 10', shell=True, timeout=0.3)[0],
+                             RunCmd.TIMEOUT_ERR)
+            self.assertFalse(cmd.result.is_cached)
+
+            stats = cache.stats
+            self.assertEqual((stats['hits'], stats['misses']), (4, 7))
+            self.assertEqual(stats['size'], cache.size)
+
+            # reloaded from the directory, and evicted down to the new size.
+            cache = RunCmdCache(directory, max_size=cache.size // 2)
+            self.assertTrue(cache.stats['entries'] < stats['entries'])
+            self.assertTrue(cache.size <= cache.max_size)
+            self.assertTrue(cache.evictions > 0)
+            cache.clear()
+            self.assertEqual(cache.stats['entries'], 0)
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+            os.remove(path)
+
     #TODO
     #   1. Test for RunCmdInterruptError.
     #   2. Test forced killing of children process.
-    #   3. Test _PipeData?
 
 def main():
     unittest.main()
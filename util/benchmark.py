@@ -0,0 +1,379 @@
+#! /usr/bin/env python
+
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Wen Shan Chang
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+
+#
+# benchmark.py
+#
+# Measure the overhead and throughput of RunCmd against subprocess.Popen().communicate(), and
+# write the results as JSON to track regressions between releases. The benchmarks are:
+#
+#   latency    : time per call for trivial commands through run(), run_fd() and main().
+#   throughput : bytes per second of output generated by generate_output.py.
+#   memory     : peak memory used to capture the output, measured in a fresh process.
+#   timeout    : how late a command is terminated after its timeout.
+#
+# Every benchmark is also run with Popen().communicate() as the baseline, under the mode
+# 'communicate'. For example, to write the results to bench.json:
+#
+#   python benchmark.py -o bench.json
+#
+# Use --quick for a short run, or --sizes to choose the output sizes, e.g. --sizes=1k,1m,1g.
+# Only supported under POSIX platforms.
+#
+
+
+import sys
+import os
+import json
+import time
+import platform
+import signal
+import subprocess
+import threading
+import resource
+
+# add module's root folder as part of search path
+ROOT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+
+import runcmd
+from runcmd import RunCmd
+
+GENERATE_OUTPUT = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                               'generate_output.py')
+
+LATENCY_CMDS = ['true', 'echo hello']
+LATENCY_MODES = ['communicate', 'run', 'run_fd', 'main']
+THROUGHPUT_MODES = ['communicate', 'run', 'run_fd']
+TIMEOUTS = [0.05, 0.1, 0.5, 1.0]
+
+# block size of generate_output.py
+BLOCK_SIZE = 65536
+
+DEFAULT_SIZES = '1k,1m,100m,1g'
+QUICK_SIZES = '1k,1m'
+DEFAULT_MEMORY_SIZES = '100m'
+
+
+def _parse_size(size):
+    """ Returns a tuple of (count, unit) for a size such as '100m'.
+    """
+    return int(size[:-1]), size[-1].lower()
+
+
+def _generate_cmd(size):
+    """ Returns the shell command generating output of the given size, e.g. '1m'. Block mode
+    is used, so the generator is not the bottleneck.
+    """
+    count, unit = _parse_size(size)
+    return '%s %s %d %s --block-size=%d' % (sys.executable, GENERATE_OUTPUT, count, unit,
+                                            BLOCK_SIZE)
+
+
+def _summarize(samples):
+    """ Returns the statistics of a list of durations, in seconds.
+    """
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'n': n,
+        'min': samples[0],
+        'median': samples[n // 2] if n % 2 else (samples[n // 2 - 1] + samples[n // 2]) / 2.0,
+        'mean': sum(samples) / n,
+        'p95': samples[min(n - 1, int(n * 0.95))],
+        'max': samples[-1],
+    }
+
+
+def _call(mode, cmd, devnull):
+    """ Run a shell command once in the given mode, and return the number of bytes of output.
+    """
+    if mode == 'communicate':
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return len(p.communicate()[0])
+
+    if mode == 'run':
+        return len(RunCmd().run(cmd, shell=True)[1])
+
+    if mode == 'run_fd':
+        c = RunCmd()
+        c.run_fd(cmd, devnull, shell=True)
+        return c.result.output_bytes
+
+    if mode == 'main':
+        argv, stdout = sys.argv, sys.stdout
+        sys.argv, sys.stdout = ['runcmd.py', '--cmd=%s' % cmd, '--shell'], devnull
+        try:
+            runcmd.main()
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+        return None
+
+    raise ValueError('unknown mode %s' % mode)
+
+
+def bench_latency(iterations):
+    """ Time trivial commands through each mode.
+    """
+    results = []
+    with open(os.devnull, 'wb') as devnull:
+        for cmd in LATENCY_CMDS:
+            baseline = None
+            for mode in LATENCY_MODES:
+                _call(mode, cmd, devnull)  # warm up
+                samples = []
+                for _ in range(iterations):
+                    start = runcmd._monotonic()
+                    _call(mode, cmd, devnull)
+                    samples.append(runcmd._monotonic() - start)
+
+                stats = _summarize(samples)
+                if baseline is None:
+                    baseline = stats['median']
+                results.append({
+                    'cmd': cmd,
+                    'mode': mode,
+                    'seconds': stats,
+                    'overhead': stats['median'] - baseline,
+                    'ratio': stats['median'] / baseline,
+                })
+                _report('latency %-12s %-12s median %.2f ms (x%.2f)' %
+                        (cmd, mode, stats['median'] * 1000, stats['median'] / baseline))
+    return results
+
+
+def bench_throughput(sizes, iterations):
+    """ Time commands producing output of each size through each mode.
+    """
+    results = []
+    with open(os.devnull, 'wb') as devnull:
+        for size in sizes:
+            cmd = _generate_cmd(size)
+            baseline = None
+            for mode in THROUGHPUT_MODES:
+                samples = []
+                out_bytes = 0
+                for _ in range(iterations):
+                    start = runcmd._monotonic()
+                    out_bytes = _call(mode, cmd, devnull)
+                    samples.append(runcmd._monotonic() - start)
+
+                stats = _summarize(samples)
+                throughput = out_bytes / stats['median']
+                if baseline is None:
+                    baseline = throughput
+                results.append({
+                    'size': size,
+                    'mode': mode,
+                    'bytes': out_bytes,
+                    'seconds': stats,
+                    'bytes_per_second': throughput,
+                    'ratio': throughput / baseline,
+                })
+                _report('throughput %-5s %-12s %.1f MB/s (x%.2f)' %
+                        (size, mode, throughput / 1048576, throughput / baseline))
+    return results
+
+
+def bench_memory(sizes):
+    """ Measure the peak memory used to capture the output of each size, each in a fresh
+    process, so earlier runs cannot hide the peak.
+    """
+    results = []
+    for size in sizes:
+        baseline = None
+        for mode in THROUGHPUT_MODES:
+            c = RunCmd()
+            ret, out = c.run([sys.executable, os.path.realpath(__file__), '--memory-child',
+                              mode, size])
+            if ret != 0:
+                raise RuntimeError('memory benchmark failed: %s' % out)
+
+            usage = json.loads(out)
+            peak = usage['peak_kb'] - usage['baseline_kb']
+            if baseline is None:
+                baseline = peak
+            results.append({
+                'size': size,
+                'mode': mode,
+                'bytes': usage['bytes'],
+                'peak_kb': peak,
+                'ratio': float(peak) / baseline if baseline else None,
+            })
+            _report('memory %-5s %-12s %d KB' % (size, mode, peak))
+    return results
+
+
+def _memory_child(mode, size):
+    """ Run one capture and print the peak resident set size before and after, as JSON.
+    """
+    baseline = _get_max_rss()
+    with open(os.devnull, 'wb') as devnull:
+        out_bytes = _call(mode, _generate_cmd(size), devnull)
+    print json.dumps({'baseline_kb': baseline, 'peak_kb': _get_max_rss(), 'bytes': out_bytes})
+
+
+def _get_max_rss():
+    """ Returns the peak resident set size of this process, in KB.
+
+    Under Linux, ru_maxrss is inherited across fork and exec, so the child would start with the
+    benchmark's own peak. VmHWM is read instead, as it is reset on exec.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+def bench_timeout(iterations):
+    """ Measure how long after its timeout a command is terminated. The baseline kills the
+    process group from a threading.Timer, as is commonly done around communicate().
+    """
+    results = []
+    cmd = 'sleep 10'
+    for timeout in TIMEOUTS:
+        baseline = None
+        for mode in ['communicate', 'run']:
+            samples = []
+            for _ in range(iterations):
+                start = runcmd._monotonic()
+                if mode == 'communicate':
+                    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+                    timer = threading.Timer(timeout, os.killpg, (p.pid, signal.SIGTERM))
+                    timer.start()
+                    p.communicate()
+                    timer.cancel()
+                else:
+                    RunCmd().run(cmd, timeout=timeout, shell=True)
+                samples.append(runcmd._monotonic() - start - timeout)
+
+            stats = _summarize(samples)
+            if baseline is None:
+                baseline = stats['median']
+            results.append({
+                'timeout': timeout,
+                'mode': mode,
+                'overshoot_seconds': stats,
+            })
+            _report('timeout %-5s %-12s overshoot median %.2f ms' %
+                    (timeout, mode, stats['median'] * 1000))
+    return results
+
+
+def _report(line):
+    """ Print progress to stderr, leaving stdout for the JSON.
+    """
+    sys.stderr.write(line + '\n')
+
+
+def main():
+    """ Run the benchmarks and write the results as JSON.
+
+    Returns 0 if the benchmarks were run successfully.
+    """
+    import optparse
+
+    parser = optparse.OptionParser()
+    parser.add_option('-o', '--output',
+                      action='store',
+                      type='string',
+                      dest='output',
+                      help='File to write the JSON results to. Defaults to stdout.')
+
+    parser.add_option('-q', '--quick',
+                      action='store_true',
+                      default=False,
+                      dest='is_quick',
+                      help='Run fewer iterations and only small outputs.')
+
+    parser.add_option('--sizes',
+                      action='store',
+                      type='string',
+                      dest='sizes',
+                      help='Comma separated output sizes for the throughput benchmark, e.g. '
+                           '1k,1m,1g. Defaults to %s.' % DEFAULT_SIZES)
+
+    parser.add_option('--memory-sizes',
+                      action='store',
+                      type='string',
+                      dest='memory_sizes',
+                      help='Comma separated output sizes for the memory benchmark. '
+                           'Defaults to %s.' % DEFAULT_MEMORY_SIZES)
+
+    parser.add_option('--memory-child',
+                      action='store',
+                      type='string',
+                      nargs=2,
+                      dest='memory_child',
+                      help=optparse.SUPPRESS_HELP)
+
+    (options, args) = parser.parse_args()
+
+    if sys.platform == 'win32':
+        print "The benchmarks are only supported under POSIX platforms."
+        return 1
+
+    if options.memory_child:
+        _memory_child(*options.memory_child)
+        return 0
+
+    sizes = (options.sizes or (QUICK_SIZES if options.is_quick else DEFAULT_SIZES)).split(',')
+    memory_sizes = (options.memory_sizes or
+                    (QUICK_SIZES if options.is_quick else DEFAULT_MEMORY_SIZES)).split(',')
+    latency_iterations = 20 if options.is_quick else 200
+    iterations = 1 if options.is_quick else 3
+
+    results = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'argv': sys.argv[1:],
+        },
+        'latency': bench_latency(latency_iterations),
+        'throughput': bench_throughput(sizes, iterations),
+        'memory': bench_memory(memory_sizes),
+        'timeout': bench_timeout(iterations),
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -40,15 +40,32 @@
 #   c = RunCmd()
 #   c.run_fd('python generate_output.py 50 m', out_file=f)
 #
+# By default every line is numbered, which limits the output to what Python can format. Pass
+# --block-size to write pre-built blocks instead, fast enough to stress RunCmd at GB/s. In
+# block mode the output can also be binary, rate limited or partly written to stderr, e.g.
+# 1 GB of random bytes at 100 MB/s in bursts of 4 MB, a tenth of it to stderr:
+#
+#   python generate_output.py 1 g --block-size=4194304 --binary --rate=104857600 \
+#       --stderr-every=10
+#
+# The output is deterministic. Use checksums() from this module, or --checksum with the same
+# options, to compute what the receiving end should get.
+#
 
 
 __author__ = 'Wen Shan Chang'
 
 import sys
+import os
 import time
+import random
+import binascii
+import hashlib
+import optparse
 
-#number of bytes per KB, MB, GB
+#number of bytes per B, KB, MB, GB
 UNIT_VALUES = {
+    'b': 1,
     'k': 1024,
     'm': 1048576,
     'g': 1073741824,
@@ -56,11 +73,25 @@ UNIT_VALUES = {
 
 STRING = 'This is a test string from generate_output.py: '
 
+# Defaults for block mode.
+LINE_LENGTH = 80
+STDOUT = 1
+STDERR = 2
+
+
 def main(size, file_obj, timeout):
 
     timeout = timeout if timeout >= 0 else 0
     time.sleep(timeout)
 
+    for line in iter_lines(size):
+        file_obj.write(line)
+
+
+def iter_lines(size):
+    """ Generate the numbered lines written by main(), at least size bytes of them, followed
+    by a line giving their total size.
+    """
     if size <= 0:
         return
 
@@ -68,27 +99,141 @@ def main(size, file_obj, timeout):
     i = 0
     while written_bytes < size:
         line = "{}{}\n".format(STRING, i)
-        file_obj.write(line)
+        yield line
         i += 1
         written_bytes += len(line)
 
-    file_obj.write("Written {} bytes.\n".format(written_bytes))
+    yield "Written {} bytes.\n".format(written_bytes)
+
+
+def make_block(block_size, line_length=LINE_LENGTH, binary=False, seed=0):
+    """ Build a block of output.
+
+    Args:
+        block_size : approximate size of the block in bytes. Text blocks are rounded down to
+                     whole lines, but hold at least one line.
+        line_length: length of each line of text, including the line ending.
+        binary     : if True, the block is random bytes which do not compress, instead of text.
+        seed       : seed of the random bytes.
+    Returns:
+        The block as a string.
+    """
+    if binary:
+        rand = random.Random(seed)
+        return binascii.unhexlify('%0*x' % (block_size * 2, rand.getrandbits(block_size * 8)))
+
+    line_length = max(1, line_length)
+    text = STRING * (line_length // len(STRING) + 1)
+    line = text[:line_length - 1] + '\n'
+    return line * max(1, block_size // line_length)
+
+
+def iter_blocks(size, block_size, line_length=LINE_LENGTH, binary=False, stderr_every=0,
+                seed=0):
+    """ Generate exactly size bytes of output as pre-built blocks.
+
+    Binary output cycles through a few blocks built from different seeds, so compressors with
+    a window smaller than several blocks find nothing to compress.
+
+    Args:
+        size        : total number of bytes to generate, stdout and stderr together.
+        block_size  : size of each block. See make_block().
+        line_length : see make_block().
+        binary      : see make_block().
+        stderr_every: if > 0, every n-th block is written to stderr instead of stdout.
+        seed        : seed of the random bytes.
+    Returns:
+        A generator of tuples of (stream, block), where stream is STDOUT or STDERR.
+    """
+    blocks = [make_block(block_size, line_length, binary, seed + i)
+              for i in range(4 if binary else 1)]
+    written_bytes = 0
+    i = 0
+    while written_bytes < size:
+        block = blocks[i % len(blocks)][:size - written_bytes]
+        i += 1
+        stream = STDERR if stderr_every > 0 and i % stderr_every == 0 else STDOUT
+        written_bytes += len(block)
+        yield stream, block
+
+
+def checksums(size, block_size, **kwargs):
+    """ Returns the MD5 hex digests of what iter_blocks() writes to stdout and stderr, as a
+    dictionary keyed by STDOUT and STDERR. See iter_blocks() for the arguments. A block_size
+    <= 0 gives the digests of the numbered lines written by main() instead, which ignores
+    kwargs.
+    """
+    digests = {STDOUT: hashlib.md5(), STDERR: hashlib.md5()}
+    if block_size <= 0:
+        blocks = ((STDOUT, line) for line in iter_lines(size))
+    else:
+        blocks = iter_blocks(size, block_size, **kwargs)
+    for stream, block in blocks:
+        digests[stream].update(block)
+    return dict((stream, digest.hexdigest()) for stream, digest in digests.items())
+
+
+def write_blocks(size, block_size, rate=0, **kwargs):
+    """ Write the output of iter_blocks() to the stdout and stderr file descriptors.
+
+    Args:
+        size      : see iter_blocks().
+        block_size: see iter_blocks().
+        rate      : if > 0, the average number of bytes per second to write. Each block is
+                    written at once, then the generator sleeps, hence larger blocks give
+                    burstier output.
+        kwargs    : see iter_blocks().
+    """
+    fds = {STDOUT: sys.stdout.fileno(), STDERR: sys.stderr.fileno()}
+    start_time = time.time()
+    written_bytes = 0
+    for stream, block in iter_blocks(size, block_size, **kwargs):
+        view = memoryview(block)
+        while view:
+            view = view[os.write(fds[stream], view):]
+        written_bytes += len(block)
+        if rate > 0:
+            delay = start_time + float(written_bytes) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
 
 if __name__ == "__main__":
 
-    if (len(sys.argv) < 3):
-        print "Usage: python generate_output.py size unit [timeout], "\
-                "where size is an integer, " \
-                "unit is [k|m|g], " \
-                "timeout is an optional argument to delay printout for x seconds. Defaults to 0."
-        print " e.g. Generate a 2 megabyte worth of output: python generate_output.py 2 m"
+    parser = optparse.OptionParser(
+        usage="python generate_output.py size unit [timeout] [options], "
+              "where size is an integer, "
+              "unit is [b|k|m|g], "
+              "timeout is an optional argument to delay printout for x seconds. Defaults to 0.\n"
+              " e.g. Generate a 2 megabyte worth of output: python generate_output.py 2 m")
+    parser.add_option('-b', '--block-size', type='int', default=0, dest='block_size',
+                      help='Write pre-built blocks of this many bytes instead of numbered '
+                           'lines. The options below only apply to this mode.')
+    parser.add_option('-l', '--line-length', type='int', default=LINE_LENGTH,
+                      dest='line_length', help='Length of each line. Defaults to %d.' %
+                      LINE_LENGTH)
+    parser.add_option('--binary', action='store_true', default=False, dest='binary',
+                      help='Write random, incompressible bytes instead of text.')
+    parser.add_option('-r', '--rate', type='int', default=0, dest='rate',
+                      help='Limit the output to this many bytes per second on average.')
+    parser.add_option('-e', '--stderr-every', type='int', default=0, dest='stderr_every',
+                      help='Write every n-th block to stderr.')
+    parser.add_option('--seed', type='int', default=0, dest='seed',
+                      help='Seed of the random bytes. Defaults to 0.')
+    parser.add_option('--checksum', action='store_true', default=False, dest='checksum',
+                      help='Print the MD5 of the stdout and stderr output instead of writing '
+                           'it.')
+    (options, args) = parser.parse_args()
+
+    if (len(args) < 2):
+        parser.print_usage()
         sys.exit(1)
 
     is_error = True
     data_size = 0
     try:
-        data_size = int(sys.argv[1])
-        data_size *= UNIT_VALUES[sys.argv[2].lower()]
+        data_size = int(args[0])
+        data_size *= UNIT_VALUES[args[1].lower()]
         is_error = False
 
     except ValueError:
@@ -96,7 +241,7 @@ if __name__ == "__main__":
 
     except KeyError:
         print "Error: unknown unit {}. Possible units are {}".\
-              format(sys.argv[2], [u for u in UNIT_VALUES.iterkeys()])
+              format(args[1], [u for u in UNIT_VALUES.iterkeys()])
 
     if data_size <= 0:
         print "Error: size must be > 0"
@@ -104,16 +249,24 @@ if __name__ == "__main__":
 
     #handle optional parameters.
     timeout = 0
-    if len(sys.argv) == 4:
+    if len(args) == 3:
         try:
-            timeout = int(sys.argv[3])
+            timeout = int(args[2])
         except ValueError:
             print "Error: timeout values must be an integer."
             is_error = True
 
-    if not is_error:
-        main(data_size, sys.stdout, timeout)
-    else:
+    if is_error:
         print "Exiting."
         sys.exit(1)
 
+    block_options = dict(line_length=options.line_length, binary=options.binary,
+                         stderr_every=options.stderr_every, seed=options.seed)
+    if options.checksum:
+        digests = checksums(data_size, options.block_size, **block_options)
+        print "stdout {}\nstderr {}".format(digests[STDOUT], digests[STDERR])
+    elif options.block_size > 0:
+        time.sleep(max(0, timeout))
+        write_blocks(data_size, options.block_size, options.rate, **block_options)
+    else:
+        main(data_size, sys.stdout, timeout)